@@ -0,0 +1,477 @@
+"""
+Performance benchmarks for the backend service layer
+
+Runs against a scratch database (BENCH_DB_NAME, default "zone_bench") on the
+configured MONGO_URL. Never point it at a production database.
+
+Usage:
+    python benchmark.py numbering --clients 200 --per-client 25
+    python benchmark.py line-items --lines 1 10 100 300
+    python benchmark.py ledger --clients 50 --per-client 20
+    python benchmark.py journal-list --entries 10000
+    python benchmark.py serialize --rows 10000 --repeat 5
+    python benchmark.py helpers --ops 2000 --concurrency 1
+    python benchmark.py pdf-load --renders 50 --mode pool
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+os.environ["DB_NAME"] = os.environ.get("BENCH_DB_NAME", "zone_bench")
+
+from database import (  # noqa: E402
+    db, get_document, DocumentLoader, create_document, update_document, delete_document, convert_objectid_to_str,
+    id_filter
+)
+import numbering  # noqa: E402
+import ledger  # noqa: E402
+
+
+def report(name: str, count: int, elapsed: float) -> None:
+    """Print a one-line throughput summary"""
+    rate = count / elapsed if elapsed else float("inf")
+    print(f"{name:<40} {count:>8} ops  {elapsed:>8.3f}s  {rate:>10.1f} ops/s")
+
+
+# =============================
+# Document numbering
+# =============================
+
+async def _legacy_next_number(prefix: str, year: int) -> str:
+    """The find_one-by-regex-sort scheme numbering.py replaced"""
+    last = await db.bench_invoices.find_one(
+        {"invoice_number": {"$regex": f"^{prefix}-{year}-"}},
+        sort=[("invoice_number", -1)]
+    )
+    if last:
+        last_num = int(last.get("invoice_number", "0").split("-")[-1])
+        return numbering.format_number(prefix, year, last_num + 1)
+    return numbering.format_number(prefix, year, 1)
+
+
+async def bench_numbering(clients: int, per_client: int, block_size: int, legacy: bool) -> None:
+    """Create numbered documents from concurrent clients and check for duplicates"""
+    prefix = "BENCH"
+    year = 2000
+    await db.bench_invoices.drop()
+    await db[numbering.COUNTERS_COLLECTION].delete_many({"prefix": prefix})
+    numbering.NUMBER_BLOCK_SIZE = block_size
+    numbering.NUMBER_SEQUENCES[prefix] = ("bench_invoices", "invoice_number")
+    numbering._seeded.clear()
+    numbering._blocks.clear()
+
+    async def client():
+        for _ in range(per_client):
+            if legacy:
+                number = await _legacy_next_number(prefix, year)
+            else:
+                number = await numbering.next_number(prefix, year)
+            await db.bench_invoices.insert_one({"invoice_number": number})
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+
+    total = clients * per_client
+    unique = len(await db.bench_invoices.distinct("invoice_number"))
+    label = "legacy regex" if legacy else f"counters (block={block_size})"
+    report(f"create with numbering, {label}", total, elapsed)
+    print(f"{'':<40} {total - unique} duplicate numbers")
+
+    await db.bench_invoices.drop()
+    await db[numbering.COUNTERS_COLLECTION].delete_many({"prefix": prefix})
+
+
+# =============================
+# Line-item product lookups
+# =============================
+
+async def _resolve_per_line(items):
+    """One find_one round-trip per line, as the create endpoints used to do before get_document was cached"""
+    for item in items:
+        await db.products.find_one(id_filter(item["product_id"]))
+
+
+async def _resolve_batched(items):
+    """One $in query for all lines through DocumentLoader"""
+    loader = DocumentLoader("products")
+    await loader.load_many(item["product_id"] for item in items)
+    for item in items:
+        await loader.load(item["product_id"])
+
+
+async def bench_line_items(line_counts, repeat: int, with_endpoint: bool) -> None:
+    """Time product resolution for invoices of increasing size, per-line vs batched"""
+    from server import SalesInvoiceCreate, create_sales_invoice
+
+    await db.products.delete_many({"sku": {"$regex": "^BENCH-"}})
+    await db.customers.delete_many({"email": "bench@example.com"})
+    max_lines = max(line_counts)
+    result = await db.products.insert_many([
+        {"name": f"Bench product {i}", "sku": f"BENCH-{i:05d}", "category": "Bench",
+         "price": 1000.0, "cost": 500.0, "stock": 1000000, "min_stock": 0, "max_stock": 0}
+        for i in range(max_lines)
+    ])
+    product_ids = [str(oid) for oid in result.inserted_ids]
+    customer = await db.customers.insert_one({"name": "Bench customer", "email": "bench@example.com"})
+
+    for lines in line_counts:
+        items = [{"product_id": product_ids[i], "quantity": 1} for i in range(lines)]
+        for label, resolve in (("per-line get_document", _resolve_per_line), ("DocumentLoader", _resolve_batched)):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                await resolve(items)
+            elapsed = time.perf_counter() - start
+            print(f"{lines:>5} lines  {label:<24} {elapsed / repeat * 1000:>9.2f} ms/invoice")
+
+        if with_endpoint:
+            payload = SalesInvoiceCreate(customer_id=str(customer.inserted_id), invoice_date="2000-01-01",
+                                         due_date="2000-01-31", items=[dict(item) for item in items])
+            start = time.perf_counter()
+            for _ in range(repeat):
+                await create_sales_invoice(payload.model_copy(deep=True))
+            elapsed = time.perf_counter() - start
+            print(f"{lines:>5} lines  {'create_sales_invoice':<24} {elapsed / repeat * 1000:>9.2f} ms/invoice")
+
+    await db.products.delete_many({"sku": {"$regex": "^BENCH-"}})
+    await db.customers.delete_many({"email": "bench@example.com"})
+    await db.sales_invoices.delete_many({"customer_id": str(customer.inserted_id)})
+
+
+# =============================
+# Ledger posting
+# =============================
+
+async def bench_ledger(clients: int, per_client: int, transactions: str) -> None:
+    """Post concurrently between two accounts and check the balances did not drift"""
+    codes = {"BENCH-DR": "Debit", "BENCH-CR": "Credit"}
+    await db.chart_of_accounts.delete_many({"account_code": {"$in": list(codes)}})
+    await db.general_journal.delete_many({"reference": "bench-ledger"})
+    await db.chart_of_accounts.insert_many([
+        {"account_code": code, "account_name": code, "normal_balance": normal, "balance": 0.0}
+        for code, normal in codes.items()
+    ])
+    ledger.forget_accounts()
+    ledger.LEDGER_TRANSACTIONS = transactions
+    ledger._transactions_supported = None
+
+    async def client():
+        for _ in range(per_client):
+            await ledger.post_journal([ledger.Posting(
+                debit_code="BENCH-DR", credit_code="BENCH-CR", amount=1.0,
+                description="bench", reference="bench-ledger", entry_date="2000-01-01"
+            )])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+
+    total = clients * per_client
+    mode = "transaction" if await ledger.transactions_supported() else "bulk_write"
+    report(f"ledger postings ({mode})", total, elapsed)
+    entries = await db.general_journal.count_documents({"reference": "bench-ledger"})
+    async for account in db.chart_of_accounts.find({"account_code": {"$in": list(codes)}}):
+        drift = account["balance"] - total
+        print(f"{'':<40} {account['account_code']}: balance {account['balance']:.0f}, drift {drift:.0f}")
+    print(f"{'':<40} {entries} journal entries for {total} postings")
+
+    await db.chart_of_accounts.delete_many({"account_code": {"$in": list(codes)}})
+    await db.general_journal.delete_many({"reference": "bench-ledger"})
+    ledger.forget_accounts()
+
+
+# =============================
+# General journal listing
+# =============================
+
+async def bench_journal_list(entries: int, accounts: int) -> None:
+    """List journal entries with per-entry account lookups versus the cached name map"""
+    from server import get_general_journal_entries, list_params
+    from starlette.responses import Response
+
+    await db.chart_of_accounts.delete_many({"account_code": {"$regex": "^BENCH-"}})
+    await db.general_journal.delete_many({"reference": "bench-journal"})
+    result = await db.chart_of_accounts.insert_many([
+        {"account_code": f"BENCH-{i:03d}", "account_name": f"Bench account {i}", "normal_balance": "Debit", "balance": 0.0}
+        for i in range(accounts)
+    ])
+    account_ids = [str(oid) for oid in result.inserted_ids]
+    now = datetime.utcnow()
+    await db.general_journal.insert_many([
+        {"entry_number": f"BENCH-{i:06d}", "entry_date": "2000-01-01", "description": "bench",
+         "debit_account": account_ids[i % accounts], "credit_account": account_ids[(i + 1) % accounts],
+         "debit_amount": 1.0, "credit_amount": 1.0, "reference": "bench-journal", "status": "Posted",
+         "created_by": "bench", "created_at": now - timedelta(seconds=i)}
+        for i in range(entries)
+    ])
+    docs = await db.general_journal.find({"reference": "bench-journal"}).to_list(length=entries)
+    for doc in docs:
+        doc["debit_account"], doc["credit_account"] = str(doc["debit_account"]), str(doc["credit_account"])
+
+    start = time.perf_counter()
+    # Straight to the database: get_document is cached now, and repeats would only measure hits
+    for doc in docs:
+        await db.chart_of_accounts.find_one(id_filter(doc["debit_account"]))
+        await db.chart_of_accounts.find_one(id_filter(doc["credit_account"]))
+    report("names via find_one per entry", entries, time.perf_counter() - start)
+
+    ledger.forget_accounts()
+    start = time.perf_counter()
+    names = await ledger.account_names(
+        [doc["debit_account"] for doc in docs] + [doc["credit_account"] for doc in docs]
+    )
+    for doc in docs:
+        names.get(doc["debit_account"]), names.get(doc["credit_account"])
+    report("names via cached account map", entries, time.perf_counter() - start)
+
+    # Page through the endpoint itself
+    start = time.perf_counter()
+    listed, cursor = 0, None
+    while True:
+        response = Response()
+        page = list_params(limit=1000, cursor=cursor, order=None)
+        listed += len(await get_general_journal_entries(response, page, status=None, reference="bench-journal"))
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    report("GET /general-journal, pages of 1000", listed, time.perf_counter() - start)
+
+    await db.chart_of_accounts.delete_many({"account_code": {"$regex": "^BENCH-"}})
+    await db.general_journal.delete_many({"reference": "bench-journal"})
+    ledger.forget_accounts()
+
+
+# =============================
+# List serialization
+# =============================
+
+def _legacy_customer_rows(docs):
+    """The per-row rebuild get_customers did before documents_response"""
+    rows = []
+    for cust in docs:
+        rows.append({
+            "id": cust.get("id", ""),
+            "name": cust.get("name", ""),
+            "contact_person": cust.get("contact_person", ""),
+            "email": cust.get("email", ""),
+            "phone": cust.get("phone", ""),
+            "address": cust.get("address", ""),
+            "city": cust.get("city", ""),
+            "type": cust.get("type", "Corporate"),
+            "status": cust.get("status", "Active"),
+            "credit_limit": cust.get("credit_limit", 0),
+            "total_purchases": cust.get("total_purchases", 0),
+            "last_purchase": cust.get("last_purchase"),
+            "created_at": cust.get("created_at", datetime.utcnow()).isoformat() if isinstance(cust.get("created_at"), datetime) else cust.get("created_at", "")
+        })
+    return rows
+
+
+def bench_serialize(rows: int, repeat: int) -> None:
+    """Encode a page of customers the old way (rebuild, validate, json) and with documents_response"""
+    from typing import List
+    from pydantic import TypeAdapter
+    from starlette.responses import Response
+    from server import Customer
+    from serialization import documents_response
+
+    now = datetime.utcnow()
+    page = [{
+        "id": f"{i:024x}", "name": f"Customer {i}", "contact_person": "Bench", "email": f"c{i}@bench.test",
+        "phone": "+62 21 0000", "address": "Jl. Bench 1", "city": "Jakarta", "type": "Corporate",
+        "status": "Active", "credit_limit": 1000000.0, "total_purchases": float(i), "last_purchase": None,
+        "created_at": now - timedelta(seconds=i)
+    } for i in range(rows)]
+    adapter = TypeAdapter(List[Customer])
+    defaults = {field: None for field in Customer.model_fields if field != "id"}
+
+    def legacy():
+        # What FastAPI does with response_model: validate, dump to JSON-able, json.dumps
+        validated = adapter.validate_python(_legacy_customer_rows(page))
+        return json.dumps(adapter.dump_python(validated, mode="json")).encode()
+
+    def fast():
+        return documents_response([dict(doc) for doc in page], Response(), defaults).body
+
+    for name, encode in (("rebuild + response_model + json", legacy), ("documents_response (orjson)", fast)):
+        size = len(encode())
+        start = time.perf_counter()
+        for _ in range(repeat):
+            encode()
+        elapsed = time.perf_counter() - start
+        report(name, rows * repeat, elapsed)
+        print(f"{'':<40} {elapsed / repeat / rows * 10000 * 1000:>8.1f} ms per 10k rows, {size} bytes")
+
+
+# =============================
+# Database helpers
+# =============================
+
+async def _legacy_create_document(collection_name: str, data):
+    """create_document before it stopped reading the document back"""
+    collection = db[collection_name]
+    data["created_at"] = datetime.utcnow()
+    data["updated_at"] = datetime.utcnow()
+    result = await collection.insert_one(data)
+    return convert_objectid_to_str(await collection.find_one({"_id": result.inserted_id}))
+
+
+async def _legacy_update_document(collection_name: str, doc_id: str, data):
+    """update_document before find_one_and_update: update_one, then get_document"""
+    from bson import ObjectId
+    data["updated_at"] = datetime.utcnow()
+    result = await db[collection_name].update_one({"_id": ObjectId(doc_id)}, {"$set": data})
+    if result.modified_count > 0:
+        return convert_objectid_to_str(await db[collection_name].find_one({"_id": ObjectId(doc_id)}))
+    return None
+
+
+async def bench_helpers(ops: int, concurrency: int) -> None:
+    """ops/s of the write helpers against their read-after-write predecessors"""
+    collection_name = "bench_helpers"
+    await db[collection_name].drop()
+
+    async def run(name, make_op):
+        per_client = ops // concurrency
+
+        async def client(offset):
+            for i in range(per_client):
+                await make_op(offset * per_client + i)
+        start = time.perf_counter()
+        await asyncio.gather(*(client(c) for c in range(concurrency)))
+        report(name, per_client * concurrency, time.perf_counter() - start)
+
+    def new_doc(i):
+        return {"name": f"Bench {i}", "sku": f"BENCH-{i:08d}", "price": 1.0, "stock": 10}
+
+    await run("create_document (insert + find_one)", lambda i: _legacy_create_document(collection_name, new_doc(i)))
+    await run("create_document", lambda i: create_document(collection_name, new_doc(i)))
+
+    ids = [str(doc["_id"]) async for doc in db[collection_name].find({}, {"_id": 1}).limit(ops)]
+    await run("update_document (update_one + get)", lambda i: _legacy_update_document(
+        collection_name, ids[i % len(ids)], {"price": float(i)}))
+    await run("update_document", lambda i: update_document(collection_name, ids[i % len(ids)], {"price": float(i)}))
+    await run("get_document", lambda i: get_document(collection_name, ids[i % len(ids)]))
+    await run("delete_document", lambda i: delete_document(collection_name, ids[i % len(ids)]))
+
+    await db[collection_name].drop()
+
+
+# =============================
+# PDF rendering under load
+# =============================
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+async def bench_pdf_load(renders: int, lines: int, mode: str, probe_interval_ms: float) -> None:
+    """Latency of an unrelated endpoint while PDFs render, inline on the loop versus in the pool"""
+    import pdf_service
+    from pdf_generator import PDFGenerator
+    from server import health
+
+    invoice = {
+        "id": "BENCH", "customer_id": "CUST-BENCH", "customer_name": "PT. Bench", "invoice_date": "2000-01-01",
+        "due_date": "2000-02-01", "amount": 1000.0 * lines, "status": "Pending",
+        "items": [{"product_id": f"PRD-{i}", "product_name": f"Product {i}", "quantity": 1,
+                   "unit_price": 1000.0, "total": 1000.0} for i in range(lines)]
+    }
+    pdf_service.PDF_MAX_PENDING = renders
+    if mode == "pool":
+        await pdf_service.start_pdf_pool()
+    generator = PDFGenerator()
+
+    async def render(i):
+        if mode == "inline":
+            # What the endpoints did before: build on the event loop
+            generator.render_bytes("generate_invoice_pdf", invoice)
+        else:
+            await pdf_service.render_pdf("invoice", invoice)
+
+    latencies = []
+    rendering = True
+
+    async def probe():
+        interval = probe_interval_ms / 1000
+        while rendering:
+            scheduled = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            await health()
+            latencies.append((time.perf_counter() - scheduled) * 1000)
+
+    prober = asyncio.create_task(probe())
+    await asyncio.sleep(0.2)
+    start = time.perf_counter()
+    await asyncio.gather(*(render(i) for i in range(renders)))
+    elapsed = time.perf_counter() - start
+    rendering = False
+    await prober
+    await pdf_service.stop_pdf_pool()
+
+    report(f"{renders} PDFs, {lines} lines, {mode}", renders, elapsed)
+    print(f"{'GET /health while rendering':<40} p50 {percentile(latencies, 0.5):.1f} ms  "
+          f"p99 {percentile(latencies, 0.99):.1f} ms  max {max(latencies, default=0):.1f} ms  ({len(latencies)} calls)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ZONE backend benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("numbering", help="concurrent document creation with numbering")
+    p.add_argument("--clients", type=int, default=200)
+    p.add_argument("--per-client", type=int, default=25)
+    p.add_argument("--block-size", type=int, default=1)
+    p.add_argument("--legacy", action="store_true", help="use the old regex scheme for comparison")
+
+    p = sub.add_parser("line-items", help="invoice product lookups versus line count")
+    p.add_argument("--lines", type=int, nargs="+", default=[1, 10, 100, 300])
+    p.add_argument("--repeat", type=int, default=20)
+    p.add_argument("--endpoint", action="store_true", help="also time create_sales_invoice end to end")
+
+    p = sub.add_parser("ledger", help="concurrent journal postings with a balance drift check")
+    p.add_argument("--clients", type=int, default=50)
+    p.add_argument("--per-client", type=int, default=20)
+    p.add_argument("--transactions", choices=["auto", "off"], default="auto")
+
+    p = sub.add_parser("journal-list", help="general journal listing with account names")
+    p.add_argument("--entries", type=int, default=10000)
+    p.add_argument("--accounts", type=int, default=50)
+
+    p = sub.add_parser("serialize", help="list response encoding cost per 10k rows")
+    p.add_argument("--rows", type=int, default=10000)
+    p.add_argument("--repeat", type=int, default=5)
+
+    p = sub.add_parser("helpers", help="ops/s of create/update/get/delete_document")
+    p.add_argument("--ops", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=1)
+
+    p = sub.add_parser("pdf-load", help="unrelated endpoint latency while PDFs render")
+    p.add_argument("--renders", type=int, default=50)
+    p.add_argument("--lines", type=int, default=50)
+    p.add_argument("--mode", choices=["inline", "pool"], default="pool")
+    p.add_argument("--probe-interval-ms", type=float, default=5)
+
+    args = parser.parse_args()
+    if args.command == "numbering":
+        asyncio.run(bench_numbering(args.clients, args.per_client, args.block_size, args.legacy))
+    elif args.command == "line-items":
+        asyncio.run(bench_line_items(args.lines, args.repeat, args.endpoint))
+    elif args.command == "ledger":
+        asyncio.run(bench_ledger(args.clients, args.per_client, args.transactions))
+    elif args.command == "journal-list":
+        asyncio.run(bench_journal_list(args.entries, args.accounts))
+    elif args.command == "serialize":
+        bench_serialize(args.rows, args.repeat)
+    elif args.command == "helpers":
+        asyncio.run(bench_helpers(args.ops, args.concurrency))
+    elif args.command == "pdf-load":
+        asyncio.run(bench_pdf_load(args.renders, args.lines, args.mode, args.probe_interval_ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Bulk import of CSV or NDJSON uploads
+
+Rows are parsed lazily from the uploaded file and handled IMPORT_CHUNK_SIZE at
+a time: each row is validated with the same model as the single-create
+endpoint, duplicates of the unique key (SKU or email) are found with one $in
+query per chunk (plus within the chunk itself), and the rest are written with
+one unordered insert_many, so one bad row never blocks the others. A result
+line per row is yielded as soon as its chunk is done.
+"""
+import codecs
+import csv
+import json
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Type
+
+from pydantic import BaseModel, ValidationError
+from pymongo.errors import BulkWriteError
+
+from database import bump_change_version, db
+from search import SEARCH_FIELDS, with_search_keys
+
+# Rows validated, de-duplicated and inserted together
+IMPORT_CHUNK_SIZE = 1000
+
+# (row number, parsed fields or the reason the row could not be parsed)
+ParsedRow = Tuple[int, Any]
+
+
+class ImportSpec(NamedTuple):
+    model: Type[BaseModel]
+    build: Callable[[Any], Dict]  # validated model -> document, as the create endpoint stores it
+    key_field: Optional[str]  # unique business key; rows without a value are not de-duplicated
+
+
+def csv_rows(binary) -> Iterator[ParsedRow]:
+    """Rows of a CSV file with a header line; row numbers count the header as line 1"""
+    reader = csv.DictReader(codecs.getreader("utf-8-sig")(binary))
+    for row in reader:
+        yield reader.line_num, {key.strip(): value for key, value in row.items() if key and value is not None}
+
+
+def ndjson_rows(binary) -> Iterator[ParsedRow]:
+    """One JSON object per line; blank lines are skipped"""
+    for number, line in enumerate(codecs.getreader("utf-8-sig")(binary), start=1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            yield number, ValueError(f"Invalid JSON: {str(e)}")
+            continue
+        yield number, data if isinstance(data, dict) else ValueError("Expected a JSON object")
+
+
+def _chunks(rows: Iterable[ParsedRow], size: int) -> Iterator[List[ParsedRow]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _validation_message(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in error.errors())
+
+
+def _validate(spec: ImportSpec, data: Dict) -> BaseModel:
+    # Empty CSV cells fall back to the model default where there is one
+    fields = spec.model.model_fields
+    data = {key: value for key, value in data.items()
+            if not (value == "" and key in fields and not fields[key].is_required())}
+    return spec.model(**data)
+
+
+async def _import_chunk(collection_name: str, spec: ImportSpec, chunk: List[ParsedRow]) -> List[Dict]:
+    results: Dict[int, Dict] = {}
+    pending: List[Tuple[int, Dict]] = []
+    keys_in_chunk = set()
+
+    for number, data in chunk:
+        if isinstance(data, Exception):
+            results[number] = {"row": number, "status": "invalid", "error": str(data)}
+            continue
+        try:
+            doc = spec.build(_validate(spec, data))
+        except ValidationError as e:
+            results[number] = {"row": number, "status": "invalid", "error": _validation_message(e)}
+            continue
+        key = doc.get(spec.key_field) if spec.key_field else None
+        if key and key in keys_in_chunk:
+            results[number] = {"row": number, "status": "duplicate", "key": key}
+            continue
+        if key:
+            keys_in_chunk.add(key)
+        pending.append((number, doc))
+
+    if keys_in_chunk:
+        existing = {
+            doc[spec.key_field] async for doc in
+            db[collection_name].find({spec.key_field: {"$in": list(keys_in_chunk)}}, {spec.key_field: 1})
+        }
+        still_pending = []
+        for number, doc in pending:
+            key = doc.get(spec.key_field)
+            if key in existing:
+                results[number] = {"row": number, "status": "duplicate", "key": key}
+            else:
+                still_pending.append((number, doc))
+        pending = still_pending
+
+    if pending:
+        now = datetime.utcnow()
+        docs = []
+        for _, doc in pending:
+            doc["created_at"] = now
+            doc["updated_at"] = now
+            docs.append(with_search_keys(collection_name, doc) if collection_name in SEARCH_FIELDS else doc)
+
+        failed: Dict[int, Dict] = {}
+        try:
+            await db[collection_name].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Unordered: every other document was still inserted
+            for error in e.details.get("writeErrors", []):
+                failed[error["index"]] = error
+        except Exception as e:
+            logging.error(f"Error importing {collection_name} chunk: {str(e)}")
+            failed = {index: {"errmsg": str(e)} for index in range(len(docs))}
+
+        for index, (number, doc) in enumerate(pending):
+            error = failed.get(index)
+            if error is None:
+                results[number] = {"row": number, "status": "created", "id": str(doc["_id"])}
+            elif error.get("code") == 11000:
+                # Inserted concurrently since the $in check
+                results[number] = {"row": number, "status": "duplicate", "key": doc.get(spec.key_field)}
+            else:
+                results[number] = {"row": number, "status": "error", "error": error.get("errmsg", "")}
+        if len(failed) < len(docs):
+            await bump_change_version(collection_name)
+
+    return [results[number] for number, _ in chunk]
+
+
+async def import_rows(collection_name: str, spec: ImportSpec, rows: Iterable[ParsedRow],
+                      chunk_size: int = IMPORT_CHUNK_SIZE) -> AsyncIterator[Dict]:
+    """Yield one result per row, then {"summary": counts per status}"""
+    summary = {"created": 0, "duplicate": 0, "invalid": 0, "error": 0}
+    for chunk in _chunks(rows, chunk_size):
+        for result in await _import_chunk(collection_name, spec, chunk):
+            summary[result["status"]] += 1
+            yield result
+    yield {"summary": summary}
@@ -0,0 +1,144 @@
+"""
+Process-local read-through cache for hot reference documents
+
+get_document serves customers, products, vendors and chart of accounts rows
+from here while they are fresh. Entries expire after a per-collection TTL,
+which bounds how stale a worker can be after another worker's write, and the
+least recently used entries are evicted beyond DOCUMENT_CACHE_SIZE. Writes
+made through the database helpers (and the stock and ledger services)
+invalidate the affected ids immediately in the writing process.
+"""
+import copy
+import os
+import time
+from collections import OrderedDict, defaultdict
+from typing import Dict, NamedTuple, Optional, Set, Tuple
+
+# Collection -> seconds a cached document is served before it is re-read
+CACHE_TTLS: Dict[str, float] = {
+    "customers": 60,
+    "vendors": 60,
+    "products": 30,
+    "chart_of_accounts": 300,
+}
+
+# Entries kept across all collections; 0 disables the cache
+DOCUMENT_CACHE_SIZE = int(os.environ.get("DOCUMENT_CACHE_SIZE", "10000"))
+
+STAT_FIELDS = ("hits", "misses", "expirations", "evictions", "invalidations")
+
+
+class CacheEntry(NamedTuple):
+    expires_at: float
+    canonical_id: str  # the document's own id, when it was requested by a legacy string id
+    doc: Dict
+
+
+class DocumentCache:
+    """LRU of (collection, id) -> document with per-collection TTLs and hit/miss counters"""
+
+    def __init__(self, ttls: Dict[str, float], max_entries: int):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], CacheEntry]" = OrderedDict()
+        # (collection, canonical id) -> other ids the same document is cached under
+        self._aliases: Dict[Tuple[str, str], Set[str]] = defaultdict(set)
+        # Bumped by every invalidation, so a read that raced a write is not cached
+        self._generations: Dict[str, int] = defaultdict(int)
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(lambda: dict.fromkeys(STAT_FIELDS, 0))
+
+    def enabled(self, collection_name: str) -> bool:
+        return self.max_entries > 0 and self.ttls.get(collection_name, 0) > 0
+
+    def generation(self, collection_name: str) -> int:
+        """Take before reading from the database and pass to put()"""
+        return self._generations[collection_name]
+
+    def get(self, collection_name: str, doc_id: str) -> Optional[Dict]:
+        """A copy of the cached document, or None on a miss"""
+        if not self.enabled(collection_name) or not doc_id:
+            return None
+        key = (collection_name, doc_id)
+        stats = self._stats[collection_name]
+        entry = self._entries.get(key)
+        if entry is None:
+            stats["misses"] += 1
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            stats["expirations"] += 1
+            stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        stats["hits"] += 1
+        return copy.deepcopy(entry.doc)
+
+    def put(self, collection_name: str, doc_id: str, doc: Dict, generation: int) -> None:
+        """Cache a document read by id, unless the collection was invalidated since generation"""
+        if not self.enabled(collection_name) or not doc_id or generation != self._generations[collection_name]:
+            return
+        key = (collection_name, doc_id)
+        canonical_id = doc.get("id") or doc_id
+        self._remove(key)
+        self._entries[key] = CacheEntry(
+            time.monotonic() + self.ttls[collection_name], canonical_id, copy.deepcopy(doc)
+        )
+        if canonical_id != doc_id:
+            self._aliases[(collection_name, canonical_id)].add(doc_id)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._stats[oldest[0]]["evictions"] += 1
+
+    def invalidate(self, collection_name: str, doc_id: str) -> None:
+        """Drop a document, under every id it was cached by"""
+        self._generations[collection_name] += 1
+        if not doc_id:
+            return
+        ids = {doc_id}
+        entry = self._entries.get((collection_name, doc_id))
+        if entry:
+            ids.add(entry.canonical_id)
+        for known_id in list(ids):
+            ids |= self._aliases.pop((collection_name, known_id), set())
+        for known_id in ids:
+            if self._remove((collection_name, known_id)):
+                self._stats[collection_name]["invalidations"] += 1
+
+    def clear(self, collection_name: Optional[str] = None) -> None:
+        """Drop every entry, or every entry of one collection"""
+        for key in [key for key in self._entries if collection_name in (None, key[0])]:
+            self._remove(key)
+        for name in ([collection_name] if collection_name else list(self.ttls)):
+            self._generations[name] += 1
+
+    def stats(self) -> Dict:
+        sizes: Dict[str, int] = defaultdict(int)
+        for collection_name, _ in self._entries:
+            sizes[collection_name] += 1
+        collections = {}
+        for collection_name, ttl in self.ttls.items():
+            counters = dict(self._stats[collection_name])
+            lookups = counters["hits"] + counters["misses"]
+            collections[collection_name] = {
+                "ttl_seconds": ttl,
+                "size": sizes[collection_name],
+                **counters,
+                "hit_rate": round(counters["hits"] / lookups, 4) if lookups else None
+            }
+        return {"max_entries": self.max_entries, "size": len(self._entries), "collections": collections}
+
+    def _remove(self, key: Tuple[str, str]) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        if entry.canonical_id != key[1]:
+            aliases = self._aliases.get((key[0], entry.canonical_id))
+            if aliases is not None:
+                aliases.discard(key[1])
+                if not aliases:
+                    del self._aliases[(key[0], entry.canonical_id)]
+        return True
+
+
+document_cache = DocumentCache(CACHE_TTLS, DOCUMENT_CACHE_SIZE)
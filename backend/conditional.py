@@ -0,0 +1,126 @@
+"""
+Conditional GETs for list and detail endpoints
+
+Every write through the database helpers (and the stock, ledger and overdue
+services) bumps a per-collection change version. For GET requests on the
+routes below, the middleware derives an ETag from the URL and the versions of
+the collections the route reads, plus Last-Modified from the newest bump
+once its second has passed. A request whose If-None-Match (or
+If-Modified-Since) still matches is answered with 304 before the endpoint
+runs, so an unchanged poll costs one indexed lookup and no payload.
+"""
+import hashlib
+import re
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, List, Optional, Pattern, Tuple
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from database import get_change_versions
+
+# Route pattern -> collections whose changes can alter the response
+CONDITIONAL_ROUTES: List[Tuple[Pattern, Tuple[str, ...]]] = [
+    # The optional segment is a document id; PDF bundles are generated, not read
+    (re.compile(rf"^/api/{path}(/(?!pdf-bundle$)[^/]+)?$"), collections) for path, collections in [
+        ("customers", ("customers",)),
+        ("vendors", ("vendors",)),
+        ("products", ("products",)),
+        ("sales-invoices", ("sales_invoices",)),
+        ("sales-orders", ("sales_orders",)),
+        ("quotations", ("quotations",)),
+        ("purchase-invoices", ("purchase_invoices",)),
+        ("purchase-orders", ("purchase_orders",)),
+        ("stock-opnames", ("stock_opnames",)),
+        ("stock-transfers", ("stock_transfers",)),
+        ("production-orders", ("production_orders",)),
+        ("users", ("users",)),
+        ("chart-of-accounts", ("chart_of_accounts",)),
+        # Journal rows show account names
+        ("general-journal", ("general_journal", "chart_of_accounts")),
+    ]
+]
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header names etag (weak or strong) or is *"""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
+
+
+def route_collections(path: str) -> Optional[Tuple[str, ...]]:
+    for pattern, collections in CONDITIONAL_ROUTES:
+        if pattern.match(path):
+            return collections
+    return None
+
+
+def _validators(request: Request, collections: Tuple[str, ...],
+                versions: Dict[str, Dict]) -> Tuple[str, Optional[datetime]]:
+    """Weak ETag for this URL at the current versions, and the newest change time"""
+    parts = [request.url.path, request.url.query]
+    modified = []
+    for name in collections:
+        version = versions.get(name, {})
+        parts.append(f"{name}:{version.get('version', 0)}")
+        if version.get("updated_at"):
+            modified.append(version["updated_at"])
+    digest = hashlib.sha1("|".join(parts).encode()).hexdigest()[:20]
+    return f'W/"{digest}"', max(modified) if modified else None
+
+
+def _not_modified(request: Request, etag: str, last_modified: Optional[datetime]) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        return etag_matches(if_none_match, etag[2:])
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since).replace(tzinfo=None)
+        except (TypeError, ValueError):
+            return False
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+def _settled(last_modified: Optional[datetime]) -> bool:
+    """Whether the second of the newest change has passed, so no later change can share it.
+
+    Last-Modified only has whole seconds: sent earlier, a write later in the
+    same second would leave it unchanged and revalidation would answer 304.
+    """
+    if not last_modified:
+        return False
+    return datetime.utcnow() >= last_modified.replace(microsecond=0) + timedelta(seconds=1)
+
+
+def _set_validators(response: Response, etag: str, last_modified: Optional[datetime]) -> None:
+    response.headers["ETag"] = etag
+    if _settled(last_modified):
+        response.headers["Last-Modified"] = format_datetime(
+            last_modified.replace(microsecond=0, tzinfo=timezone.utc), usegmt=True
+        )
+    # Clients may keep the body but must revalidate it on every poll
+    response.headers["Cache-Control"] = "no-cache"
+
+
+async def conditional_get_middleware(request: Request, call_next):
+    collections = route_collections(request.url.path) if request.method == "GET" else None
+    if not collections:
+        return await call_next(request)
+
+    # Versions are read before the endpoint runs, so a concurrent write can only make the ETag older than the body
+    etag, last_modified = _validators(request, collections, await get_change_versions(collections))
+    if _not_modified(request, etag, last_modified):
+        response = Response(status_code=304)
+        _set_validators(response, etag, last_modified)
+        return response
+
+    response = await call_next(request)
+    if response.status_code == 200:
+        _set_validators(response, etag, last_modified)
+    return response
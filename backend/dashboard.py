@@ -0,0 +1,293 @@
+"""
+Materialized dashboard aggregates maintained incrementally by invoice writes
+
+The dashboard_aggregates collection holds one "summary" document (totals,
+pending count, recent transactions) and one "month:YYYY-MM" document per
+month with revenue/expense buckets. Invoice endpoints call
+record_invoice_change with the before/after documents; rebuild_dashboard_aggregates
+recomputes everything from the invoice collections for recovery. Rebuilds
+run one at a time under a lease and replace documents in place, so readers
+never see the collection empty; invoice changes that land while a rebuild
+scans (record_invoice_change skips them while the summary is stale) leave it
+marked stale, and the next read rebuilds again.
+
+Usage:
+    python dashboard.py rebuild
+"""
+import argparse
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ReplaceOne
+
+from database import TOMBSTONES_COLLECTION, acquire_lease, db, release_lease, stream_documents
+
+DASHBOARD_COLLECTION = "dashboard_aggregates"
+SUMMARY_ID = "summary"
+
+# Lease serialising rebuilds across workers, and how long a waiting reader polls for its result
+REBUILD_LOCK_ID = "dashboard_rebuild"
+REBUILD_LEASE_SECONDS = 300
+REBUILD_WAIT_SECONDS = 30
+REBUILD_POLL_SECONDS = 0.5
+
+# Recent transactions kept on the summary document
+RECENT_TRANSACTIONS_LIMIT = 5
+
+# Collection -> (transaction type, month bucket field, summary total field, counterparty field)
+INVOICE_COLLECTIONS: Dict[str, Tuple[str, str, str, str]] = {
+    "sales_invoices": ("Invoice", "revenue", "total_revenue", "customer_name"),
+    "purchase_invoices": ("Purchase", "expense", "total_expense", "vendor_name"),
+}
+
+# Statuses that count towards revenue/expense, and sales statuses counted as pending
+COUNTED_STATUSES = ("Paid", "Pending", "Overdue")
+PENDING_STATUSES = ("Pending", "Overdue")
+
+INVOICE_PROJECTION = ["invoice_date", "created_at", "amount", "status", "customer_name", "vendor_name"]
+
+
+def parse_date(value: Any) -> Optional[datetime]:
+    """Parse the date formats invoices are stored with"""
+    if isinstance(value, datetime):
+        return value
+    if not value:
+        return None
+    for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(value, fmt)
+        except Exception:
+            continue
+    return None
+
+
+def month_id(year: int, month: int) -> str:
+    """Aggregate document id for a month bucket"""
+    return f"month:{year:04d}-{month:02d}"
+
+
+def invoice_contribution(collection_name: str, doc: Optional[Dict]) -> Dict[Tuple[str, str], float]:
+    """What a single invoice adds to each (aggregate document, field)"""
+    if not doc:
+        return {}
+    _, bucket_field, total_field, _ = INVOICE_COLLECTIONS[collection_name]
+    status = doc.get("status")
+    amount = doc.get("amount", 0.0) or 0.0
+    contribution: Dict[Tuple[str, str], float] = {}
+
+    if status in COUNTED_STATUSES:
+        contribution[(SUMMARY_ID, total_field)] = amount
+    if collection_name == "sales_invoices" and status in PENDING_STATUSES:
+        contribution[(SUMMARY_ID, "pending_invoices")] = 1
+
+    # Monthly buckets include every invoice, matching the cash flow chart
+    dt = parse_date(doc.get("invoice_date") or doc.get("created_at"))
+    if dt:
+        contribution[(month_id(dt.year, dt.month), bucket_field)] = amount
+    return contribution
+
+
+def recent_entry(collection_name: str, doc: Dict) -> Dict:
+    """Recent transaction row stored on the summary document"""
+    tx_type, _, _, party_field = INVOICE_COLLECTIONS[collection_name]
+    created_at = doc.get("created_at")
+    return {
+        "id": doc.get("id", ""),
+        "type": tx_type,
+        "customer": doc.get(party_field, ""),
+        "amount": doc.get("amount", 0.0),
+        "status": doc.get("status", ""),
+        "date": doc.get("invoice_date") or (created_at.isoformat() if isinstance(created_at, datetime) else created_at or ""),
+        "created_at": parse_date(created_at or doc.get("invoice_date")) or datetime.min
+    }
+
+
+async def _load_recent_transactions() -> List[Dict]:
+    """Newest invoices across both collections, read through the created_at index"""
+    entries = []
+    for collection_name in INVOICE_COLLECTIONS:
+        cursor = db[collection_name].find({}, {field: 1 for field in INVOICE_PROJECTION})
+        async for doc in cursor.sort("created_at", -1).limit(RECENT_TRANSACTIONS_LIMIT):
+            doc["id"] = str(doc.pop("_id"))
+            entries.append(recent_entry(collection_name, doc))
+    entries.sort(key=lambda entry: entry["created_at"], reverse=True)
+    return entries[:RECENT_TRANSACTIONS_LIMIT]
+
+
+async def _mark_stale(reason: str) -> None:
+    """Flag the aggregates so the next dashboard read rebuilds them"""
+    logging.error(f"Dashboard aggregates marked stale: {reason}")
+    try:
+        await db[DASHBOARD_COLLECTION].update_one({"_id": SUMMARY_ID}, {"$set": {"stale": True}})
+    except Exception as e:
+        logging.error(f"Error marking dashboard aggregates stale: {str(e)}")
+
+
+async def record_invoice_change(collection_name: str, before: Optional[Dict], after: Optional[Dict]) -> None:
+    """Apply the difference between two versions of an invoice to the aggregates
+
+    Pass before=None for a create and after=None for a delete. Failures never
+    propagate to the caller; the aggregates are marked stale instead.
+    """
+    try:
+        aggregates = db[DASHBOARD_COLLECTION]
+        summary = await aggregates.find_one({"_id": SUMMARY_ID}, {"stale": 1})
+        if not summary or summary.get("stale"):
+            # Nothing to increment yet; the next read rebuilds from scratch
+            return
+
+        deltas = invoice_contribution(collection_name, after)
+        for key, value in invoice_contribution(collection_name, before).items():
+            deltas[key] = deltas.get(key, 0) - value
+
+        increments: Dict[str, Dict[str, float]] = {}
+        for (doc_id, field), value in deltas.items():
+            if value:
+                increments.setdefault(doc_id, {})[field] = value
+
+        for doc_id, inc in increments.items():
+            if doc_id == SUMMARY_ID:
+                continue
+            await aggregates.update_one(
+                {"_id": doc_id},
+                {"$inc": inc, "$setOnInsert": {"month": doc_id.split(":", 1)[1]}},
+                upsert=True
+            )
+
+        entry_id = (after or before or {}).get("id")
+        summary_update: Dict[str, Any] = {"$pull": {"recent_transactions": {"id": entry_id}}}
+        if increments.get(SUMMARY_ID):
+            summary_update["$inc"] = increments[SUMMARY_ID]
+        pulled = await aggregates.update_one({"_id": SUMMARY_ID}, summary_update)
+
+        if after:
+            await aggregates.update_one({"_id": SUMMARY_ID}, {"$push": {"recent_transactions": {
+                "$each": [recent_entry(collection_name, after)],
+                "$sort": {"created_at": -1},
+                "$slice": RECENT_TRANSACTIONS_LIMIT
+            }}})
+        elif pulled.modified_count:
+            # A deleted invoice left a gap in the recent list; refill it
+            await aggregates.update_one(
+                {"_id": SUMMARY_ID},
+                {"$set": {"recent_transactions": await _load_recent_transactions()}}
+            )
+    except Exception as e:
+        await _mark_stale(f"error applying {collection_name} change: {str(e)}")
+
+
+async def refresh_recent_transactions() -> None:
+    """Reload the recent list after bulk status changes that bypass record_invoice_change"""
+    try:
+        await db[DASHBOARD_COLLECTION].update_one(
+            {"_id": SUMMARY_ID},
+            {"$set": {"recent_transactions": await _load_recent_transactions()}}
+        )
+    except Exception as e:
+        await _mark_stale(f"error refreshing recent transactions: {str(e)}")
+
+
+def _empty_summary() -> Dict[str, Any]:
+    return {"_id": SUMMARY_ID, "total_revenue": 0.0, "total_expense": 0.0, "pending_invoices": 0,
+            "recent_transactions": []}
+
+
+async def _changed_since(started: datetime) -> bool:
+    """Whether any invoice was written or deleted after a rebuild started reading"""
+    for collection_name in INVOICE_COLLECTIONS:
+        if await db[collection_name].find_one({"updated_at": {"$gte": started}}, {"_id": 1}):
+            return True
+    return await db[TOMBSTONES_COLLECTION].find_one(
+        {"collection": {"$in": list(INVOICE_COLLECTIONS)}, "deleted_at": {"$gte": started}}, {"_id": 1}
+    ) is not None
+
+
+async def _await_rebuild() -> Dict:
+    """Wait for another worker's rebuild and return its summary"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + REBUILD_WAIT_SECONDS
+    summary = None
+    while loop.time() < deadline:
+        await asyncio.sleep(REBUILD_POLL_SECONDS)
+        summary = await db[DASHBOARD_COLLECTION].find_one({"_id": SUMMARY_ID})
+        if summary and not summary.get("stale"):
+            return summary
+    # Still rebuilding: serve what is there rather than block the dashboard
+    return summary or _empty_summary()
+
+
+async def rebuild_dashboard_aggregates() -> Dict:
+    """Recompute every aggregate from the invoice collections
+
+    If another worker is already rebuilding, waits for its result instead.
+    """
+    if not await acquire_lease(REBUILD_LOCK_ID, REBUILD_LEASE_SECONDS):
+        return await _await_rebuild()
+    try:
+        return await _rebuild()
+    finally:
+        await release_lease(REBUILD_LOCK_ID)
+
+
+async def _rebuild() -> Dict:
+    started = datetime.utcnow()
+    summary: Dict[str, Any] = {"_id": SUMMARY_ID, "total_revenue": 0.0, "total_expense": 0.0, "pending_invoices": 0}
+    months: Dict[str, Dict[str, Any]] = {}
+
+    for collection_name in INVOICE_COLLECTIONS:
+        async for doc in stream_documents(collection_name, projection=INVOICE_PROJECTION):
+            for (doc_id, field), value in invoice_contribution(collection_name, doc).items():
+                if doc_id == SUMMARY_ID:
+                    summary[field] += value
+                else:
+                    bucket = months.setdefault(doc_id, {
+                        "_id": doc_id, "month": doc_id.split(":", 1)[1], "revenue": 0.0, "expense": 0.0
+                    })
+                    bucket[field] += value
+
+    summary["recent_transactions"] = await _load_recent_transactions()
+    summary["rebuilt_at"] = datetime.utcnow()
+
+    aggregates = db[DASHBOARD_COLLECTION]
+    # Replace in place: deleting first would let concurrent readers and month upserts race the insert
+    await aggregates.bulk_write(
+        [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in [summary] + list(months.values())],
+        ordered=False
+    )
+    await aggregates.delete_many({"_id": {"$regex": "^month:", "$nin": list(months)}})
+    if await _changed_since(started):
+        await _mark_stale("invoices changed during rebuild")
+    logging.info(f"Rebuilt dashboard aggregates: {len(months)} months")
+    return summary
+
+
+async def get_dashboard_aggregates(months: List[Tuple[int, int]]) -> Tuple[Dict, Dict[Tuple[int, int], Dict]]:
+    """Summary document plus the requested (year, month) buckets, rebuilding if needed"""
+    aggregates = db[DASHBOARD_COLLECTION]
+    summary = await aggregates.find_one({"_id": SUMMARY_ID})
+    if not summary or summary.get("stale"):
+        summary = await rebuild_dashboard_aggregates()
+
+    ids = {month_id(y, m): (y, m) for (y, m) in months}
+    buckets = {}
+    async for doc in aggregates.find({"_id": {"$in": list(ids)}}):
+        buckets[ids[doc["_id"]]] = doc
+    return summary, buckets
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ZONE dashboard aggregates")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("rebuild", help="recompute dashboard aggregates from the invoice collections")
+
+    args = parser.parse_args()
+    if args.command == "rebuild":
+        summary = asyncio.run(rebuild_dashboard_aggregates())
+        rebuilt_at = summary.get("rebuilt_at")
+        print(f"Rebuilt dashboard aggregates at {rebuilt_at.isoformat() if rebuilt_at else 'unknown (another rebuild is still running)'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,21 @@
 Database connection and helper functions
 """
 from motor.motor_asyncio import AsyncIOMotorClient
-from typing import Optional, Dict, Any, List
-from bson import ObjectId
-from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator, Iterable
+from bson import ObjectId, json_util
+from datetime import datetime, timedelta
+import base64
 import os
+import socket
+import uuid
 from dotenv import load_dotenv
 from pathlib import Path
+import logging
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from cache import document_cache
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -18,6 +27,23 @@ db_name = os.environ.get('DB_NAME', 'zone_db')
 client = AsyncIOMotorClient(mongo_url)
 db = client[db_name]
 
+# List page sizes
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 1000
+
+# One {"_id": collection, "version", "updated_at"} document per written collection
+CHANGE_VERSIONS_COLLECTION = "change_versions"
+
+# One {"collection", "doc_id", "deleted_at"} document per deleted document, for delta sync
+TOMBSTONES_COLLECTION = "tombstones"
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get("TOMBSTONE_RETENTION_DAYS", "30"))
+
+# One {"_id": lock id, "owner", "expires_at"} document per lease, see acquire_lease
+LOCKS_COLLECTION = "locks"
+
+# Identifies this process as a lease owner
+_owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
 
 def convert_objectid_to_str(doc: Dict) -> Dict:
     """Convert ObjectId to string in document"""
@@ -27,18 +53,35 @@ def convert_objectid_to_str(doc: Dict) -> Dict:
     return doc
 
 
+def utcnow() -> datetime:
+    """Current UTC time at the millisecond precision MongoDB stores"""
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
 async def create_document(collection_name: str, data: Dict) -> Dict:
-    """Create a new document in collection"""
+    """Create a new document in collection and return it as stored, without reading it back"""
     collection = db[collection_name]
-    data['created_at'] = datetime.utcnow()
-    data['updated_at'] = datetime.utcnow()
-    result = await collection.insert_one(data)
-    doc = await collection.find_one({'_id': result.inserted_id})
-    return convert_objectid_to_str(doc)
+    data['created_at'] = data['updated_at'] = utcnow()
+    # insert_one sets data['_id']
+    await collection.insert_one(data)
+    await bump_change_version(collection_name)
+    return convert_objectid_to_str(dict(data))
 
 
 async def get_document(collection_name: str, doc_id: str) -> Optional[Dict]:
-    """Get a document by ID"""
+    """Get a document by ID, through the document cache for cached collections"""
+    cached = document_cache.get(collection_name, doc_id)
+    if cached is not None:
+        return cached
+    generation = document_cache.generation(collection_name)
+    doc = await _find_document(collection_name, doc_id)
+    if doc:
+        document_cache.put(collection_name, doc_id, doc, generation)
+    return doc
+
+
+async def _find_document(collection_name: str, doc_id: str) -> Optional[Dict]:
     collection = db[collection_name]
     try:
         doc = await collection.find_one({'_id': ObjectId(doc_id)})
@@ -53,7 +96,66 @@ async def get_document(collection_name: str, doc_id: str) -> Optional[Dict]:
         return None
 
 
-async def get_documents(collection_name: str, filter_dict: Optional[Dict] = None, 
+async def get_documents_by_ids(collection_name: str, doc_ids: Iterable[str]) -> Dict[str, Dict]:
+    """Get many documents by ID with a single $in query, keyed by the requested ID.
+
+    IDs are resolved the same way as get_document; IDs that are not found are absent.
+    """
+    object_ids, string_ids = {}, set()
+    for doc_id in doc_ids:
+        if not doc_id:
+            continue
+        try:
+            object_ids[ObjectId(doc_id)] = doc_id
+        except Exception:
+            string_ids.add(doc_id)
+    if not object_ids and not string_ids:
+        return {}
+
+    clauses = []
+    if object_ids:
+        clauses.append({'_id': {'$in': list(object_ids)}})
+    if string_ids:
+        clauses.append({'id': {'$in': list(string_ids)}})
+    query = clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
+    found = {}
+    async for doc in db[collection_name].find(query):
+        requested = object_ids.get(doc['_id'])
+        if requested is None:
+            requested = doc.get('id')
+        found[requested] = convert_objectid_to_str(doc)
+    return found
+
+
+class DocumentLoader:
+    """Per-request identity map over one collection.
+
+    Call load_many() with every ID a request needs to fetch them in one round-trip;
+    later load() calls for those IDs are served from memory. Create one per request,
+    since cached documents are never refreshed.
+    """
+
+    def __init__(self, collection_name: str):
+        self.collection_name = collection_name
+        self._docs: Dict[str, Optional[Dict]] = {}
+
+    async def load_many(self, doc_ids: Iterable[str]) -> Dict[str, Dict]:
+        """Fetch any IDs not seen yet and return the found documents keyed by ID"""
+        doc_ids = [doc_id for doc_id in doc_ids if doc_id]
+        missing = {doc_id for doc_id in doc_ids if doc_id not in self._docs}
+        if missing:
+            found = await get_documents_by_ids(self.collection_name, missing)
+            for doc_id in missing:
+                self._docs[doc_id] = found.get(doc_id)
+        return {doc_id: self._docs[doc_id] for doc_id in doc_ids if self._docs[doc_id]}
+
+    async def load(self, doc_id: str) -> Optional[Dict]:
+        """Get one document, from memory if it was already loaded"""
+        return (await self.load_many([doc_id])).get(doc_id)
+
+
+async def get_documents(collection_name: str, filter_dict: Optional[Dict] = None,
                        skip: int = 0, limit: int = 1000, sort: Optional[List] = None) -> List[Dict]:
     """Get multiple documents from collection"""
     collection = db[collection_name]
@@ -68,43 +170,156 @@ async def get_documents(collection_name: str, filter_dict: Optional[Dict] = None
     return [convert_objectid_to_str(doc) for doc in docs]
 
 
+def encode_cursor(value: Any, doc_id: Any) -> str:
+    """Encode a keyset position (sort value, _id) as an opaque URL-safe token"""
+    raw = json_util.dumps([value, doc_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> Tuple[Any, Any]:
+    """Decode a token from encode_cursor, raising ValueError if it is malformed"""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        value, doc_id = json_util.loads(base64.urlsafe_b64decode(padded).decode())
+    except Exception:
+        raise ValueError("Invalid cursor")
+    return value, doc_id
+
+
+def keyset_filter(sort_field: str, sort_direction: int, value: Any, last_id: Any) -> Dict:
+    """Documents after (value, last_id) in (sort_field, _id) order.
+
+    $gt/$lt never match null (comparisons stay within one type), while null and
+    missing values sort lowest: they come first ascending and last descending,
+    so they are matched explicitly.
+    """
+    op = "$lt" if sort_direction < 0 else "$gt"
+    same_value = {sort_field: value, "_id": {op: last_id}}
+    if value is None:
+        return same_value if sort_direction < 0 else {"$or": [same_value, {sort_field: {"$ne": None}}]}
+    after = [{sort_field: {op: value}}, same_value]
+    if sort_direction < 0:
+        after.append({sort_field: None})
+    return {"$or": after}
+
+
+async def get_page(collection_name: str, filter_dict: Optional[Dict] = None,
+                   limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None,
+                   projection: Optional[List[str]] = None, sort_field: str = "created_at",
+                   sort_direction: int = -1) -> Tuple[List[Dict], Optional[str]]:
+    """Get one page of documents using keyset pagination over (sort_field, _id).
+
+    Returns the documents and the cursor for the next page (None on the last page).
+    Unlike skip/limit, the cost of a page does not grow with its position.
+    """
+    collection = db[collection_name]
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    query = dict(filter_dict or {})
+
+    if cursor:
+        value, last_id = decode_cursor(cursor)
+        keyset = keyset_filter(sort_field, sort_direction, value, last_id)
+        query = {"$and": [query, keyset]} if query else keyset
+
+    fields = None
+    if projection:
+        fields = {field: 1 for field in projection if field != "id"}
+        fields[sort_field] = 1
+
+    # Fetch one extra document to know whether another page exists
+    docs = await collection.find(query, fields).sort(
+        [(sort_field, sort_direction), ("_id", sort_direction)]
+    ).limit(limit + 1).to_list(length=limit + 1)
+
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        last = docs[-1]
+        next_cursor = encode_cursor(last.get(sort_field), last["_id"])
+
+    return [convert_objectid_to_str(doc) for doc in docs], next_cursor
+
+
+async def stream_documents(collection_name: str, filter_dict: Optional[Dict] = None,
+                           projection: Optional[List[str]] = None,
+                           batch_size: int = 1000) -> AsyncIterator[Dict]:
+    """Yield documents one by one from a server-side cursor, in _id order.
+
+    Only one batch is held in memory at a time, so this is safe for full-collection exports.
+    """
+    collection = db[collection_name]
+    fields = {field: 1 for field in projection if field != "id"} if projection else None
+    cursor = collection.find(filter_dict or {}, fields).sort("_id", 1).batch_size(batch_size)
+    async for doc in cursor:
+        yield convert_objectid_to_str(doc)
+
+
 async def update_document(collection_name: str, doc_id: str, data: Dict) -> Optional[Dict]:
-    """Update a document"""
+    """Update a document and return it as updated, in one round-trip"""
     collection = db[collection_name]
-    data['updated_at'] = datetime.utcnow()
+    data['updated_at'] = utcnow()
     
     # Remove _id from data if exists
     data.pop('_id', None)
     data.pop('id', None)
     
+    # Taken before the write: a concurrent update that lands between our write and our
+    # put bumps the generation again, so our older document is never cached over it
+    generation = document_cache.generation(collection_name)
+    doc = await collection.find_one_and_update(
+        id_filter(doc_id),
+        {'$set': data},
+        return_document=ReturnDocument.AFTER
+    )
+    document_cache.invalidate(collection_name, doc_id)
+    if not doc:
+        return None
+    await bump_change_version(collection_name)
+    doc = convert_objectid_to_str(doc)
+    # generation + 1 allows for our own invalidation and no other
+    document_cache.put(collection_name, doc_id, doc, generation + 1)
+    return doc
+
+
+def id_filter(doc_id: str) -> Dict:
+    """Filter matching a document ID the same way get_document resolves it"""
     try:
-        result = await collection.update_one(
-            {'_id': ObjectId(doc_id)},
-            {'$set': data}
-        )
-        if result.modified_count > 0:
-            return await get_document(collection_name, doc_id)
-    except:
-        # Try as string if ObjectId fails
-        result = await collection.update_one(
-            {'id': doc_id},
-            {'$set': data}
-        )
-        if result.modified_count > 0:
-            return await get_document(collection_name, doc_id)
-    return None
+        return {'_id': ObjectId(doc_id)}
+    except Exception:
+        return {'id': doc_id}
+
+
+async def increment_document(collection_name: str, doc_id: str, increments: Dict,
+                             data: Optional[Dict] = None) -> bool:
+    """Atomically $inc numeric fields (and optionally $set others) without reading first"""
+    update = {'$inc': increments, '$set': {**(data or {}), 'updated_at': datetime.utcnow()}}
+    result = await db[collection_name].update_one(id_filter(doc_id), update)
+    document_cache.invalidate(collection_name, doc_id)
+    if result.matched_count:
+        await bump_change_version(collection_name)
+    return result.matched_count > 0
 
 
 async def delete_document(collection_name: str, doc_id: str) -> bool:
-    """Delete a document"""
+    """Delete a document, leaving a tombstone for delta sync"""
     collection = db[collection_name]
+    deleted = await collection.find_one_and_delete(id_filter(doc_id), projection={'_id': 1})
+    document_cache.invalidate(collection_name, doc_id)
+    if not deleted:
+        return False
+    await record_tombstone(collection_name, str(deleted['_id']))
+    await bump_change_version(collection_name)
+    return True
+
+
+async def record_tombstone(collection_name: str, doc_id: str) -> None:
+    """Remember a deletion so sync clients can drop the document; kept for TOMBSTONE_RETENTION_DAYS"""
     try:
-        result = await collection.delete_one({'_id': ObjectId(doc_id)})
-        return result.deleted_count > 0
-    except:
-        # Try as string if ObjectId fails
-        result = await collection.delete_one({'id': doc_id})
-        return result.deleted_count > 0
+        await db[TOMBSTONES_COLLECTION].insert_one(
+            {'collection': collection_name, 'doc_id': doc_id, 'deleted_at': datetime.utcnow()}
+        )
+    except Exception as e:
+        logging.error(f"Error recording tombstone for {collection_name} {doc_id}: {str(e)}")
 
 
 async def count_documents(collection_name: str, filter_dict: Optional[Dict] = None) -> int:
@@ -123,3 +338,45 @@ async def find_one_document(collection_name: str, filter_dict: Dict) -> Optional
     return None
 
 
+async def bump_change_version(*collection_names: str) -> None:
+    """Record that collections changed, for conditional GETs.
+
+    Call after every write that bypasses the helpers above. Failures are logged
+    rather than raised, since the write itself has already happened.
+    """
+    ops = [
+        UpdateOne({'_id': name}, {'$inc': {'version': 1}, '$currentDate': {'updated_at': True}}, upsert=True)
+        for name in sorted(set(collection_names))
+    ]
+    if not ops:
+        return
+    try:
+        await db[CHANGE_VERSIONS_COLLECTION].bulk_write(ops, ordered=False)
+    except Exception as e:
+        logging.error(f"Error bumping change version of {', '.join(collection_names)}: {str(e)}")
+
+
+async def acquire_lease(lock_id: str, ttl_seconds: int) -> bool:
+    """Take or renew a lease; False while another live worker holds it"""
+    now = datetime.utcnow()
+    try:
+        await db[LOCKS_COLLECTION].find_one_and_update(
+            {"_id": lock_id, "$or": [{"owner": _owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": _owner, "expires_at": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # The upsert collided with a lease held by someone else
+        return False
+
+
+async def release_lease(lock_id: str) -> None:
+    """Give up a lease this process holds so another worker can take it at once"""
+    await db[LOCKS_COLLECTION].delete_one({"_id": lock_id, "owner": _owner})
+
+
+async def get_change_versions(collection_names: Iterable[str]) -> Dict[str, Dict]:
+    """Collection -> {"version", "updated_at"}; collections never bumped are absent"""
+    cursor = db[CHANGE_VERSIONS_COLLECTION].find({'_id': {'$in': list(collection_names)}})
+    return {doc['_id']: doc async for doc in cursor}
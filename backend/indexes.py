@@ -0,0 +1,313 @@
+"""
+Declarative index registry, reconciled against the database at startup
+
+INDEX_SPECS lists the indexes each collection should have, derived from the
+filters and sorts the endpoints actually run. reconcile_indexes creates the
+missing ones and reports extra or unused indexes from $indexStats. The only
+index it ever drops is one on declared keys that lacks the spec's unique or
+partial option, which it rebuilds as declared. index_report compares the
+same specs with the live indexes without changing anything.
+"""
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import json_util
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+from database import TOMBSTONE_RETENTION_DAYS, TOMBSTONES_COLLECTION, db
+from pdf_export import PDF_JOB_RETENTION_HOURS, PDF_JOBS_COLLECTION
+
+IndexKeys = List[Tuple[str, int]]
+
+# Keyset pagination sorts on (created_at, _id), see database.get_page
+CREATED_AT: IndexKeys = [("created_at", DESCENDING), ("_id", DESCENDING)]
+
+# Cache invalidation polling and delta sync read changes by updated_at, see invalidation.py and sync.py
+UPDATED_AT: IndexKeys = [("updated_at", ASCENDING)]
+
+# Collection -> index specs. "unique" is only set where the endpoints already
+# enforce uniqueness; document numbers stay non-unique because legacy data
+# numbered with the old regex scheme may contain duplicates. Vendor email is
+# optional, so it is only unique among vendors that have one.
+INDEX_SPECS: Dict[str, List[Dict[str, Any]]] = {
+    "customers": [
+        {"keys": [("email", ASCENDING)], "unique": True},
+        {"keys": CREATED_AT},
+        {"keys": [("type", ASCENDING), ("created_at", DESCENDING)]},
+        {"keys": [("search_keys", ASCENDING)]},
+        {"keys": UPDATED_AT},
+    ],
+    "vendors": [
+        {"keys": [("email", ASCENDING)], "unique": True, "partial": {"email": {"$type": "string", "$gt": ""}}},
+        {"keys": CREATED_AT},
+        {"keys": [("search_keys", ASCENDING)]},
+        {"keys": UPDATED_AT},
+    ],
+    "products": [
+        {"keys": [("sku", ASCENDING)], "unique": True},
+        {"keys": CREATED_AT},
+        {"keys": [("category", ASCENDING)]},
+        {"keys": [("search_keys", ASCENDING)]},
+        {"keys": UPDATED_AT},
+    ],
+    "sales_invoices": [
+        {"keys": CREATED_AT},
+        {"keys": UPDATED_AT},
+        {"keys": [("invoice_number", ASCENDING)]},
+        {"keys": [("customer_id", ASCENDING)]},
+        {"keys": [("status", ASCENDING), ("created_at", DESCENDING)]},
+        {"keys": [("status", ASCENDING), ("invoice_date", ASCENDING)]},
+        {"keys": [("status", ASCENDING), ("due_date", ASCENDING)]},
+        {"keys": [("items.product_id", ASCENDING)]},
+    ],
+    "sales_orders": [
+        {"keys": CREATED_AT},
+        {"keys": UPDATED_AT},
+        {"keys": [("order_number", ASCENDING)]},
+        {"keys": [("customer_id", ASCENDING)]},
+        {"keys": [("quotation_id", ASCENDING)]},
+        {"keys": [("items.product_id", ASCENDING)]},
+    ],
+    "quotations": [
+        {"keys": CREATED_AT},
+        {"keys": UPDATED_AT},
+        {"keys": [("quotation_number", ASCENDING)]},
+        {"keys": [("customer_id", ASCENDING)]},
+    ],
+    "purchase_invoices": [
+        {"keys": CREATED_AT},
+        {"keys": UPDATED_AT},
+        {"keys": [("invoice_number", ASCENDING)]},
+        {"keys": [("vendor_id", ASCENDING)]},
+        {"keys": [("status", ASCENDING), ("created_at", DESCENDING)]},
+        {"keys": [("status", ASCENDING), ("due_date", ASCENDING)]},
+    ],
+    "purchase_orders": [
+        {"keys": CREATED_AT},
+        {"keys": UPDATED_AT},
+        {"keys": [("order_number", ASCENDING)]},
+        {"keys": [("vendor_id", ASCENDING)]},
+    ],
+    "stock_opnames": [
+        {"keys": CREATED_AT},
+        {"keys": UPDATED_AT},
+        {"keys": [("opname_number", ASCENDING)]},
+    ],
+    "stock_transfers": [
+        {"keys": CREATED_AT},
+        {"keys": UPDATED_AT},
+        {"keys": [("transfer_number", ASCENDING)]},
+    ],
+    "production_orders": [
+        {"keys": CREATED_AT},
+        {"keys": UPDATED_AT},
+        {"keys": [("order_number", ASCENDING)]},
+        {"keys": [("order_date", ASCENDING)]},
+    ],
+    "chart_of_accounts": [
+        {"keys": [("account_code", ASCENDING)], "unique": True},
+        {"keys": UPDATED_AT},
+    ],
+    "general_journal": [
+        {"keys": CREATED_AT},
+        {"keys": UPDATED_AT},
+        {"keys": [("entry_number", ASCENDING)]},
+        {"keys": [("debit_account", ASCENDING)]},
+        {"keys": [("credit_account", ASCENDING)]},
+        {"keys": [("reference", ASCENDING)]},
+    ],
+    "users": [
+        {"keys": [("email", ASCENDING)], "unique": True},
+        {"keys": [("username", ASCENDING)], "unique": True},
+        {"keys": CREATED_AT},
+    ],
+    "stock_movements": [
+        {"keys": [("product_id", ASCENDING), ("created_at", DESCENDING)]},
+        {"keys": [("reference_id", ASCENDING)]},
+    ],
+    "settings_backups": [
+        {"keys": [("createdAt", DESCENDING)]},
+    ],
+    TOMBSTONES_COLLECTION: [
+        {"keys": [("collection", ASCENDING), ("deleted_at", ASCENDING)]},
+        {"keys": [("deleted_at", ASCENDING)], "expire_after_seconds": TOMBSTONE_RETENTION_DAYS * 86400},
+    ],
+    PDF_JOBS_COLLECTION: [
+        {"keys": [("created_at", ASCENDING)], "expire_after_seconds": PDF_JOB_RETENTION_HOURS * 3600},
+    ],
+}
+
+# Operations slower than this are recorded by the database profiler (0 disables profiling)
+SLOW_QUERY_MS = int(os.environ.get("SLOW_QUERY_MS", "100"))
+
+
+def index_name(keys: IndexKeys) -> str:
+    """Default MongoDB index name for a key pattern, e.g. created_at_-1__id_-1"""
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+async def index_usage(collection_name: str) -> Dict[str, Dict[str, Any]]:
+    """Per-index access counts from $indexStats, keyed by index name"""
+    usage = {}
+    try:
+        async for stat in db[collection_name].aggregate([{"$indexStats": {}}]):
+            usage[stat["name"]] = {
+                "ops": stat.get("accesses", {}).get("ops", 0),
+                "since": stat.get("accesses", {}).get("since")
+            }
+    except OperationFailure as e:
+        logging.warning(f"$indexStats unavailable for {collection_name}: {str(e)}")
+    return usage
+
+
+def _options_match(info: Dict[str, Any], spec: Dict[str, Any]) -> bool:
+    """Whether an existing index has the options its spec declares; undeclared options are left alone"""
+    if "partial" in spec and info.get("partialFilterExpression") != spec["partial"]:
+        return False
+    return not spec.get("unique") or bool(info.get("unique"))
+
+
+async def reconcile_collection(collection_name: str, specs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Create the declared indexes a collection is missing and describe the rest"""
+    collection = db[collection_name]
+    existing = await collection.index_information()
+    existing_by_keys = {tuple(tuple(k) for k in info["key"]): name for name, info in existing.items()}
+
+    created, present, failed = [], [], []
+    declared = set()
+    for spec in specs:
+        keys = [tuple(k) for k in spec["keys"]]
+        name = existing_by_keys.get(tuple(keys))
+        if name and _options_match(existing[name], spec):
+            present.append(name)
+            declared.add(name)
+            continue
+        try:
+            if name:
+                # e.g. a unique index that has since become partial; it cannot be altered in place
+                await collection.drop_index(name)
+                logging.info(f"Dropped {collection_name}.{name} to rebuild it with its declared options")
+            name = index_name(spec["keys"])
+            options = {"expireAfterSeconds": spec["expire_after_seconds"]} if "expire_after_seconds" in spec else {}
+            if "partial" in spec:
+                options["partialFilterExpression"] = spec["partial"]
+            await collection.create_index(spec["keys"], name=name, unique=spec.get("unique", False), **options)
+            created.append(name)
+            declared.add(name)
+        except OperationFailure as e:
+            # Typically duplicate values under a unique spec; the app keeps running without it
+            logging.error(f"Could not create index {collection_name}.{name}: {str(e)}")
+            failed.append({"name": name, "error": str(e)})
+
+    usage = await index_usage(collection_name)
+    extra = [name for name in existing if name != "_id_" and name not in declared]
+    return {
+        "created": created,
+        "present": present,
+        "failed": failed,
+        "extra": [{"name": name, **usage.get(name, {})} for name in extra],
+        "unused": [name for name in present if usage.get(name, {}).get("ops") == 0],
+        "usage": usage
+    }
+
+
+async def describe_collection(collection_name: str, specs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Compare a collection's indexes with its specs, read-only"""
+    existing = await db[collection_name].index_information()
+    existing_by_keys = {tuple(tuple(k) for k in info["key"]): name for name, info in existing.items()}
+
+    present, missing, mismatched = [], [], []
+    for spec in specs:
+        name = existing_by_keys.get(tuple(tuple(k) for k in spec["keys"]))
+        if not name:
+            missing.append(index_name(spec["keys"]))
+        elif _options_match(existing[name], spec):
+            present.append(name)
+        else:
+            mismatched.append(name)
+
+    usage = await index_usage(collection_name)
+    declared = set(present) | set(mismatched)
+    extra = [name for name in existing if name != "_id_" and name not in declared]
+    return {
+        "present": present,
+        "missing": missing,
+        "mismatched": mismatched,
+        "extra": [{"name": name, **usage.get(name, {})} for name in extra],
+        "unused": [name for name in present if usage.get(name, {}).get("ops") == 0],
+        "usage": usage
+    }
+
+
+async def index_report(collection_name: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+    """describe_collection for every collection in INDEX_SPECS, or just one"""
+    names = [collection_name] if collection_name else list(INDEX_SPECS)
+    report = {}
+    for name in names:
+        try:
+            report[name] = await describe_collection(name, INDEX_SPECS[name])
+        except Exception as e:
+            logging.error(f"Error describing indexes for {name}: {str(e)}")
+            report[name] = {"error": str(e)}
+    return report
+
+
+async def reconcile_indexes() -> Dict[str, Dict[str, Any]]:
+    """Reconcile every collection in INDEX_SPECS and log a summary"""
+    report = {}
+    for collection_name, specs in INDEX_SPECS.items():
+        try:
+            report[collection_name] = await reconcile_collection(collection_name, specs)
+        except Exception as e:
+            logging.error(f"Error reconciling indexes for {collection_name}: {str(e)}")
+            report[collection_name] = {"error": str(e)}
+
+    created = sum(len(r.get("created", [])) for r in report.values())
+    extra = sum(len(r.get("extra", [])) for r in report.values())
+    failed = sum(len(r.get("failed", [])) for r in report.values())
+    logging.info(f"Index reconciliation: {created} created, {extra} extra, {failed} failed")
+    return report
+
+
+async def enable_slow_query_profiling() -> bool:
+    """Ask the database profiler to record operations slower than SLOW_QUERY_MS"""
+    if SLOW_QUERY_MS <= 0:
+        return False
+    try:
+        await db.command("profile", 1, slowms=SLOW_QUERY_MS)
+        return True
+    except OperationFailure as e:
+        # Managed clusters may not allow changing the profiling level
+        logging.warning(f"Slow query profiling unavailable: {str(e)}")
+        return False
+
+
+async def unindexed_slow_queries(limit: int = 50, collection_name: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Recent profiled operations that scanned a whole collection"""
+    query: Dict[str, Any] = {"planSummary": {"$regex": "^COLLSCAN"}}
+    if collection_name:
+        query["ns"] = f"{db.name}.{collection_name}"
+    cursor = db["system.profile"].find(query, {
+        "ns": 1, "op": 1, "millis": 1, "ts": 1, "planSummary": 1,
+        "docsExamined": 1, "nreturned": 1, "command.filter": 1, "command.sort": 1
+    }).sort("ts", -1).limit(limit)
+
+    queries = []
+    async for entry in cursor:
+        command = entry.get("command", {})
+        queries.append({
+            "collection": entry.get("ns", "").split(".", 1)[-1],
+            "op": entry.get("op"),
+            "millis": entry.get("millis"),
+            "ts": entry.get("ts"),
+            "plan": entry.get("planSummary"),
+            "docs_examined": entry.get("docsExamined"),
+            "returned": entry.get("nreturned"),
+            # Relaxed extended JSON so ObjectIds and dates survive the response encoder
+            "filter": json.loads(json_util.dumps(command.get("filter"))),
+            "sort": json.loads(json_util.dumps(command.get("sort")))
+        })
+    return queries
@@ -0,0 +1,191 @@
+"""
+Cross-worker invalidation of process-local caches
+
+Every worker keeps its own caches (the document cache, the ledger's account
+maps), and its own writes invalidate them directly. Writes made by other
+workers or hosts arrive through this listener: on a replica set or sharded
+cluster it follows a change stream on the cached collections; on a
+standalone server, where change streams are unavailable, it polls those
+collections for recently updated documents. Deletes made elsewhere are only
+seen in watch mode; in poll mode they age out with the cache TTL.
+
+Modules with their own caches subscribe with on_change().
+"""
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set
+
+from cache import CACHE_TTLS, document_cache
+from database import client, db
+from ledger import ACCOUNTS_COLLECTION, forget_accounts
+
+# "auto" watches on replica sets and polls on standalone servers; "watch", "poll" or "off" force a mode
+CACHE_INVALIDATION = os.environ.get("CACHE_INVALIDATION", "auto").lower()
+
+# Seconds between polls in poll mode
+CACHE_POLL_INTERVAL = float(os.environ.get("CACHE_POLL_INTERVAL", "2"))
+
+# Each poll re-reads this many seconds before the previous one, covering clock skew between hosts
+POLL_OVERLAP = 5
+
+# Seconds to wait before reopening a failed change stream
+RETRY_DELAY = 5
+
+# Account fields shown or resolved through the ledger's account maps
+ACCOUNT_MAP_FIELDS = {"account_name", "account_code", "normal_balance"}
+
+# Called with (collection name, document id, changed fields). The id is None when
+# anything in the collection may have changed; fields is None when unknown.
+ChangeListener = Callable[[str, Optional[str], Optional[Set[str]]], None]
+
+_listeners: Dict[str, List[ChangeListener]] = defaultdict(list)
+_task: Optional[asyncio.Task] = None
+_mode: Optional[str] = None
+
+
+def on_change(collection_name: str, listener: ChangeListener) -> None:
+    """Call listener for every write to collection_name, from any worker"""
+    _listeners[collection_name].append(listener)
+
+
+def _dispatch(collection_name: str, doc_id: Optional[str], fields: Optional[Set[str]]) -> None:
+    for listener in _listeners.get(collection_name, ()):
+        try:
+            listener(collection_name, doc_id, fields)
+        except Exception as e:
+            logging.error(f"Error invalidating cache for {collection_name}: {str(e)}")
+
+
+def _invalidate_document(collection_name: str, doc_id: Optional[str], fields: Optional[Set[str]]) -> None:
+    if doc_id is None:
+        document_cache.clear(collection_name)
+    else:
+        document_cache.invalidate(collection_name, doc_id)
+
+
+def _invalidate_accounts(collection_name: str, doc_id: Optional[str], fields: Optional[Set[str]]) -> None:
+    # Every posting updates balances; only changes to names and codes affect the account maps
+    if fields is None or fields & ACCOUNT_MAP_FIELDS:
+        forget_accounts()
+
+
+for _name in CACHE_TTLS:
+    on_change(_name, _invalidate_document)
+on_change(ACCOUNTS_COLLECTION, _invalidate_accounts)
+
+
+def _invalidate_everything() -> None:
+    for name in list(_listeners):
+        _dispatch(name, None, None)
+
+
+def _apply_change(change: Dict) -> None:
+    """Dispatch one change stream event"""
+    operation = change.get("operationType")
+    collection_name = change.get("ns", {}).get("coll")
+    if operation in ("insert", "update", "replace", "delete"):
+        fields = None
+        if operation == "update":
+            description = change.get("updateDescription", {})
+            fields = set(description.get("updatedFields", {})) | set(description.get("removedFields", []))
+            # Nested paths like "address.city" count as their top-level field
+            fields = {field.split(".", 1)[0] for field in fields}
+        _dispatch(collection_name, str(change["documentKey"]["_id"]), fields)
+    elif collection_name in _listeners:
+        # drop or rename
+        _dispatch(collection_name, None, None)
+    elif operation in ("dropDatabase", "invalidate"):
+        _invalidate_everything()
+
+
+async def _watch(collections: List[str]) -> None:
+    pipeline = [{"$match": {"$or": [
+        {"ns.coll": {"$in": collections}},
+        {"operationType": {"$in": ["dropDatabase", "invalidate"]}}
+    ]}}]
+    reopened = False
+    while True:
+        try:
+            async with db.watch(pipeline) as stream:
+                if reopened:
+                    # Writes made while the stream was down were missed; start clean
+                    _invalidate_everything()
+                async for change in stream:
+                    _apply_change(change)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Cache invalidation change stream failed: {str(e)}")
+        reopened = True
+        await asyncio.sleep(RETRY_DELAY)
+
+
+async def _poll(collections: List[str], interval: float) -> None:
+    since = datetime.utcnow()
+    while True:
+        await asyncio.sleep(interval)
+        started = datetime.utcnow()
+        try:
+            window = {"updated_at": {"$gte": since - timedelta(seconds=POLL_OVERLAP)}}
+            for name in collections:
+                async for doc in db[name].find(window, {"_id": 1}):
+                    _dispatch(name, str(doc["_id"]), None)
+            since = started
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Error polling for cache invalidation: {str(e)}")
+
+
+async def detect_mode() -> str:
+    """Change streams need a replica set member or mongos"""
+    if CACHE_INVALIDATION in ("watch", "poll", "off"):
+        return CACHE_INVALIDATION
+    hello = await client.admin.command("hello")
+    return "watch" if "setName" in hello or hello.get("msg") == "isdbgrid" else "poll"
+
+
+async def _run() -> None:
+    global _mode
+    collections = sorted(_listeners)
+    while _mode is None:
+        try:
+            _mode = await detect_mode()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Error detecting cache invalidation mode: {str(e)}")
+            await asyncio.sleep(RETRY_DELAY)
+    logging.info(f"Cache invalidation mode: {_mode} for {', '.join(collections)}")
+    if _mode == "watch":
+        await _watch(collections)
+    elif _mode == "poll":
+        await _poll(collections, CACHE_POLL_INTERVAL)
+
+
+def invalidation_status() -> Dict:
+    return {"mode": _mode, "collections": sorted(_listeners), "running": _task is not None and not _task.done()}
+
+
+def start_cache_invalidation() -> None:
+    """Start the invalidation listener on the running event loop"""
+    global _task
+    if CACHE_INVALIDATION == "off" or _task is not None:
+        return
+    _task = asyncio.create_task(_run())
+
+
+async def stop_cache_invalidation() -> None:
+    """Cancel the invalidation listener"""
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
@@ -0,0 +1,257 @@
+"""
+Ledger posting engine
+
+post_journal inserts journal entries and applies the account balance changes
+with $inc, together with an optional guarded update of the source document
+(e.g. an invoice status change). On a replica set or sharded cluster all of
+it runs in one multi-document transaction; on a standalone server it falls
+back to a guarded update followed by insert_many and an unordered bulk_write,
+which still never loses a concurrent balance update. If that bulk_write
+reports failed lines, the lines that did apply, the inserted entries and the
+guarded change are undone, so the journal and the balances stay in step.
+"""
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from cache import document_cache
+from database import bump_change_version, client, db, id_filter
+from numbering import next_number
+
+ACCOUNTS_COLLECTION = "chart_of_accounts"
+JOURNAL_COLLECTION = "general_journal"
+
+# Accounts the posting rules rely on, created on first use
+SYSTEM_ACCOUNTS: Dict[str, Dict[str, str]] = {
+    "1110": {"account_name": "Cash", "account_type": "Asset", "normal_balance": "Debit"},
+    "1200": {"account_name": "Accounts Receivable", "account_type": "Asset", "normal_balance": "Debit"},
+    "2100": {"account_name": "Accounts Payable", "account_type": "Liability", "normal_balance": "Credit"},
+    "4000": {"account_name": "Sales Revenue", "account_type": "Revenue", "normal_balance": "Credit"},
+    "5100": {"account_name": "Purchase Expense", "account_type": "Expense", "normal_balance": "Debit"},
+}
+
+# "auto" detects replica sets, "off" always uses the bulk_write fallback
+LEDGER_TRANSACTIONS = os.environ.get("LEDGER_TRANSACTIONS", "auto").lower()
+
+# Account names are reloaded after this many seconds, bounding staleness across workers
+ACCOUNT_NAMES_TTL = int(os.environ.get("ACCOUNT_NAMES_TTL", "60"))
+
+# Minimum seconds between reloads triggered by an unknown account id
+ACCOUNT_NAMES_MISS_RELOAD = 5
+
+# Account code -> {"id", "normal_balance"}; cleared when the chart of accounts changes
+_accounts: Dict[str, Dict[str, str]] = {}
+# Account id -> account name, for display
+_account_names: Dict[str, str] = {}
+_account_names_loaded_at: Optional[float] = None
+_transactions_supported: Optional[bool] = None
+
+
+class LedgerConflict(Exception):
+    """The guarded document no longer matched when the posting was applied"""
+
+
+class Posting(NamedTuple):
+    debit_code: str
+    credit_code: str
+    amount: float
+    description: str
+    reference: str
+    entry_date: str
+    created_by: str = "System"
+
+
+class GuardedUpdate(NamedTuple):
+    """$set `changes` on a document only while it still matches `expected`"""
+    collection_name: str
+    doc_id: str
+    expected: Dict
+    changes: Dict
+
+
+def forget_accounts() -> None:
+    """Drop the cached account maps after chart of accounts changes"""
+    global _account_names_loaded_at
+    _accounts.clear()
+    _account_names.clear()
+    _account_names_loaded_at = None
+
+
+async def account_names(required_ids: Iterable[str] = ()) -> Dict[str, str]:
+    """Account id -> name for the whole chart of accounts, from a process-local cache.
+
+    Reloads when the cache expires, or when one of required_ids is unknown
+    (e.g. created by another worker) and the last reload is a few seconds old.
+    """
+    global _account_names_loaded_at
+    now = time.monotonic()
+    age = now - _account_names_loaded_at if _account_names_loaded_at is not None else None
+    missing = any(account_id and account_id not in _account_names for account_id in required_ids)
+    if age is None or age > ACCOUNT_NAMES_TTL or (missing and age > ACCOUNT_NAMES_MISS_RELOAD):
+        names = {}
+        async for doc in db[ACCOUNTS_COLLECTION].find({}, {"account_name": 1, "id": 1}):
+            name = doc.get("account_name", "")
+            names[str(doc["_id"])] = name
+            if doc.get("id"):
+                # Legacy documents addressed by a string id field
+                names[doc["id"]] = name
+        _account_names.clear()
+        _account_names.update(names)
+        _account_names_loaded_at = now
+    return _account_names
+
+
+async def resolve_account(code: str) -> Dict[str, str]:
+    """Account id and normal balance for a code, creating system accounts if missing"""
+    cached = _accounts.get(code)
+    if cached:
+        return cached
+
+    accounts = db[ACCOUNTS_COLLECTION]
+    defaults = SYSTEM_ACCOUNTS.get(code)
+    doc = None
+    if defaults:
+        now = datetime.utcnow()
+        try:
+            doc = await accounts.find_one_and_update(
+                {"account_code": code},
+                {"$setOnInsert": {**defaults, "account_code": code, "balance": 0.0, "status": "Active",
+                                  "created_at": now, "updated_at": now}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # A concurrent upsert created it first (account_code is uniquely indexed)
+            pass
+    if doc is None:
+        doc = await accounts.find_one({"account_code": code})
+    if doc is None:
+        raise ValueError(f"Account {code} not found")
+
+    account = {"id": str(doc["_id"]), "normal_balance": doc.get("normal_balance", "Debit")}
+    _accounts[code] = account
+    return account
+
+
+async def transactions_supported() -> bool:
+    """Multi-document transactions need a replica set member or mongos"""
+    global _transactions_supported
+    if LEDGER_TRANSACTIONS == "off":
+        return False
+    if _transactions_supported is None:
+        hello = await client.admin.command("hello")
+        _transactions_supported = "setName" in hello or hello.get("msg") == "isdbgrid"
+    return _transactions_supported
+
+
+def balance_delta(account: Dict[str, str], side: str, amount: float) -> float:
+    """Balances grow on the account's normal side and shrink on the other"""
+    return amount if account["normal_balance"] == side else -amount
+
+
+async def apply_guard(guard: Optional[GuardedUpdate], session=None) -> None:
+    """Apply a guarded update, raising LedgerConflict if the document no longer matches"""
+    if not guard:
+        return
+    result = await db[guard.collection_name].update_one(
+        {**id_filter(guard.doc_id), **guard.expected},
+        {"$set": {**guard.changes, "updated_at": datetime.utcnow()}},
+        session=session
+    )
+    if result.matched_count == 0:
+        raise LedgerConflict(f"{guard.collection_name} {guard.doc_id} was modified concurrently")
+
+
+def _balance_ops(deltas: Dict[str, float], now: datetime) -> List[UpdateOne]:
+    return [
+        UpdateOne(id_filter(account_id), {"$inc": {"balance": delta}, "$set": {"updated_at": now}})
+        for account_id, delta in deltas.items()
+    ]
+
+
+async def _apply(entries: List[Dict], deltas: Dict[str, float], now: datetime,
+                 guard: Optional[GuardedUpdate], session=None) -> None:
+    await apply_guard(guard, session=session)
+    if entries:
+        # Copies, so a retried transaction does not reuse _ids assigned by an aborted attempt
+        await db[JOURNAL_COLLECTION].insert_many([dict(entry) for entry in entries], session=session)
+    if deltas:
+        await db[ACCOUNTS_COLLECTION].bulk_write(_balance_ops(deltas, now), ordered=False, session=session)
+
+
+async def _apply_with_compensation(entries: List[Dict], deltas: Dict[str, float], now: datetime,
+                                   guard: Optional[GuardedUpdate]) -> None:
+    """The fallback path: undo whatever applied if some balance lines fail"""
+    await apply_guard(guard)
+    entry_ids = []
+    if entries:
+        result = await db[JOURNAL_COLLECTION].insert_many([dict(entry) for entry in entries])
+        entry_ids = result.inserted_ids
+    if not deltas:
+        return
+    try:
+        await db[ACCOUNTS_COLLECTION].bulk_write(_balance_ops(deltas, now), ordered=False)
+    except BulkWriteError as e:
+        # An unordered bulk_write applies every line that did not fail; take those back out
+        failed = {error["index"] for error in e.details.get("writeErrors", [])}
+        undo = [UpdateOne(id_filter(account_id), {"$inc": {"balance": -delta}})
+                for index, (account_id, delta) in enumerate(deltas.items()) if index not in failed]
+        if undo:
+            await db[ACCOUNTS_COLLECTION].bulk_write(undo, ordered=False)
+        if entry_ids:
+            await db[JOURNAL_COLLECTION].delete_many({"_id": {"$in": entry_ids}})
+        if guard:
+            await db[guard.collection_name].update_one(
+                {**id_filter(guard.doc_id), **guard.changes}, {"$set": guard.expected}
+            )
+        raise
+
+
+async def post_journal(postings: List[Posting], guard: Optional[GuardedUpdate] = None) -> List[Dict]:
+    """Post journal entries and their balance changes, optionally with a guarded document update.
+
+    Raises LedgerConflict if the guard does not match; nothing is posted in that case.
+    Returns the journal entries that were inserted.
+    """
+    now = datetime.utcnow()
+    entries = []
+    deltas: Dict[str, float] = defaultdict(float)
+    for posting in postings:
+        debit = await resolve_account(posting.debit_code)
+        credit = await resolve_account(posting.credit_code)
+        entries.append({
+            "entry_number": await next_number("JE"),
+            "entry_date": posting.entry_date,
+            "description": posting.description,
+            "debit_account": debit["id"],
+            "credit_account": credit["id"],
+            "debit_amount": posting.amount,
+            "credit_amount": posting.amount,
+            "reference": posting.reference,
+            "status": "Posted",
+            "created_by": posting.created_by,
+            "created_at": now,
+            "updated_at": now
+        })
+        deltas[debit["id"]] += balance_delta(debit, "Debit", posting.amount)
+        deltas[credit["id"]] += balance_delta(credit, "Credit", posting.amount)
+
+    deltas = {account_id: delta for account_id, delta in deltas.items() if delta}
+
+    if await transactions_supported():
+        async with await client.start_session() as session:
+            async def callback(s):
+                await _apply(entries, deltas, now, guard, session=s)
+            await session.with_transaction(callback)
+    else:
+        # The guard runs first, so a lost race posts nothing
+        await _apply_with_compensation(entries, deltas, now, guard)
+    for account_id in deltas:
+        document_cache.invalidate(ACCOUNTS_COLLECTION, account_id)
+    await bump_change_version(JOURNAL_COLLECTION, ACCOUNTS_COLLECTION, *([guard.collection_name] if guard else []))
+    return entries
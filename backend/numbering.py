@@ -0,0 +1,110 @@
+"""
+Document numbering backed by an atomic counters collection
+"""
+import asyncio
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import ReturnDocument
+
+from database import db
+
+# Prefix -> (collection, number field) for every numbered document type.
+# Used to seed a counter from legacy data the first time it is touched.
+NUMBER_SEQUENCES: Dict[str, Tuple[str, str]] = {
+    "INV": ("sales_invoices", "invoice_number"),
+    "SO": ("sales_orders", "order_number"),
+    "QUO": ("quotations", "quotation_number"),
+    "PINV": ("purchase_invoices", "invoice_number"),
+    "PO": ("purchase_orders", "order_number"),
+    "OPN": ("stock_opnames", "opname_number"),
+    "STR": ("stock_transfers", "transfer_number"),
+    "PROD": ("production_orders", "order_number"),
+    "JE": ("general_journal", "entry_number"),
+}
+
+# Numbers reserved per round-trip. 1 keeps numbering gap-free; larger values
+# let a worker hand out numbers from memory, at the cost of gaps on restart.
+NUMBER_BLOCK_SIZE = max(1, int(os.environ.get("NUMBER_BLOCK_SIZE", "1")))
+
+COUNTERS_COLLECTION = "counters"
+
+# Per-process state: seeded counter keys, reserved blocks and refill locks
+_seeded: set = set()
+_blocks: Dict[str, List[int]] = {}
+_locks: Dict[str, asyncio.Lock] = {}
+
+
+def format_number(prefix: str, year: int, seq: int) -> str:
+    """Format a document number, e.g. INV-2024-000001"""
+    return f"{prefix}-{year}-{str(seq).zfill(6)}"
+
+
+def _counter_key(prefix: str, year: int) -> str:
+    return f"{prefix}-{year}"
+
+
+async def _seed_counter(prefix: str, year: int) -> None:
+    """Start a counter after the highest number already stored for the prefix"""
+    key = _counter_key(prefix, year)
+    if key in _seeded:
+        return
+
+    sequence = NUMBER_SEQUENCES.get(prefix)
+    last_num = 0
+    if sequence:
+        collection_name, field = sequence
+        last_doc = await db[collection_name].find_one(
+            {field: {"$regex": f"^{prefix}-{year}-"}},
+            sort=[(field, -1)],
+            projection={field: 1}
+        )
+        if last_doc:
+            try:
+                last_num = int(last_doc.get(field, "0").split("-")[-1])
+            except ValueError:
+                last_num = 0
+
+    # $max is idempotent, so concurrent seeders (or workers) cannot move the counter back
+    await db[COUNTERS_COLLECTION].update_one(
+        {"_id": key},
+        {"$max": {"seq": last_num}, "$setOnInsert": {"prefix": prefix, "year": year}},
+        upsert=True
+    )
+    _seeded.add(key)
+
+
+async def _reserve(prefix: str, year: int, count: int) -> int:
+    """Atomically reserve `count` numbers and return the last one reserved"""
+    await _seed_counter(prefix, year)
+    doc = await db[COUNTERS_COLLECTION].find_one_and_update(
+        {"_id": _counter_key(prefix, year)},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return doc["seq"]
+
+
+async def next_number(prefix: str, year: Optional[int] = None) -> str:
+    """Get the next document number for a prefix, e.g. next_number("INV")"""
+    year = year or datetime.utcnow().year
+    if NUMBER_BLOCK_SIZE == 1:
+        return format_number(prefix, year, await _reserve(prefix, year, 1))
+
+    key = _counter_key(prefix, year)
+    while True:
+        # No await between reading and advancing the block, so this is atomic on the event loop
+        block = _blocks.get(key)
+        if block is not None and block[0] <= block[1]:
+            seq = block[0]
+            block[0] += 1
+            return format_number(prefix, year, seq)
+
+        lock = _locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            block = _blocks.get(key)
+            if block is None or block[0] > block[1]:
+                last = await _reserve(prefix, year, NUMBER_BLOCK_SIZE)
+                _blocks[key] = [last - NUMBER_BLOCK_SIZE + 1, last]
@@ -0,0 +1,79 @@
+"""
+Background sweeper that marks past-due invoices as Overdue
+
+One worker at a time holds a lease in the locks collection and flips
+Pending -> Overdue with a single update_many per invoice collection, so the
+invoice GET endpoints never write.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Dict, Optional
+
+from database import acquire_lease, bump_change_version, db, release_lease
+from dashboard import refresh_recent_transactions
+
+# Seconds between sweeps; 0 disables the sweeper in this process
+OVERDUE_SWEEP_INTERVAL = int(os.environ.get("OVERDUE_SWEEP_INTERVAL", "300"))
+
+OVERDUE_COLLECTIONS = ("sales_invoices", "purchase_invoices")
+
+SWEEPER_LOCK_ID = "overdue_sweeper"
+
+_task: Optional[asyncio.Task] = None
+
+
+async def sweep_overdue_invoices(today: Optional[str] = None) -> Dict[str, int]:
+    """Mark every Pending invoice due before today as Overdue; returns counts per collection"""
+    today = today or datetime.utcnow().strftime("%Y-%m-%d")
+    counts = {}
+    for collection_name in OVERDUE_COLLECTIONS:
+        result = await db[collection_name].update_many(
+            # due_date is stored as YYYY-MM-DD, which compares correctly as a string
+            {"status": "Pending", "due_date": {"$lt": today, "$regex": r"^\d{4}-\d{2}-\d{2}"}},
+            {"$set": {"status": "Overdue", "updated_at": datetime.utcnow()}}
+        )
+        counts[collection_name] = result.modified_count
+
+    if any(counts.values()):
+        logging.info(f"Overdue sweep: {counts}")
+        await bump_change_version(*[name for name, count in counts.items() if count])
+        # Totals count Pending and Overdue alike; only the recent list shows statuses
+        await refresh_recent_transactions()
+    return counts
+
+
+async def _run_sweeper(interval: int) -> None:
+    while True:
+        try:
+            # The lease outlives one interval so a slow sweep keeps it
+            if await acquire_lease(SWEEPER_LOCK_ID, interval * 2):
+                await sweep_overdue_invoices()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Error sweeping overdue invoices: {str(e)}")
+        await asyncio.sleep(interval)
+
+
+def start_overdue_sweeper() -> None:
+    """Start the sweeper task on the running event loop"""
+    global _task
+    if OVERDUE_SWEEP_INTERVAL <= 0 or _task is not None:
+        return
+    _task = asyncio.create_task(_run_sweeper(OVERDUE_SWEEP_INTERVAL))
+
+
+async def stop_overdue_sweeper() -> None:
+    """Cancel the sweeper task and release the lease so another worker can take over"""
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
+    await release_lease(SWEEPER_LOCK_ID)
@@ -0,0 +1,293 @@
+"""
+Rendered PDF cache keyed by document version
+
+A PDF depends only on the stored data and the templates, so it is cached
+under a digest of (collection, kind, document id, version, TEMPLATE_VERSION),
+where the version changes with anything the PDF shows: an edited document or
+a new template gets a new key, and a Paid invoice is rendered once. Nothing
+is deleted when a document changes: its old entries are simply never asked
+for again and age out.
+
+Files live under PDF_CACHE_DIR, shared by the workers on a host, and the
+least recently read ones (reads refresh the mtime) are evicted once the
+store passes PDF_CACHE_MAX_MB; each worker rescans the directory when its
+own count says the limit is reached. With PDF_CACHE_GRIDFS=1 every PDF is
+also kept in a GridFS bucket, so other hosts and fresh containers reuse it.
+That tier is pruned at most once per GRIDFS_PRUNE_INTERVAL per worker: files
+unused for PDF_CACHE_GRIDFS_DAYS, rendered with an older template or
+uploaded twice by concurrent misses go, and then the least recently used
+ones until it fits PDF_CACHE_GRIDFS_MAX_MB.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Set
+
+from gridfs.errors import NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pymongo import ASCENDING
+
+from database import db, utcnow
+from pdf_generator import TEMPLATE_VERSION
+from pdf_service import render_pdf
+
+PDF_CACHE_DIR = os.environ.get("PDF_CACHE_DIR", os.path.join(tempfile.gettempdir(), "zone-pdf-cache"))
+PDF_CACHE_MAX_BYTES = int(os.environ.get("PDF_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+# Also keep PDFs in GridFS, shared by every host
+PDF_CACHE_GRIDFS = os.environ.get("PDF_CACHE_GRIDFS", "").lower() in ("1", "true", "yes")
+PDF_CACHE_BUCKET = "pdf_cache"
+PDF_CACHE_GRIDFS_MAX_BYTES = int(os.environ.get("PDF_CACHE_GRIDFS_MAX_MB", "2048")) * 1024 * 1024
+PDF_CACHE_GRIDFS_DAYS = int(os.environ.get("PDF_CACHE_GRIDFS_DAYS", "90"))
+
+# Seconds between GridFS prunes by one worker
+GRIDFS_PRUNE_INTERVAL = 3600
+
+# Eviction trims either tier to this fraction of its limit, so rescans and prunes stay rare
+EVICT_TO = 0.8
+
+
+class PdfDiskCache:
+    """Size-bounded LRU of PDF files; every method does blocking I/O, so callers run it in a thread"""
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Bytes on disk at the last scan plus this worker's writes since; None until the first write
+        self._estimated_bytes: Optional[int] = None
+
+    def _doc_dir(self, collection_name: str, doc_id: str) -> str:
+        # Hashed so any id is a safe directory name
+        return os.path.join(self.root, collection_name, hashlib.sha1(doc_id.encode()).hexdigest())
+
+    def get(self, collection_name: str, doc_id: str, digest: str) -> Optional[bytes]:
+        path = os.path.join(self._doc_dir(collection_name, doc_id), f"{digest}.pdf")
+        try:
+            with open(path, "rb") as f:
+                pdf = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass  # evicted or invalidated meanwhile
+        return pdf
+
+    def put(self, collection_name: str, doc_id: str, digest: str, pdf: bytes) -> None:
+        directory = self._doc_dir(collection_name, doc_id)
+        os.makedirs(directory, exist_ok=True)
+        # Write then rename, so readers in other workers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(pdf)
+            os.replace(tmp_path, os.path.join(directory, f"{digest}.pdf"))
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            if self._estimated_bytes is not None and self._estimated_bytes + len(pdf) <= self.max_bytes:
+                self._estimated_bytes += len(pdf)
+            else:
+                self._trim()
+
+    def _trim(self) -> None:
+        """Rescan the store, which other workers write too, and evict the oldest files if it is over the limit"""
+        entries = []
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith(".pdf"):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+                try:
+                    os.unlink(path)
+                    os.rmdir(os.path.dirname(path))  # only succeeds once the document has no other PDFs
+                except OSError:
+                    pass
+                total -= size
+        self._estimated_bytes = total
+
+    def stats(self) -> Dict[str, Any]:
+        return {"dir": self.root, "max_bytes": self.max_bytes, "estimated_bytes": self._estimated_bytes}
+
+
+disk_cache = PdfDiskCache(PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES)
+
+_stats = {"hits": 0, "gridfs_hits": 0, "misses": 0}
+_bucket: Optional[AsyncIOMotorGridFSBucket] = None
+_last_prune = 0.0
+_prune_tasks: Set[asyncio.Task] = set()
+
+
+def _gridfs() -> AsyncIOMotorGridFSBucket:
+    global _bucket
+    if _bucket is None:
+        _bucket = AsyncIOMotorGridFSBucket(db, bucket_name=PDF_CACHE_BUCKET)
+    return _bucket
+
+
+def pdf_cache_key(collection_name: str, kind: str, doc_id: str, version: Any) -> str:
+    if isinstance(version, datetime):
+        version = version.isoformat()
+    return hashlib.sha256(f"{collection_name}|{kind}|{doc_id}|{version}|{TEMPLATE_VERSION}".encode()).hexdigest()
+
+
+def _gridfs_files():
+    return db[f"{PDF_CACHE_BUCKET}.files"]
+
+
+async def _gridfs_get(digest: str) -> Optional[bytes]:
+    try:
+        stream = await _gridfs().open_download_stream_by_name(digest)
+    except NoFile:
+        return None
+    pdf = await stream.read()
+    await _gridfs_files().update_one({"_id": stream._id}, {"$set": {"metadata.last_used": utcnow()}})
+    return pdf
+
+
+async def _gridfs_delete(file_id: Any) -> int:
+    """Delete one GridFS file with its chunks; returns 0 if another worker got there first"""
+    try:
+        await _gridfs().delete(file_id)
+    except NoFile:
+        return 0
+    return 1
+
+
+async def prune_gridfs() -> Dict[str, int]:
+    """Drop stale, outdated and duplicate files, then the least recently used beyond the size limit"""
+    files = _gridfs_files()
+    deleted = 0
+    cutoff = utcnow() - timedelta(days=PDF_CACHE_GRIDFS_DAYS)
+    stale = {"$or": [{"metadata.last_used": {"$lt": cutoff}},
+                     {"metadata.last_used": {"$exists": False}, "uploadDate": {"$lt": cutoff}},
+                     {"metadata.template_version": {"$ne": TEMPLATE_VERSION}}]}
+    async for grid_file in files.find(stale, {"_id": 1}):
+        deleted += await _gridfs_delete(grid_file["_id"])
+
+    # Concurrent misses may each upload the same digest; keep the newest
+    duplicates = files.aggregate([
+        {"$group": {"_id": "$filename", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ])
+    async for group in duplicates:
+        for file_id in sorted(group["ids"])[:-1]:
+            deleted += await _gridfs_delete(file_id)
+
+    totals = await files.aggregate([{"$group": {"_id": None, "bytes": {"$sum": "$length"}}}]).to_list(length=1)
+    total = totals[0]["bytes"] if totals else 0
+    if total > PDF_CACHE_GRIDFS_MAX_BYTES:
+        async for grid_file in files.find({}, {"length": 1}).sort("metadata.last_used", ASCENDING):
+            if total <= PDF_CACHE_GRIDFS_MAX_BYTES * EVICT_TO:
+                break
+            deleted += await _gridfs_delete(grid_file["_id"])
+            total -= grid_file["length"]
+    return {"deleted": deleted, "bytes": total}
+
+
+async def _prune_in_background() -> None:
+    try:
+        await prune_gridfs()
+    except Exception as e:
+        logging.error(f"Error pruning the GridFS PDF cache: {str(e)}")
+
+
+def _schedule_prune() -> None:
+    global _last_prune
+    if time.monotonic() - _last_prune < GRIDFS_PRUNE_INTERVAL:
+        return
+    _last_prune = time.monotonic()
+    task = asyncio.get_running_loop().create_task(_prune_in_background())
+    _prune_tasks.add(task)
+    task.add_done_callback(_prune_tasks.discard)
+
+
+async def _in_thread(func, *args):
+    """Run blocking disk I/O in the default executor"""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def _lookup(collection_name: str, doc_id: str, digest: str) -> Optional[bytes]:
+    pdf = await _in_thread(disk_cache.get, collection_name, doc_id, digest)
+    if pdf is not None:
+        _stats["hits"] += 1
+        return pdf
+    if PDF_CACHE_GRIDFS:
+        pdf = await _gridfs_get(digest)
+        if pdf is not None:
+            _stats["gridfs_hits"] += 1
+            await _in_thread(disk_cache.put, collection_name, doc_id, digest, pdf)
+            return pdf
+    return None
+
+
+async def _store(collection_name: str, doc_id: str, digest: str, pdf: bytes) -> None:
+    await _in_thread(disk_cache.put, collection_name, doc_id, digest, pdf)
+    if PDF_CACHE_GRIDFS:
+        # Another host may have rendered it meanwhile; a duplicate from an exact tie is pruned later
+        if await _gridfs_files().find_one({"filename": digest}, {"_id": 1}) is None:
+            metadata = {"collection": collection_name, "doc_id": doc_id,
+                        "template_version": TEMPLATE_VERSION, "last_used": utcnow()}
+            await _gridfs().upload_from_stream(digest, pdf, metadata=metadata)
+        _schedule_prune()
+
+
+async def cached_render(collection_name: str, kind: str, doc_id: str, version: Any, data: Dict[str, Any]) -> bytes:
+    """The PDF of one stored document version, rendered only on a cache miss.
+
+    doc_id is the stored _id as a string and version any value that changes
+    whenever the rendered content would, such as its updated_at. Raises
+    PdfQueueFull like render_pdf when a miss cannot be queued; cache failures
+    only cost a render.
+    """
+    digest = pdf_cache_key(collection_name, kind, doc_id, version)
+    try:
+        pdf = await _lookup(collection_name, doc_id, digest)
+        if pdf is not None:
+            return pdf
+    except Exception as e:
+        logging.error(f"Error reading cached PDF for {collection_name} {doc_id}: {str(e)}")
+
+    _stats["misses"] += 1
+    pdf = await render_pdf(kind, data)
+    try:
+        await _store(collection_name, doc_id, digest, pdf)
+    except Exception as e:
+        logging.error(f"Error caching PDF for {collection_name} {doc_id}: {str(e)}")
+    return pdf
+
+
+async def start_pdf_cache() -> None:
+    """Index the GridFS tier for least-recently-used pruning and start the first prune"""
+    if not PDF_CACHE_GRIDFS:
+        return
+    try:
+        await _gridfs_files().create_index([("metadata.last_used", ASCENDING)])
+    except Exception as e:
+        logging.error(f"Error preparing the GridFS PDF cache: {str(e)}")
+    _schedule_prune()
+
+
+def pdf_cache_stats() -> Dict[str, Any]:
+    return {**disk_cache.stats(), "gridfs": PDF_CACHE_GRIDFS, **_stats}
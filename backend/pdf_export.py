@@ -0,0 +1,330 @@
+"""
+PDFs of stored documents, one at a time or many as one streamed ZIP
+
+A document is loaded for rendering with a single aggregation that joins its
+customer or vendor and the products of its lines, whatever the line count;
+company details come from the settings cache. The cache version is a digest
+of exactly what is handed to the renderer, so an edited customer or company
+address gets a fresh PDF while unrelated writes, such as stock movements
+stamping a product, do not.
+
+A bundle selects documents of one type by date range and/or id and renders
+them through the PDF cache and worker pool in a window of BUNDLE_CONCURRENCY
+documents, read from the cursor as the window drains. A slot is only
+refilled once its PDF has been added to the archive and sent, so a slow
+download slows rendering instead of piling PDFs up in memory, and the
+download starts with the first finished document. PDFs are already
+compressed, so they are stored in the ZIP as they are. Documents that fail
+to render are listed in errors.txt at the end instead of breaking the
+archive.
+
+Progress lives in a pdf_jobs document, so any worker can answer a status
+request. It is written at most once per BUNDLE_PROGRESS_INTERVAL and expires
+after PDF_JOB_RETENTION_HOURS.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+import zipfile
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional, Set
+
+from bson import ObjectId
+
+from database import convert_objectid_to_str, db, id_filter, utcnow
+from pdf_cache import cached_render
+from pdf_service import PDF_RETRY_AFTER, PDF_WORKERS, PdfQueueFull
+from settings_cache import SettingsSnapshot
+
+PDF_JOBS_COLLECTION = "pdf_jobs"
+PDF_JOB_RETENTION_HOURS = 24
+
+# Documents one bundle may contain
+PDF_BUNDLE_MAX_DOCUMENTS = int(os.environ.get("PDF_BUNDLE_MAX_DOCUMENTS", "5000"))
+
+# Documents one bundle renders ahead of the client; the rest of the pool queue stays free for single downloads
+BUNDLE_CONCURRENCY = max(1, PDF_WORKERS)
+
+# Seconds between progress writes
+BUNDLE_PROGRESS_INTERVAL = 1.0
+
+# Failures kept in the job document; all of them go into errors.txt
+MAX_JOB_ERRORS = 100
+
+
+class PdfSource(NamedTuple):
+    collection: str
+    kind: str  # pdf_service renderer
+    date_field: str
+    filename_prefix: str  # as the single-document endpoint names the file
+    party: str  # "customer" or "vendor"
+    title: str
+
+
+# Party -> (collection, id field on the document, heading)
+PARTIES = {
+    "customer": ("customers", "customer_id", "INFORMASI CUSTOMER"),
+    "vendor": ("vendors", "vendor_id", "INFORMASI VENDOR"),
+}
+
+# Settings general keys -> company fields PDFGenerator prints
+COMPANY_FIELDS = {
+    "companyName": "name", "companyAddress": "address", "companyPhone": "phone",
+    "companyEmail": "email", "companyWebsite": "website", "taxNumber": "tax_number",
+}
+
+
+# URL segment -> documents rendered by the matching /{id}/pdf endpoint
+PDF_SOURCES = {
+    "sales-invoices": PdfSource(
+        "sales_invoices", "invoice", "invoice_date", "invoice", "customer", "INVOICE PENJUALAN"),
+    "sales-orders": PdfSource("sales_orders", "order", "order_date", "order", "customer", "SALES ORDER"),
+    "quotations": PdfSource("quotations", "quotation", "quotation_date", "quotation", "customer", "QUOTATION"),
+    "purchase-invoices": PdfSource(
+        "purchase_invoices", "invoice", "invoice_date", "purchase_invoice", "vendor", "INVOICE PEMBELIAN"),
+    "purchase-orders": PdfSource(
+        "purchase_orders", "order", "order_date", "purchase_order", "vendor", "PURCHASE ORDER"),
+}
+
+_finish_tasks: Set[asyncio.Task] = set()
+
+
+class BundleTooLarge(Exception):
+    """The selection holds more than PDF_BUNDLE_MAX_DOCUMENTS documents"""
+
+
+def _object_id(expression: str) -> Dict[str, Any]:
+    # Ids are stored as strings; ones that are not ObjectIds simply match nothing
+    return {"$convert": {"input": expression, "to": "objectId", "onError": None, "onNull": None}}
+
+
+def pdf_pipeline(source: PdfSource, match: Dict[str, Any], sort: Optional[Dict[str, int]] = None) -> List[Dict]:
+    """Documents matching match, each with its party as _party and its line products as _products"""
+    party_collection, party_field, _ = PARTIES[source.party]
+    pipeline: List[Dict] = [{"$match": match}]
+    if sort:
+        pipeline.append({"$sort": sort})
+    pipeline += [
+        {"$addFields": {
+            "_party_id": _object_id(f"${party_field}"),
+            "_product_ids": {"$map": {
+                "input": {"$ifNull": ["$items", []]}, "as": "item", "in": _object_id("$$item.product_id")
+            }},
+        }},
+        # localField lookups on _id use the index; an array localField matches any of its elements
+        {"$lookup": {"from": party_collection, "localField": "_party_id", "foreignField": "_id", "as": "_party"}},
+        {"$lookup": {"from": "products", "localField": "_product_ids", "foreignField": "_id", "as": "_products"}},
+        {"$project": {"_party_id": 0, "_product_ids": 0, "search_keys": 0,
+                      "_party.search_keys": 0, "_products.search_keys": 0}},
+    ]
+    return pipeline
+
+
+async def load_pdf_document(source: PdfSource, doc_id: str) -> Optional[Dict[str, Any]]:
+    """One stored document with its party and products, in one round-trip"""
+    docs = await db[source.collection].aggregate(pdf_pipeline(source, id_filter(doc_id))).to_list(length=1)
+    return docs[0] if docs else None
+
+
+def render_data(source: PdfSource, doc: Dict[str, Any], settings: Dict[str, Any]) -> Dict[str, Any]:
+    """The fields PDFGenerator reads, from a document loaded by pdf_pipeline.
+
+    Line names and prices stay as stored on the document; products only fill
+    in what a line lacks. The party's current contact details are shown.
+    """
+    _, party_field, party_title = PARTIES[source.party]
+    data = {key: value for key, value in doc.items() if key not in ("_party", "_products")}
+    data = convert_objectid_to_str(data)
+    party = doc["_party"][0] if doc.get("_party") else {}
+    products = {str(product["_id"]): product for product in doc.get("_products", [])}
+
+    data["title"] = source.title
+    data["party_title"] = party_title
+    data["customer_id"] = doc.get(party_field, "")
+    data["customer_name"] = party.get("name") or doc.get(f"{source.party}_name", "")
+    data["customer_address"] = ", ".join(part for part in (party.get("address"), party.get("city")) if part)
+    data["customer_phone"] = party.get("phone") or ""
+    data["customer_email"] = party.get("email") or ""
+
+    items = []
+    for item in doc.get("items") or []:
+        item = dict(item)
+        product = products.get(str(item.get("product_id")), {})
+        item.setdefault("product_name", product.get("name", ""))
+        item.setdefault("unit_price", product.get("price", 0))
+        item.setdefault("total", item["unit_price"] * item.get("quantity", 0))
+        items.append(item)
+    data["items"] = items
+
+    general = settings.get("general", {})
+    data["company"] = {field: general.get(key, "") for key, field in COMPANY_FIELDS.items()}
+    return data
+
+
+def source_version(data: Dict[str, Any]) -> str:
+    """Digest of the render data: the PDF changes only when this does"""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+async def render_stored(source: PdfSource, doc: Dict[str, Any], settings: SettingsSnapshot) -> bytes:
+    """Render a document loaded by pdf_pipeline, through the PDF cache"""
+    data = render_data(source, doc, settings.settings)
+    return await cached_render(source.collection, source.kind, str(doc["_id"]), source_version(data), data)
+
+
+def bundle_query(source: PdfSource, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                 ids: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Filter for the selected documents; dates are inclusive YYYY-MM-DD strings like the stored ones"""
+    query: Dict[str, Any] = {}
+    if date_from or date_to:
+        query[source.date_field] = {op: value for op, value in (("$gte", date_from), ("$lte", date_to)) if value}
+    if ids:
+        # Resolved the same way as database.id_filter
+        object_ids, string_ids = [], []
+        for doc_id in ids:
+            try:
+                object_ids.append(ObjectId(doc_id))
+            except Exception:
+                string_ids.append(doc_id)
+        query["$or"] = [{"_id": {"$in": object_ids}}, {"id": {"$in": string_ids}}]
+    return query
+
+
+async def create_bundle_job(document_type: str, query: Dict[str, Any]) -> Dict[str, Any]:
+    """Count the selection and record a running job; raises BundleTooLarge"""
+    source = PDF_SOURCES[document_type]
+    total = await db[source.collection].count_documents(query)
+    if total > PDF_BUNDLE_MAX_DOCUMENTS:
+        raise BundleTooLarge(
+            f"{total} documents selected; narrow the selection to {PDF_BUNDLE_MAX_DOCUMENTS} or fewer"
+        )
+    now = utcnow()
+    job = {
+        "_id": uuid.uuid4().hex, "document_type": document_type, "status": "running",
+        "total": total, "done": 0, "failed": 0, "errors": [], "created_at": now, "updated_at": now,
+    }
+    await db[PDF_JOBS_COLLECTION].insert_one(job)
+    return convert_objectid_to_str(job)
+
+
+async def get_bundle_job(job_id: str) -> Optional[Dict[str, Any]]:
+    return convert_objectid_to_str(await db[PDF_JOBS_COLLECTION].find_one({"_id": job_id}))
+
+
+async def _update_job(job_id: str, fields: Dict[str, Any]) -> None:
+    try:
+        await db[PDF_JOBS_COLLECTION].update_one({"_id": job_id}, {"$set": {**fields, "updated_at": utcnow()}})
+    except Exception as e:
+        logging.error(f"Error updating PDF bundle job {job_id}: {str(e)}")
+
+
+def _finish_job(job_id: str, fields: Dict[str, Any]) -> None:
+    # Not awaited: a disconnected client cancels the stream, and with it anything awaited here
+    task = asyncio.get_running_loop().create_task(_update_job(job_id, {**fields, "finished_at": utcnow()}))
+    _finish_tasks.add(task)
+    task.add_done_callback(_finish_tasks.discard)
+
+
+async def _render(source: PdfSource, doc: Dict[str, Any], settings: SettingsSnapshot) -> bytes:
+    while True:
+        try:
+            return await render_stored(source, doc, settings)
+        except PdfQueueFull:
+            # Single downloads hold the rest of the queue; wait for room rather than fail the document
+            await asyncio.sleep(PDF_RETRY_AFTER)
+
+
+class _ZipSink:
+    """Write-only stream collecting what ZipFile writes; having no tell(), it makes ZipFile stream"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _zip_entry(name: str) -> zipfile.ZipInfo:
+    entry = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    entry.compress_type = zipfile.ZIP_STORED
+    return entry
+
+
+async def bundle_zip(source: PdfSource, query: Dict[str, Any], settings: SettingsSnapshot,
+                     job_id: str) -> AsyncIterator[bytes]:
+    """Yield the ZIP archive in pieces, adding PDFs in the order they finish"""
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, "w")
+    progress: Dict[str, Any] = {"done": 0, "failed": 0, "errors": []}
+    failures: List[str] = []
+    in_flight: Set[asyncio.Task] = set()
+    selected = 0
+    status = "cancelled"
+
+    async def render(doc):
+        try:
+            return doc, await _render(source, doc, settings), None
+        except Exception as e:
+            return doc, None, e
+
+    try:
+        pipeline = pdf_pipeline(source, query, {source.date_field: 1})
+        docs = db[source.collection].aggregate(pipeline, batchSize=BUNDLE_CONCURRENCY * 2).__aiter__()
+        exhausted = False
+        last_report = time.monotonic()
+        while True:
+            while not exhausted and len(in_flight) < BUNDLE_CONCURRENCY:
+                try:
+                    doc = await docs.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                else:
+                    in_flight.add(asyncio.create_task(render(doc)))
+                    selected += 1
+            if not in_flight:
+                break
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                doc, pdf, error = task.result()
+                if error is None:
+                    archive.writestr(_zip_entry(f"{source.filename_prefix}_{doc['_id']}.pdf"), pdf)
+                    progress["done"] += 1
+                    # Resumes once the chunk is sent, so the window refills at the client's pace
+                    yield sink.take()
+                else:
+                    logging.error(f"Error rendering PDF for {source.collection} {doc['_id']}: {str(error)}")
+                    failures.append(f"{doc['_id']}: {str(error)}")
+                    progress["failed"] += 1
+                    if len(progress["errors"]) < MAX_JOB_ERRORS:
+                        progress["errors"].append({"id": str(doc["_id"]), "error": str(error)})
+            if time.monotonic() - last_report >= BUNDLE_PROGRESS_INTERVAL:
+                await _update_job(job_id, progress)
+                last_report = time.monotonic()
+        if failures:
+            archive.writestr(_zip_entry("errors.txt"), "\n".join(failures) + "\n")
+        archive.close()
+        yield sink.take()
+        status = "completed"
+    except Exception:
+        status = "failed"
+        raise
+    finally:
+        for task in in_flight:
+            task.cancel()
+        fields = {**progress, "status": status}
+        if status == "completed":
+            # Documents created since the job was counted are included too
+            fields["total"] = selected
+        _finish_job(job_id, fields)
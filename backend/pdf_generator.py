@@ -5,8 +5,13 @@ from reportlab.lib import colors
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
 from datetime import datetime
+from xml.sax.saxutils import escape
+import io
 import os
 
+# Bump whenever the layout changes, so cached PDFs from older templates are not served
+TEMPLATE_VERSION = 2
+
 class PDFGenerator:
     def __init__(self):
         self.styles = getSampleStyleSheet()
@@ -49,13 +54,42 @@ class PDFGenerator:
             spaceAfter=4
         ))
 
+    def render_bytes(self, method_name, data):
+        """Render with one of the generate_* methods into memory and return the PDF bytes"""
+        buffer = io.BytesIO()
+        getattr(self, method_name)(data, buffer)
+        return buffer.getvalue()
+
+    def add_company_header(self, story, data):
+        """Company name and contact details from settings, when the data carries them"""
+        company = data.get('company')
+        if not company or not company.get('name'):
+            return
+        story.append(Paragraph(escape(company['name']), self.styles['CustomSubtitle']))
+        for line in (company.get('address'), company.get('phone'), company.get('email'), company.get('website')):
+            if line:
+                story.append(Paragraph(escape(str(line)), self.styles['CustomSmall']))
+        if company.get('tax_number'):
+            story.append(Paragraph(f"NPWP: {escape(str(company['tax_number']))}", self.styles['CustomSmall']))
+        story.append(Spacer(1, 12))
+
+    def contact_rows(self, data):
+        """Address, phone and email rows for the customer or vendor table"""
+        rows = []
+        for label, key in (('Alamat:', 'customer_address'), ('Telepon:', 'customer_phone'), ('Email:', 'customer_email')):
+            if data.get(key):
+                rows.append([label, data[key]])
+        return rows
+
     def generate_invoice_pdf(self, invoice_data, output_path):
         """Generate PDF for sales invoice"""
         doc = SimpleDocTemplate(output_path, pagesize=A4)
         story = []
         
+        self.add_company_header(story, invoice_data)
+        
         # Title
-        story.append(Paragraph("INVOICE PENJUALAN", self.styles['CustomTitle']))
+        story.append(Paragraph(invoice_data.get('title', "INVOICE PENJUALAN"), self.styles['CustomTitle']))
         story.append(Spacer(1, 12))
         
         # Invoice details
@@ -78,11 +112,11 @@ class PDFGenerator:
         story.append(Spacer(1, 20))
         
         # Customer info
-        story.append(Paragraph("INFORMASI CUSTOMER", self.styles['CustomSubtitle']))
+        story.append(Paragraph(invoice_data.get('party_title', "INFORMASI CUSTOMER"), self.styles['CustomSubtitle']))
         customer_info = [
             ['Nama:', invoice_data.get('customer_name', '')],
             ['ID Customer:', invoice_data.get('customer_id', '')]
-        ]
+        ] + self.contact_rows(invoice_data)
         
         customer_table = Table(customer_info, colWidths=[2*inch, 3*inch])
         customer_table.setStyle(TableStyle([
@@ -145,8 +179,10 @@ class PDFGenerator:
         doc = SimpleDocTemplate(output_path, pagesize=A4)
         story = []
         
+        self.add_company_header(story, order_data)
+        
         # Title
-        story.append(Paragraph("SALES ORDER", self.styles['CustomTitle']))
+        story.append(Paragraph(order_data.get('title', "SALES ORDER"), self.styles['CustomTitle']))
         story.append(Spacer(1, 12))
         
         # Order details
@@ -170,11 +206,11 @@ class PDFGenerator:
         story.append(Spacer(1, 20))
         
         # Customer info
-        story.append(Paragraph("INFORMASI CUSTOMER", self.styles['CustomSubtitle']))
+        story.append(Paragraph(order_data.get('party_title', "INFORMASI CUSTOMER"), self.styles['CustomSubtitle']))
         customer_info = [
             ['Nama:', order_data.get('customer_name', '')],
             ['ID Customer:', order_data.get('customer_id', '')]
-        ]
+        ] + self.contact_rows(order_data)
         
         customer_table = Table(customer_info, colWidths=[2*inch, 3*inch])
         customer_table.setStyle(TableStyle([
@@ -228,7 +264,7 @@ class PDFGenerator:
         if order_data.get('notes'):
             story.append(Spacer(1, 20))
             story.append(Paragraph("CATATAN:", self.styles['CustomSubtitle']))
-            story.append(Paragraph(order_data.get('notes', ''), self.styles['CustomNormal']))
+            story.append(Paragraph(escape(str(order_data.get('notes', ''))), self.styles['CustomNormal']))
         
         story.append(Spacer(1, 30))
         
@@ -243,8 +279,10 @@ class PDFGenerator:
         doc = SimpleDocTemplate(output_path, pagesize=A4)
         story = []
         
+        self.add_company_header(story, quotation_data)
+        
         # Title
-        story.append(Paragraph("QUOTATION", self.styles['CustomTitle']))
+        story.append(Paragraph(quotation_data.get('title', "QUOTATION"), self.styles['CustomTitle']))
         story.append(Spacer(1, 12))
         
         # Quotation details
@@ -268,11 +306,11 @@ class PDFGenerator:
         story.append(Spacer(1, 20))
         
         # Customer info
-        story.append(Paragraph("INFORMASI CUSTOMER", self.styles['CustomSubtitle']))
+        story.append(Paragraph(quotation_data.get('party_title', "INFORMASI CUSTOMER"), self.styles['CustomSubtitle']))
         customer_info = [
             ['Nama:', quotation_data.get('customer_name', '')],
             ['ID Customer:', quotation_data.get('customer_id', '')]
-        ]
+        ] + self.contact_rows(quotation_data)
         
         customer_table = Table(customer_info, colWidths=[2*inch, 3*inch])
         customer_table.setStyle(TableStyle([
@@ -326,7 +364,7 @@ class PDFGenerator:
         if quotation_data.get('notes'):
             story.append(Spacer(1, 20))
             story.append(Paragraph("CATATAN:", self.styles['CustomSubtitle']))
-            story.append(Paragraph(quotation_data.get('notes', ''), self.styles['CustomNormal']))
+            story.append(Paragraph(escape(str(quotation_data.get('notes', ''))), self.styles['CustomNormal']))
         
         story.append(Spacer(1, 30))
         
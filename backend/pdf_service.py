@@ -0,0 +1,112 @@
+"""
+PDF rendering off the event loop
+
+reportlab builds are synchronous and CPU-bound, so render_pdf runs them in a
+ProcessPoolExecutor of PDF_WORKERS processes. Each worker builds one
+PDFGenerator (and its style sheet) when it starts, and start_pdf_pool warms
+every worker up front so the first requests do not pay for process start-up.
+At most PDF_MAX_PENDING renders may be queued or running; beyond that
+render_pdf raises PdfQueueFull, which endpoints turn into 503 so clients back
+off instead of piling up behind the pool. Documents are rendered into memory
+and come back as bytes, so nothing is written to disk.
+
+This module must not import the database layer: spawned workers import it.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional
+
+from pdf_generator import PDFGenerator
+
+# Rendering processes; 0 renders in a thread of this process instead
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Renders queued or running before new ones are refused
+PDF_MAX_PENDING = int(os.environ.get("PDF_MAX_PENDING", str(max(1, PDF_WORKERS) * 8)))
+
+# Seconds clients are told to wait when the queue is full
+PDF_RETRY_AFTER = 2
+
+# Document kind -> PDFGenerator method
+RENDERERS = {
+    "invoice": "generate_invoice_pdf",
+    "order": "generate_order_pdf",
+    "quotation": "generate_quotation_pdf",
+}
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pending = 0
+
+# Per-process generator, built once by the worker initializer (or lazily in thread mode)
+_generator: Optional[PDFGenerator] = None
+
+
+class PdfQueueFull(Exception):
+    """Too many renders are already queued"""
+
+
+def _init_worker() -> None:
+    global _generator
+    _generator = PDFGenerator()
+
+
+def _warm_up() -> int:
+    # Keep this worker busy briefly so the pool starts the others too
+    time.sleep(0.1)
+    return os.getpid()
+
+
+def _render(kind: str, data: Dict[str, Any]) -> bytes:
+    global _generator
+    if _generator is None:
+        _generator = PDFGenerator()
+    return _generator.render_bytes(RENDERERS[kind], data)
+
+
+async def start_pdf_pool() -> None:
+    """Start and warm the worker processes"""
+    global _pool
+    if PDF_WORKERS <= 0 or _pool is not None:
+        return
+    # spawn, not fork: the parent holds database client threads that must not be copied
+    _pool = ProcessPoolExecutor(
+        max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker
+    )
+    loop = asyncio.get_running_loop()
+    pids = await asyncio.gather(*(loop.run_in_executor(_pool, _warm_up) for _ in range(PDF_WORKERS)))
+    logging.info(f"PDF rendering pool started with {len(set(pids))} workers")
+
+
+async def stop_pdf_pool() -> None:
+    global _pool
+    if _pool is None:
+        return
+    pool, _pool = _pool, None
+    await asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
+
+
+def pdf_pool_status() -> Dict[str, int]:
+    return {"workers": PDF_WORKERS, "pending": _pending, "max_pending": PDF_MAX_PENDING}
+
+
+async def render_pdf(kind: str, data: Dict[str, Any]) -> bytes:
+    """Render a document in memory without blocking the event loop.
+
+    Raises PdfQueueFull when PDF_MAX_PENDING renders are already in flight.
+    """
+    global _pending
+    if kind not in RENDERERS:
+        raise ValueError(f"Unknown PDF kind {kind}")
+    if _pending >= PDF_MAX_PENDING:
+        raise PdfQueueFull(f"{_pending} PDFs are already being rendered")
+    _pending += 1
+    try:
+        if _pool is None:
+            return await asyncio.get_running_loop().run_in_executor(None, _render, kind, data)
+        return await asyncio.get_running_loop().run_in_executor(_pool, _render, kind, data)
+    finally:
+        _pending -= 1
@@ -0,0 +1,245 @@
+"""
+Report aggregation pipelines
+
+Every report runs as a single $facet pipeline so grouping and sorting happen
+inside MongoDB and only the summarized rows come back to the API.
+"""
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from database import db
+
+# Granularity -> $dateToString format for period buckets
+GRANULARITY_FORMATS = {
+    "day": "%Y-%m-%d",
+    "week": "%G-W%V",
+    "month": "%Y-%m",
+    "year": "%Y",
+}
+
+# Sales invoice statuses that count as revenue (same as the dashboard)
+REVENUE_STATUSES = ["Paid", "Pending", "Overdue"]
+
+IN_PROGRESS_PRODUCTION_STATUSES = ["Scheduled", "In Production"]
+
+
+def date_range_match(field: str, start_date: Optional[str], end_date: Optional[str]) -> Dict:
+    """$match clause for an ISO date string field (YYYY-MM-DD sorts lexically)"""
+    if not start_date and not end_date:
+        return {}
+    bounds = {}
+    if start_date:
+        bounds["$gte"] = start_date
+    if end_date:
+        # Include timestamps on the end date as well as the bare date
+        bounds["$lte"] = end_date + "\uffff"
+    return {field: bounds}
+
+
+def period_expression(field: str, granularity: str) -> Dict:
+    """Bucket label for a date string field, falling back to created_at when unparsable"""
+    return {"$dateToString": {
+        "format": GRANULARITY_FORMATS[granularity],
+        "date": {"$dateFromString": {
+            "dateString": {"$substrBytes": [{"$ifNull": [f"${field}", ""]}, 0, 10]},
+            "onError": "$created_at",
+            "onNull": "$created_at"
+        }}
+    }}
+
+
+def ratio(numerator: float, denominator: float) -> float:
+    """Percentage rounded to one decimal, 0 when the denominator is empty"""
+    return round(numerator / denominator * 100, 1) if denominator else 0.0
+
+
+async def run_facet(collection_name: str, pipeline: List[Dict]) -> Dict[str, List[Dict]]:
+    """Run a pipeline ending in $facet and return its single result document"""
+    results = await db[collection_name].aggregate(pipeline, allowDiskUse=True).to_list(1)
+    return results[0] if results else {}
+
+
+async def sales_report(start_date: Optional[str] = None, end_date: Optional[str] = None,
+                       granularity: str = "month", top: int = 5) -> Dict[str, Any]:
+    """Revenue totals, per-period revenue and best selling products from sales invoices"""
+    match = {"status": {"$in": REVENUE_STATUSES}, **date_range_match("invoice_date", start_date, end_date)}
+    facets = await run_facet("sales_invoices", [
+        {"$match": match},
+        {"$facet": {
+            "totals": [
+                {"$group": {
+                    "_id": None,
+                    "totalRevenue": {"$sum": "$amount"},
+                    "totalOrders": {"$sum": 1},
+                    "averageOrderValue": {"$avg": "$amount"}
+                }}
+            ],
+            "periods": [
+                {"$group": {
+                    "_id": period_expression("invoice_date", granularity),
+                    "revenue": {"$sum": "$amount"},
+                    "orders": {"$sum": 1}
+                }},
+                {"$sort": {"_id": -1}}
+            ],
+            "topProducts": [
+                {"$unwind": "$items"},
+                {"$group": {
+                    "_id": "$items.product_id",
+                    "name": {"$first": "$items.product_name"},
+                    "revenue": {"$sum": "$items.total"},
+                    "quantity": {"$sum": "$items.quantity"}
+                }},
+                {"$sort": {"revenue": -1}},
+                {"$limit": top}
+            ]
+        }}
+    ])
+
+    totals = (facets.get("totals") or [{}])[0]
+    periods = facets.get("periods", [])
+    growth_rate = 0.0
+    if len(periods) >= 2:
+        growth_rate = ratio(periods[0]["revenue"] - periods[1]["revenue"], periods[1]["revenue"])
+
+    return {
+        "period": periods[0]["_id"] if periods else "",
+        "startDate": start_date,
+        "endDate": end_date,
+        "granularity": granularity,
+        "totalRevenue": totals.get("totalRevenue", 0.0),
+        "totalOrders": totals.get("totalOrders", 0),
+        "averageOrderValue": round(totals.get("averageOrderValue") or 0.0, 2),
+        "growthRate": growth_rate,
+        "topProducts": [
+            {"name": p.get("name") or "", "revenue": p["revenue"], "quantity": p["quantity"]}
+            for p in facets.get("topProducts", [])
+        ],
+        "monthlyData": [
+            {"month": p["_id"], "revenue": p["revenue"], "orders": p["orders"]}
+            for p in periods
+        ]
+    }
+
+
+async def inventory_report(category: Optional[str] = None, top: int = 5) -> Dict[str, Any]:
+    """Stock levels and valuation (stock x cost) from products; a point-in-time snapshot"""
+    match = {"category": category} if category else {}
+    stock_value = {"$multiply": [{"$ifNull": ["$stock", 0]}, {"$ifNull": ["$cost", 0]}]}
+    facets = await run_facet("products", [
+        {"$match": match},
+        {"$facet": {
+            "totals": [
+                {"$group": {
+                    "_id": None,
+                    "totalProducts": {"$sum": 1},
+                    "lowStockItems": {"$sum": {"$cond": [
+                        {"$and": [{"$gt": ["$stock", 0]}, {"$lte": ["$stock", "$min_stock"]}]}, 1, 0
+                    ]}},
+                    "outOfStockItems": {"$sum": {"$cond": [{"$lte": ["$stock", 0]}, 1, 0]}},
+                    "totalValue": {"$sum": stock_value}
+                }}
+            ],
+            "categoryBreakdown": [
+                {"$group": {"_id": "$category", "count": {"$sum": 1}, "value": {"$sum": stock_value}}},
+                {"$sort": {"value": -1}}
+            ],
+            "topProducts": [
+                {"$project": {"name": 1, "stock": 1, "value": stock_value}},
+                {"$sort": {"value": -1}},
+                {"$limit": top}
+            ]
+        }}
+    ])
+
+    totals = (facets.get("totals") or [{}])[0]
+    return {
+        "totalProducts": totals.get("totalProducts", 0),
+        "lowStockItems": totals.get("lowStockItems", 0),
+        "outOfStockItems": totals.get("outOfStockItems", 0),
+        "totalValue": totals.get("totalValue", 0.0),
+        "categoryBreakdown": [
+            {"category": c["_id"] or "", "count": c["count"], "value": c["value"]}
+            for c in facets.get("categoryBreakdown", [])
+        ],
+        "topProducts": [
+            {"name": p.get("name", ""), "stock": p.get("stock", 0), "value": p["value"]}
+            for p in facets.get("topProducts", [])
+        ]
+    }
+
+
+async def production_report(start_date: Optional[str] = None, end_date: Optional[str] = None,
+                            granularity: str = "month") -> Dict[str, Any]:
+    """Order counts, completion efficiency and workstation load from production orders"""
+    match = {"status": {"$ne": "Cancelled"}, **date_range_match("order_date", start_date, end_date)}
+    completed = {"$cond": [{"$eq": ["$status", "Completed"]}, 1, 0]}
+    facets = await run_facet("production_orders", [
+        {"$match": match},
+        {"$facet": {
+            "totals": [
+                {"$group": {
+                    "_id": None,
+                    "totalOrders": {"$sum": 1},
+                    "completedOrders": {"$sum": completed},
+                    "inProgressOrders": {"$sum": {"$cond": [
+                        {"$in": ["$status", IN_PROGRESS_PRODUCTION_STATUSES]}, 1, 0
+                    ]}},
+                    "quantity": {"$sum": "$quantity"},
+                    "completedQuantity": {"$sum": "$completed_quantity"}
+                }}
+            ],
+            "workstations": [
+                {"$group": {
+                    "_id": "$workstation",
+                    "orders": {"$sum": 1},
+                    "quantity": {"$sum": "$quantity"},
+                    "completedQuantity": {"$sum": "$completed_quantity"}
+                }},
+                {"$sort": {"orders": -1}}
+            ],
+            "periods": [
+                {"$group": {
+                    "_id": period_expression("order_date", granularity),
+                    "orders": {"$sum": 1},
+                    "completed": {"$sum": completed}
+                }},
+                {"$sort": {"_id": -1}}
+            ]
+        }}
+    ])
+
+    totals = (facets.get("totals") or [{}])[0]
+    return {
+        "startDate": start_date,
+        "endDate": end_date,
+        "granularity": granularity,
+        "totalOrders": totals.get("totalOrders", 0),
+        "completedOrders": totals.get("completedOrders", 0),
+        "inProgressOrders": totals.get("inProgressOrders", 0),
+        "efficiency": ratio(totals.get("completedQuantity", 0), totals.get("quantity", 0)),
+        "workstationStats": [
+            {"workstation": w["_id"] or "", "orders": w["orders"],
+             "efficiency": ratio(w["completedQuantity"], w["quantity"])}
+            for w in facets.get("workstations", [])
+        ],
+        "monthlyData": [
+            {"month": p["_id"], "orders": p["orders"], "completed": p["completed"]}
+            for p in facets.get("periods", [])
+        ]
+    }
+
+
+async def summary_report(start_date: Optional[str] = None, end_date: Optional[str] = None,
+                         granularity: str = "month") -> Dict[str, Any]:
+    """Headline numbers from all three reports, run concurrently"""
+    sales, inventory, production = await asyncio.gather(
+        sales_report(start_date, end_date, granularity),
+        inventory_report(),
+        production_report(start_date, end_date, granularity)
+    )
+    return {
+        "sales": {key: sales[key] for key in ("totalRevenue", "totalOrders", "averageOrderValue", "growthRate")},
+        "inventory": {key: inventory[key] for key in ("totalProducts", "lowStockItems", "outOfStockItems", "totalValue")},
+        "production": {key: production[key] for key in ("totalOrders", "completedOrders", "inProgressOrders", "efficiency")}
+    }
@@ -0,0 +1,153 @@
+"""
+Autocomplete search over normalized prefix keys
+
+Searchable documents carry a `search_keys` array: the lowercased, accent-free
+value of each searchable field plus every word in it. An anchored regex on
+that indexed array is a range scan, so a keystroke costs a handful of index
+entries instead of a collection scan. Candidates are read in three bounded
+index lookups, best first: documents with a key equal to the query, then
+keys the query prefixes, then documents where every term prefixes a key;
+that small set is ranked in Python.
+
+Documents written before search keys existed are backfilled once with:
+    python search.py backfill
+"""
+import argparse
+import asyncio
+import logging
+import re
+import unicodedata
+from typing import Any, Dict, List
+
+from pymongo import UpdateOne
+
+from database import db
+
+SEARCH_KEYS_FIELD = "search_keys"
+
+# Collection -> searchable fields, most important first (earlier fields rank higher)
+SEARCH_FIELDS: Dict[str, List[str]] = {
+    "customers": ["name", "email"],
+    "products": ["name", "sku"],
+    "vendors": ["name", "contact_person", "email"],
+}
+
+# Candidates read from the index per requested result, before ranking
+CANDIDATE_FACTOR = 5
+
+
+_word_split = re.compile(r"[^\w]+", re.UNICODE)
+
+
+def normalize(value: Any) -> str:
+    """Lowercase, strip accents and collapse whitespace"""
+    text = unicodedata.normalize("NFKD", str(value or ""))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(text.lower().split())
+
+
+def search_keys(collection_name: str, doc: Dict) -> List[str]:
+    """Index keys for a document: each full field value and each word in it"""
+    keys = set()
+    for field in SEARCH_FIELDS[collection_name]:
+        value = normalize(doc.get(field))
+        if not value:
+            continue
+        keys.add(value)
+        keys.update(word for word in _word_split.split(value) if word)
+    return sorted(keys)
+
+
+def with_search_keys(collection_name: str, data: Dict) -> Dict:
+    """Add search_keys to a create/update payload that carries every searchable field"""
+    if all(field in data for field in SEARCH_FIELDS[collection_name]):
+        data[SEARCH_KEYS_FIELD] = search_keys(collection_name, data)
+    return data
+
+
+def rank(collection_name: str, doc: Dict, query: str, terms: List[str]) -> tuple:
+    """Sort key: exact field match, then whole-field prefix, then word prefixes; earlier fields win"""
+    fields = SEARCH_FIELDS[collection_name]
+    best = (3, len(fields))
+    for position, field in enumerate(fields):
+        value = normalize(doc.get(field))
+        if not value:
+            continue
+        if value == query:
+            tier = 0
+        elif value.startswith(query):
+            tier = 1
+        elif all(any(word.startswith(term) for word in _word_split.split(value)) for term in terms):
+            tier = 2
+        else:
+            continue
+        best = min(best, (tier, position))
+    name = normalize(doc.get(fields[0]))
+    return best + (len(name), name)
+
+
+async def autocomplete(collection_name: str, q: str, limit: int = 10,
+                       projection: List[str] = None) -> List[Dict]:
+    """Documents whose searchable fields start with q (or whose words start with each term of q)"""
+    query = normalize(q)
+    terms = [term for term in _word_split.split(query) if term]
+    if not terms:
+        return []
+
+    fields = {field: 1 for field in (projection or []) + SEARCH_FIELDS[collection_name]}
+    per_lookup = limit * CANDIDATE_FACTOR
+    # Exact keys, then keys the whole query prefixes, then every term as a prefix of some key;
+    # each is an index range read with its own limit, so short queries never scan every match
+    lookups = [{SEARCH_KEYS_FIELD: query}, {SEARCH_KEYS_FIELD: {"$regex": "^" + re.escape(query)}}]
+    if len(terms) > 1 or terms[0] != query:
+        lookups.append({"$and": [{SEARCH_KEYS_FIELD: {"$regex": "^" + re.escape(term)}} for term in terms]})
+
+    found: Dict[Any, Dict] = {}
+    for filter_dict in lookups:
+        async for doc in db[collection_name].find(filter_dict, fields).limit(per_lookup):
+            found.setdefault(doc["_id"], doc)
+        if len(found) >= per_lookup:
+            break
+    candidates = list(found.values())
+    candidates.sort(key=lambda doc: rank(collection_name, doc, query, terms))
+    results = []
+    for doc in candidates[:limit]:
+        doc["id"] = str(doc.pop("_id"))
+        results.append(doc)
+    return results
+
+
+async def backfill_search_keys(batch_size: int = 1000) -> Dict[str, int]:
+    """Add search_keys to documents written before autocomplete indexing existed"""
+    counts = {}
+    for collection_name, fields in SEARCH_FIELDS.items():
+        collection = db[collection_name]
+        updated = 0
+        cursor = collection.find({SEARCH_KEYS_FIELD: {"$exists": False}}, {field: 1 for field in fields})
+        batch = []
+        async for doc in cursor.batch_size(batch_size):
+            batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": {SEARCH_KEYS_FIELD: search_keys(collection_name, doc)}}))
+            if len(batch) >= batch_size:
+                updated += (await collection.bulk_write(batch, ordered=False)).modified_count
+                batch = []
+        if batch:
+            updated += (await collection.bulk_write(batch, ordered=False)).modified_count
+        counts[collection_name] = updated
+    if any(counts.values()):
+        logging.info(f"Backfilled search keys: {counts}")
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ZONE autocomplete search keys")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("backfill", help="add search keys to documents written without them")
+
+    args = parser.parse_args()
+    if args.command == "backfill":
+        counts = asyncio.run(backfill_search_keys())
+        print(f"Backfilled search keys: {counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Fast JSON responses for Mongo documents
+
+MongoJSONResponse encodes with orjson, which handles datetime natively (in
+the same format as datetime.isoformat()) and ObjectId/Decimal128 through a
+default hook. It is the app's default response class, and list endpoints
+return it directly through documents_response: the projection already limits
+each document to the model's fields, so rows only get missing defaults filled
+in place instead of being rebuilt, isoformatted and re-validated against
+response_model.
+"""
+import copy
+from decimal import Decimal
+from typing import Any, Dict, List
+
+import orjson
+from bson import Decimal128, ObjectId
+from fastapi.responses import ORJSONResponse
+from starlette.responses import Response
+
+
+def orjson_default(value: Any) -> Any:
+    """Encode the BSON types orjson does not know"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+class MongoJSONResponse(ORJSONResponse):
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def documents_response(docs: List[Dict], response: Response, defaults: Dict[str, Any]) -> MongoJSONResponse:
+    """Encode projected documents as they are, filling missing or null fields with defaults.
+
+    Headers set on the endpoint's injected response (e.g. X-Next-Cursor) are
+    carried over, since FastAPI does not merge them into a returned response.
+    """
+    for doc in docs:
+        for field, default in defaults.items():
+            if doc.get(field) is None:
+                doc[field] = copy.copy(default) if isinstance(default, (list, dict)) else default
+    return MongoJSONResponse(docs, headers=dict(response.headers))
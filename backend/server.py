@@ -1,4 +1,5 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Query, Response, UploadFile, File
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -6,22 +7,48 @@ import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Any, Dict
+from typing import List, Optional, Any, Dict, Type
 import uuid
+import csv
+import io
+import json
 from datetime import datetime, timedelta
-from pdf_generator import PDFGenerator
-import tempfile
+from bson import ObjectId
 import os
 
 # Import database and auth utilities
 from database import (
-    create_document, get_document, get_documents, 
-    update_document, delete_document, count_documents, find_one_document, db
+    create_document, get_document, get_documents, get_page, stream_documents, DocumentLoader,
+    update_document, increment_document, delete_document, count_documents, find_one_document, db,
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 )
 from auth import (
     verify_password, get_password_hash, create_access_token, 
     verify_token, get_current_user
 )
+from numbering import next_number
+from dashboard import get_dashboard_aggregates, rebuild_dashboard_aggregates, record_invoice_change
+from reports import inventory_report, production_report, sales_report, summary_report
+from indexes import (
+    INDEX_SPECS, SLOW_QUERY_MS, enable_slow_query_profiling, index_report, reconcile_indexes, unindexed_slow_queries
+)
+from overdue import start_overdue_sweeper, stop_overdue_sweeper
+from ledger import GuardedUpdate, LedgerConflict, Posting, account_names, forget_accounts, post_journal
+from stock import StockMovement, StockShortage, apply_stock_movements
+from search import autocomplete, with_search_keys
+from cache import document_cache
+from invalidation import invalidation_status, start_cache_invalidation, stop_cache_invalidation
+from settings_cache import SETTINGS_DOC_ID, SettingsSnapshot, get_settings_snapshot, save_settings
+from conditional import conditional_get_middleware, etag_matches
+from sync import SYNC_COLLECTIONS, SyncTokenExpired, sync_page
+from serialization import MongoJSONResponse, documents_response
+from bulk_import import ImportSpec, csv_rows, import_rows, ndjson_rows
+from pdf_service import PDF_RETRY_AFTER, PdfQueueFull, start_pdf_pool, stop_pdf_pool
+from pdf_cache import pdf_cache_stats, start_pdf_cache
+from pdf_export import (
+    PDF_SOURCES, BundleTooLarge, bundle_query, bundle_zip, create_bundle_job, get_bundle_job,
+    load_pdf_document, render_stored
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -32,11 +59,14 @@ db_name = os.environ.get('DB_NAME', 'zone_db')
 client = AsyncIOMotorClient(mongo_url)
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=MongoJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Conditional GETs; registered before CORS so CORS stays outermost and also covers 304s
+app.middleware("http")(conditional_get_middleware)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -44,6 +74,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Last-Modified", "Content-Disposition", "X-Job-Id"],
 )
 
 # Test endpoint
@@ -184,6 +215,63 @@ class QuotationCreate(BaseModel):
     items: List[Dict]
     notes: Optional[str] = ""
 
+# =============================
+# List pagination helpers
+# =============================
+
+def list_params(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    order: Optional[str] = Query(None, pattern="^(asc|desc)$")
+) -> Dict[str, Any]:
+    """Common query parameters for list endpoints"""
+    return {"limit": limit, "cursor": cursor, "order": order}
+
+
+def build_filter(**fields) -> Dict[str, Any]:
+    """Build an equality filter from the query parameters that were provided"""
+    return {key: value for key, value in fields.items() if value is not None}
+
+
+async def fetch_page(collection_name: str, params: Dict[str, Any], response: Response,
+                     filter_dict: Optional[Dict] = None, projection: Optional[List[str]] = None,
+                     sort_field: str = "created_at", default_order: str = "desc") -> List[Dict]:
+    """Fetch one page for a list endpoint; the next page cursor goes in the X-Next-Cursor header"""
+    order = params.get("order") or default_order
+    try:
+        docs, next_cursor = await get_page(
+            collection_name,
+            filter_dict,
+            limit=params["limit"],
+            cursor=params.get("cursor"),
+            projection=projection,
+            sort_field=sort_field,
+            sort_direction=-1 if order == "desc" else 1
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return docs
+
+
+# =============================
+# Stock movement helpers
+# =============================
+
+async def apply_order_stock_movements(movements: List[StockMovement], reference_type: str,
+                                      document: Dict, guard: GuardedUpdate) -> None:
+    """Apply a document's stock movements with its status change, mapping failures to HTTP errors"""
+    number = next((document.get(field) for field in ("order_number", "opname_number", "transfer_number")
+                   if document.get(field)), "")
+    try:
+        await apply_stock_movements(movements, reference_type, document.get("id", ""), number, guard)
+    except StockShortage as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except LedgerConflict:
+        raise HTTPException(status_code=409, detail="Status was changed by another request")
+
+
 # Add your routes to the router instead of directly to app
 @api_router.get("/")
 async def root():
@@ -204,112 +292,53 @@ async def get_status_checks():
 # Dashboard Endpoints
 @api_router.get("/dashboard", response_model=DashboardData)
 async def get_dashboard_data():
-    """Get dashboard statistics and recent transactions from live data"""
+    """Get dashboard statistics and recent transactions from the materialized aggregates"""
     try:
-        # Fetch data
-        sales_invoices = await get_documents("sales_invoices", limit=1000)
-        purchase_invoices = await get_documents("purchase_invoices", limit=1000)
-        products_count = await count_documents("products")
-
-        # Helpers
-        def parse_date(value):
-            if isinstance(value, datetime):
-                return value
-            if not value:
-                return None
-            for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"):
-                try:
-                    return datetime.strptime(value, fmt)
-                except Exception:
-                    continue
-            return None
-
         def fmt_currency(amount: float) -> str:
             try:
                 return f"Rp {amount:,.0f}"
             except Exception:
                 return str(amount)
 
-        # Stats
-        total_revenue = sum(inv.get("amount", 0.0) for inv in sales_invoices if inv.get("status") in ["Paid", "Pending", "Overdue"])
-        total_expense = sum(inv.get("amount", 0.0) for inv in purchase_invoices if inv.get("status") in ["Paid", "Pending", "Overdue"])
-        pending_invoices = sum(1 for inv in sales_invoices if inv.get("status") in ["Pending", "Overdue"])
+        # Cash flow covers the last 6 months
+        now = datetime.utcnow()
+        months = []
+        for i in range(5, -1, -1):
+            month_ref = (now.replace(day=1) - timedelta(days=30 * i))
+            months.append((month_ref.year, month_ref.month))
 
-        # Simple deltas (placeholders until trend logic added)
-        revenue_change = 0.0
-        expense_change = 0.0
-        invoice_change = 0
-        product_change = 0
+        summary, buckets = await get_dashboard_aggregates(months)
+        products_count = await count_documents("products")
 
+        # Simple deltas (placeholders until trend logic added)
         stats = DashboardStats(
-            total_revenue=total_revenue,
-            total_expense=total_expense,
-            pending_invoices=pending_invoices,
+            total_revenue=summary.get("total_revenue", 0.0),
+            total_expense=summary.get("total_expense", 0.0),
+            pending_invoices=summary.get("pending_invoices", 0),
             total_products=products_count,
-            revenue_change=revenue_change,
-            expense_change=expense_change,
-            invoice_change=invoice_change,
-            product_change=product_change
+            revenue_change=0.0,
+            expense_change=0.0,
+            invoice_change=0,
+            product_change=0
         )
 
-        # Recent transactions (combine sales & purchases, sorted by date desc)
-        recent_items = []
-        for inv in sales_invoices:
-            recent_items.append({
-                "id": inv.get("id", ""),
-                "type": "Invoice",
-                "customer": inv.get("customer_name", ""),
-                "amount": fmt_currency(inv.get("amount", 0.0)),
-                "status": inv.get("status", ""),
-                "date": inv.get("invoice_date") or (inv.get("created_at").isoformat() if isinstance(inv.get("created_at"), datetime) else inv.get("created_at", "")),
-                "created_at": parse_date(inv.get("created_at") or inv.get("invoice_date"))
-            })
-        for pinv in purchase_invoices:
-            recent_items.append({
-                "id": pinv.get("id", ""),
-                "type": "Purchase",
-                "customer": pinv.get("vendor_name", ""),
-                "amount": fmt_currency(pinv.get("amount", 0.0)),
-                "status": pinv.get("status", ""),
-                "date": pinv.get("invoice_date") or (pinv.get("created_at").isoformat() if isinstance(pinv.get("created_at"), datetime) else pinv.get("created_at", "")),
-                "created_at": parse_date(pinv.get("created_at") or pinv.get("invoice_date"))
-            })
-        recent_items = sorted(recent_items, key=lambda x: x.get("created_at") or datetime.min, reverse=True)[:5]
         recent_transactions = [
             Transaction(
                 id=item.get("id", ""),
                 type=item.get("type", ""),
                 customer=item.get("customer", ""),
-                amount=item.get("amount", ""),
+                amount=fmt_currency(item.get("amount", 0.0)),
                 status=item.get("status", ""),
                 date=item.get("date", "")
-            ) for item in recent_items
+            ) for item in summary.get("recent_transactions", [])
         ]
 
-        # Cash flow data (last 6 months aggregation)
-        now = datetime.utcnow()
-        months = []
-        for i in range(5, -1, -1):
-            month_ref = (now.replace(day=1) - timedelta(days=30 * i))
-            months.append((month_ref.year, month_ref.month))
-
-        bucket = {(y, m): {"revenue": 0.0, "expense": 0.0} for (y, m) in months}
-
-        for inv in sales_invoices:
-            dt = parse_date(inv.get("invoice_date") or inv.get("created_at"))
-            if dt and (dt.year, dt.month) in bucket:
-                bucket[(dt.year, dt.month)]["revenue"] += inv.get("amount", 0.0)
-        for pinv in purchase_invoices:
-            dt = parse_date(pinv.get("invoice_date") or pinv.get("created_at"))
-            if dt and (dt.year, dt.month) in bucket:
-                bucket[(dt.year, dt.month)]["expense"] += pinv.get("amount", 0.0)
-
         month_names = ["Januari", "Februari", "Maret", "April", "Mei", "Juni", "Juli", "Agustus", "September", "Oktober", "November", "Desember"]
         cash_flow_data = [
             ChartDataPoint(
                 month=f"{month_names[m-1]} {y}",
-                revenue=bucket[(y, m)]["revenue"],
-                expense=bucket[(y, m)]["expense"]
+                revenue=buckets.get((y, m), {}).get("revenue", 0.0),
+                expense=buckets.get((y, m), {}).get("expense", 0.0)
             )
             for (y, m) in months
         ]
@@ -323,6 +352,20 @@ async def get_dashboard_data():
         logging.error(f"Error building dashboard data: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error building dashboard data: {str(e)}")
 
+@api_router.post("/dashboard/rebuild")
+async def rebuild_dashboard():
+    """Recompute the dashboard aggregates from the invoice collections"""
+    try:
+        summary = await rebuild_dashboard_aggregates()
+        rebuilt_at = summary.get("rebuilt_at")
+        if not rebuilt_at:
+            # Another worker holds the rebuild lease and had not finished within the wait
+            return MongoJSONResponse({"message": "Dashboard rebuild in progress"}, status_code=202)
+        return {"message": "Dashboard aggregates rebuilt", "rebuilt_at": rebuilt_at.isoformat()}
+    except Exception as e:
+        logging.error(f"Error rebuilding dashboard aggregates: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error rebuilding dashboard aggregates: {str(e)}")
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -330,17 +373,62 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def reconcile_db_indexes():
+    await reconcile_indexes()
+    await enable_slow_query_profiling()
+
+@app.on_event("startup")
+async def start_background_jobs():
+    start_overdue_sweeper()
+    start_cache_invalidation()
+    await start_pdf_pool()
+    await start_pdf_cache()
+
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    await stop_overdue_sweeper()
+    await stop_cache_invalidation()
+    await stop_pdf_pool()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
 
 
 # =============================
-# Settings persistence endpoints
+# Database administration endpoints
 # =============================
 
-SETTINGS_DOC_ID = "system_settings"
+@api_router.get("/admin/indexes")
+async def get_index_report(slow_query_limit: int = Query(50, ge=0, le=1000), collection: Optional[str] = None):
+    """Compare declared indexes with the database and report index usage plus recent unindexed slow queries"""
+    try:
+        if collection and collection not in INDEX_SPECS:
+            raise HTTPException(status_code=404, detail=f"No index specs for collection {collection}")
+        report = await index_report(collection)
+        slow_queries = await unindexed_slow_queries(slow_query_limit, collection) if slow_query_limit else []
+        return {
+            "collections": report,
+            "slow_query_ms": SLOW_QUERY_MS,
+            "slow_queries": slow_queries
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error building index report: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error building index report: {str(e)}")
+
 
+@api_router.get("/admin/cache")
+async def get_cache_stats():
+    """Document cache size and hit/miss counters per collection, plus the PDF cache, for this worker"""
+    return {**document_cache.stats(), "invalidation": invalidation_status(), "pdf": pdf_cache_stats()}
+
+
+# =============================
+# Settings persistence endpoints
+# =============================
 
 class SettingsPayload(BaseModel):
     general: Dict[str, Any]
@@ -418,26 +506,27 @@ DEFAULT_SETTINGS: SettingsPayload = SettingsPayload(
 )
 
 
+def set_settings_headers(response: Response, snapshot: SettingsSnapshot) -> None:
+    response.headers["ETag"] = snapshot.etag
+    # Clients may keep the body but must revalidate it on every poll
+    response.headers["Cache-Control"] = "no-cache"
+
+
 @api_router.get("/settings", response_model=SettingsPayload)
-async def get_settings():
-    doc = await db.settings.find_one({"_id": SETTINGS_DOC_ID})
-    if not doc:
-        # Seed default settings
-        payload = DEFAULT_SETTINGS.dict()
-        await db.settings.replace_one(
-            {"_id": SETTINGS_DOC_ID}, {"_id": SETTINGS_DOC_ID, **payload}, upsert=True
-        )
-        return DEFAULT_SETTINGS
-    # remove _id before constructing model
-    doc.pop("_id", None)
-    return SettingsPayload(**doc)
+async def get_settings(response: Response, if_none_match: Optional[str] = Header(None)):
+    snapshot = await get_settings_snapshot(DEFAULT_SETTINGS.dict())
+    if etag_matches(if_none_match, snapshot.etag):
+        not_modified = Response(status_code=304)
+        set_settings_headers(not_modified, snapshot)
+        return not_modified
+    set_settings_headers(response, snapshot)
+    return SettingsPayload(**snapshot.settings)
 
 
 @api_router.put("/settings", response_model=SettingsPayload)
-async def put_settings(payload: SettingsPayload):
-    await db.settings.replace_one(
-        {"_id": SETTINGS_DOC_ID}, {"_id": SETTINGS_DOC_ID, **payload.dict()}, upsert=True
-    )
+async def put_settings(payload: SettingsPayload, response: Response):
+    snapshot = await save_settings(payload.dict())
+    set_settings_headers(response, snapshot)
     return payload
 
 
@@ -458,108 +547,131 @@ async def restore_settings():
     latest = await db.settings_backups.find().sort("createdAt", -1).limit(1).to_list(1)
     if not latest:
         raise HTTPException(status_code=404, detail="No backups found")
-    settings_doc = latest[0]["settings"]
-    # Ensure correct _id
-    settings_doc["_id"] = SETTINGS_DOC_ID
-    await db.settings.replace_one({"_id": SETTINGS_DOC_ID}, settings_doc, upsert=True)
+    await save_settings(latest[0]["settings"])
     return {"message": "Settings restored", "restored_at": datetime.utcnow()}
 
 
+# =============================
+# PDF Bundle Endpoints
+# =============================
+
+# Registered before the /{id} routes, which would otherwise match /sales-invoices/pdf-bundle
+@api_router.get("/{document_type}/pdf-bundle")
+async def download_pdf_bundle(
+    document_type: str,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    ids: Optional[str] = None
+):
+    """Stream a ZIP with the PDF of every selected document.
+
+    Select by inclusive date range, by comma-separated ids, or both. The
+    X-Job-Id header names the job whose progress /pdf-bundles/{job_id} reports.
+    """
+    source = PDF_SOURCES.get(document_type)
+    if not source:
+        raise HTTPException(status_code=404, detail=f"No PDFs for {document_type}")
+    query = bundle_query(source, date_from, date_to, [i.strip() for i in ids.split(",") if i.strip()] if ids else None)
+    try:
+        # Settings first, so a failure here does not leave a job stuck as running
+        settings = await get_settings_snapshot(DEFAULT_SETTINGS.dict())
+        job = await create_bundle_job(document_type, query)
+    except BundleTooLarge as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logging.error(f"Error starting PDF bundle for {document_type}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error starting PDF bundle: {str(e)}")
+
+    filename = f"{source.filename_prefix}s_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.zip"
+    return StreamingResponse(
+        log_stream_errors(bundle_zip(source, query, settings, job["id"]), source.collection),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "X-Job-Id": job["id"]}
+    )
+
+
+@api_router.get("/pdf-bundles/{job_id}")
+async def get_pdf_bundle_job(job_id: str):
+    """Progress of a PDF bundle: status (running, completed, cancelled or failed), total, done and failed"""
+    try:
+        job = await get_bundle_job(job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="PDF bundle job not found")
+        return job
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error fetching PDF bundle job: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error fetching PDF bundle job: {str(e)}")
+
+
 # =============================
 # Fast Input Support Endpoints
 # =============================
 
 @api_router.get("/customers/search")
-async def search_customers(q: str = ""):
+async def search_customers(q: str = "", limit: int = Query(10, ge=1, le=50)):
     """Search customers for autocomplete"""
     if not q:
         return []
     
     try:
-        # Search in database using regex (case insensitive)
-        from bson.regex import Regex
-        filter_dict = {
-            "$or": [
-                {"name": Regex(q, "i")},
-                {"email": Regex(q, "i")}
-            ]
-        }
-        customers_data = await get_documents("customers", filter_dict, limit=10)
+        customers_data = await autocomplete("customers", q, limit, ["name", "email"])
         
         # Format for autocomplete
-        results = []
-        for cust in customers_data:
-            results.append({
+        return [
+            {
                 "id": cust.get("id", ""),
                 "name": cust.get("name", ""),
                 "email": cust.get("email", "")
-            })
-        
-        return results
+            }
+            for cust in customers_data
+        ]
     except Exception as e:
         logging.error(f"Error searching customers: {str(e)}")
         return []
 
 @api_router.get("/products/search")
-async def search_products(q: str = ""):
+async def search_products(q: str = "", limit: int = Query(10, ge=1, le=50)):
     """Search products for autocomplete"""
     if not q:
         return []
     
     try:
-        # Search in database using regex (case insensitive)
-        from bson.regex import Regex
-        filter_dict = {
-            "$or": [
-                {"name": Regex(q, "i")},
-                {"sku": Regex(q, "i")}
-            ]
-        }
-        products_data = await get_documents("products", filter_dict, limit=10)
+        products_data = await autocomplete("products", q, limit, ["name", "sku", "price"])
         
         # Format for autocomplete
-        results = []
-        for prod in products_data:
-            results.append({
+        return [
+            {
                 "id": prod.get("id", ""),
                 "name": prod.get("name", ""),
                 "sku": prod.get("sku", ""),
                 "price": prod.get("price", 0)
-            })
-        
-        return results
+            }
+            for prod in products_data
+        ]
     except Exception as e:
         logging.error(f"Error searching products: {str(e)}")
         return []
 
 @api_router.get("/vendors/search")
-async def search_vendors(q: str = ""):
+async def search_vendors(q: str = "", limit: int = Query(10, ge=1, le=50)):
     """Search vendors for autocomplete"""
     if not q:
         return []
     
     try:
-        # Search in database using regex (case insensitive)
-        from bson.regex import Regex
-        filter_dict = {
-            "$or": [
-                {"name": Regex(q, "i")},
-                {"email": Regex(q, "i")},
-                {"contact_person": Regex(q, "i")}
-            ]
-        }
-        vendors_data = await get_documents("vendors", filter_dict, limit=10)
+        vendors_data = await autocomplete("vendors", q, limit, ["name", "email", "contact_person"])
         
         # Format for autocomplete
-        results = []
-        for vend in vendors_data:
-            results.append({
+        return [
+            {
                 "id": vend.get("id", ""),
                 "name": vend.get("name", ""),
                 "contact": vend.get("email", "") or vend.get("contact_person", "")
-            })
-        
-        return results
+            }
+            for vend in vendors_data
+        ]
     except Exception as e:
         logging.error(f"Error searching vendors: {str(e)}")
         return []
@@ -618,36 +730,55 @@ async def get_product_by_id(product_id: str):
 
 # Customer Endpoints
 @api_router.get("/customers", response_model=List[Customer])
-async def get_customers():
-    """Get all customers"""
+async def get_customers(response: Response, page: Dict = Depends(list_params),
+                        status: Optional[str] = None,
+                        customer_type: Optional[str] = Query(None, alias="type"),
+                        city: Optional[str] = None):
+    """Get customers, one page at a time"""
     try:
-        customers_data = await get_documents("customers", sort=[("created_at", -1)])
-        
-        # Convert to Customer model format
-        customers = []
-        for cust in customers_data:
-            customers.append({
-                "id": cust.get("id", ""),
-                "name": cust.get("name", ""),
-                "contact_person": cust.get("contact_person", ""),
-                "email": cust.get("email", ""),
-                "phone": cust.get("phone", ""),
-                "address": cust.get("address", ""),
-                "city": cust.get("city", ""),
-                "type": cust.get("type", "Corporate"),
-                "status": cust.get("status", "Active"),
-                "credit_limit": cust.get("credit_limit", 0),
-                "total_purchases": cust.get("total_purchases", 0),
-                "last_purchase": cust.get("last_purchase"),
-                "created_at": cust.get("created_at", datetime.utcnow()).isoformat() if isinstance(cust.get("created_at"), datetime) else cust.get("created_at", "")
-            })
+        customers_data = await fetch_page(
+            "customers", page, response,
+            filter_dict=build_filter(status=status, type=customer_type, city=city),
+            projection=list(Customer.model_fields)
+        )
         
-        return customers
+        return documents_response(customers_data, response, {
+            "name": "",
+            "contact_person": "",
+            "email": "",
+            "phone": "",
+            "address": "",
+            "city": "",
+            "type": "Corporate",
+            "status": "Active",
+            "credit_limit": 0,
+            "total_purchases": 0,
+            "last_purchase": None,
+            "created_at": "",
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching customers: {str(e)}")
         # Fallback to empty list on error
         return []
 
+def customer_document(customer: CustomerCreate) -> Dict[str, Any]:
+    """New customer document, shared by create_customer and the bulk import"""
+    return {
+        "name": customer.name,
+        "contact_person": customer.contact_person,
+        "email": customer.email,
+        "phone": customer.phone,
+        "address": customer.address,
+        "city": customer.city,
+        "type": customer.type,
+        "status": "Active",
+        "credit_limit": customer.credit_limit,
+        "total_purchases": 0,
+        "last_purchase": None
+    }
+
 @api_router.post("/customers", response_model=Customer)
 async def create_customer(customer: CustomerCreate):
     """Create a new customer"""
@@ -658,22 +789,10 @@ async def create_customer(customer: CustomerCreate):
             raise HTTPException(status_code=400, detail="Customer with this email already exists")
         
         # Prepare customer data
-        customer_data = {
-            "name": customer.name,
-            "contact_person": customer.contact_person,
-            "email": customer.email,
-            "phone": customer.phone,
-            "address": customer.address,
-            "city": customer.city,
-            "type": customer.type,
-            "status": "Active",
-            "credit_limit": customer.credit_limit,
-            "total_purchases": 0,
-            "last_purchase": None
-        }
+        customer_data = customer_document(customer)
         
         # Save to database
-        created_customer = await create_document("customers", customer_data)
+        created_customer = await create_document("customers", with_search_keys("customers", customer_data))
         
         # Return in Customer model format
         return Customer(
@@ -755,7 +874,7 @@ async def update_customer(customer_id: str, customer: CustomerCreate):
         }
         
         # Update in database
-        updated_customer = await update_document("customers", customer_id, update_data)
+        updated_customer = await update_document("customers", customer_id, with_search_keys("customers", update_data))
         if not updated_customer:
             raise HTTPException(status_code=500, detail="Failed to update customer")
         
@@ -814,43 +933,29 @@ async def delete_customer(customer_id: str):
 
 # Sales Invoice Endpoints
 @api_router.get("/sales-invoices", response_model=List[SalesInvoice])
-async def get_sales_invoices():
-    """Get all sales invoices"""
+async def get_sales_invoices(response: Response, page: Dict = Depends(list_params),
+                             status: Optional[str] = None, customer_id: Optional[str] = None):
+    """Get sales invoices, one page at a time"""
     try:
-        invoices_data = await get_documents("sales_invoices", sort=[("created_at", -1)])
-        
-        # Check for overdue invoices
-        today = datetime.utcnow().date()
-        for invoice in invoices_data:
-            if invoice.get("status") == "Pending":
-                due_date_str = invoice.get("due_date", "")
-                if due_date_str:
-                    try:
-                        due_date = datetime.strptime(due_date_str, "%Y-%m-%d").date()
-                        if due_date < today:
-                            # Update status to Overdue
-                            await update_document("sales_invoices", invoice.get("id"), {"status": "Overdue"})
-                            invoice["status"] = "Overdue"
-                    except:
-                        pass
-        
-        # Convert to SalesInvoice model format
-        invoices = []
-        for inv in invoices_data:
-            invoices.append({
-                "id": inv.get("id", ""),
-                "customer_id": inv.get("customer_id", ""),
-                "customer_name": inv.get("customer_name", ""),
-                "invoice_date": inv.get("invoice_date", ""),
-                "due_date": inv.get("due_date", ""),
-                "amount": inv.get("amount", 0.0),
-                "status": inv.get("status", "Draft"),
-                "items": inv.get("items", []),
-                "created_by": inv.get("created_by", ""),
-                "created_at": inv.get("created_at", datetime.utcnow()).isoformat() if isinstance(inv.get("created_at"), datetime) else inv.get("created_at", "")
-            })
+        invoices_data = await fetch_page(
+            "sales_invoices", page, response,
+            filter_dict=build_filter(status=status, customer_id=customer_id),
+            projection=list(SalesInvoice.model_fields)
+        )
         
-        return invoices
+        return documents_response(invoices_data, response, {
+            "customer_id": "",
+            "customer_name": "",
+            "invoice_date": "",
+            "due_date": "",
+            "amount": 0.0,
+            "status": "Draft",
+            "items": [],
+            "created_by": "",
+            "created_at": "",
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching sales invoices: {str(e)}")
         return []
@@ -866,12 +971,14 @@ async def create_sales_invoice(invoice: SalesInvoiceCreate):
         
         # Validate products and calculate total
         total_amount = 0
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many(item.get("product_id") for item in invoice.items)
         for item in invoice.items:
             product_id = item.get("product_id")
             if not product_id:
                 raise HTTPException(status_code=400, detail="Product ID is required for all items")
             
-            product = await get_document("products", product_id)
+            product = await product_loader.load(product_id)
             if not product:
                 raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
             
@@ -889,17 +996,7 @@ async def create_sales_invoice(invoice: SalesInvoiceCreate):
             total_amount += item.get("total", 0)
         
         # Generate invoice number
-        year = datetime.utcnow().year
-        last_invoice = await db.sales_invoices.find_one(
-            {"invoice_number": {"$regex": f"^INV-{year}-"}},
-            sort=[("invoice_number", -1)]
-        )
-        
-        if last_invoice:
-            last_num = int(last_invoice.get("invoice_number", "0").split("-")[-1])
-            invoice_number = f"INV-{year}-{str(last_num + 1).zfill(6)}"
-        else:
-            invoice_number = f"INV-{year}-000001"
+        invoice_number = await next_number("INV")
         
         # Prepare invoice data
         invoice_data = {
@@ -918,6 +1015,7 @@ async def create_sales_invoice(invoice: SalesInvoiceCreate):
         
         # Save to database
         created_invoice = await create_document("sales_invoices", invoice_data)
+        await record_invoice_change("sales_invoices", None, created_invoice)
         
         # Auto-create journal entry if status is not Draft (for future use)
         # This will be implemented when invoice is posted/confirmed
@@ -949,18 +1047,6 @@ async def get_sales_invoice(invoice_id: str):
         if not invoice:
             raise HTTPException(status_code=404, detail="Sales invoice not found")
         
-        # Check if overdue
-        if invoice.get("status") == "Pending":
-            due_date_str = invoice.get("due_date", "")
-            if due_date_str:
-                try:
-                    due_date = datetime.strptime(due_date_str, "%Y-%m-%d").date()
-                    if due_date < datetime.utcnow().date():
-                        await update_document("sales_invoices", invoice_id, {"status": "Overdue"})
-                        invoice["status"] = "Overdue"
-                except:
-                    pass
-        
         # Return in SalesInvoice model format
         return SalesInvoice(
             id=invoice.get("id", ""),
@@ -1000,12 +1086,14 @@ async def update_sales_invoice(invoice_id: str, invoice: SalesInvoiceCreate):
         
         # Validate products and calculate total
         total_amount = 0
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many(item.get("product_id") for item in invoice.items)
         for item in invoice.items:
             product_id = item.get("product_id")
             if not product_id:
                 raise HTTPException(status_code=400, detail="Product ID is required for all items")
             
-            product = await get_document("products", product_id)
+            product = await product_loader.load(product_id)
             if not product:
                 raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
             
@@ -1035,6 +1123,7 @@ async def update_sales_invoice(invoice_id: str, invoice: SalesInvoiceCreate):
         updated_invoice = await update_document("sales_invoices", invoice_id, update_data)
         if not updated_invoice:
             raise HTTPException(status_code=500, detail="Failed to update sales invoice")
+        await record_invoice_change("sales_invoices", existing, updated_invoice)
         
         # Return in SalesInvoice model format
         return SalesInvoice(
@@ -1072,6 +1161,7 @@ async def delete_sales_invoice(invoice_id: str):
         deleted = await delete_document("sales_invoices", invoice_id)
         if not deleted:
             raise HTTPException(status_code=500, detail="Failed to delete sales invoice")
+        await record_invoice_change("sales_invoices", existing, None)
         
         return {"message": "Sales invoice deleted successfully"}
     except HTTPException:
@@ -1112,140 +1202,48 @@ async def update_sales_invoice_status(invoice_id: str, status_data: dict):
         
         # Handle status-specific logic
         update_data = {"status": new_status}
+        postings = []
         
         if new_status == "Pending" and old_status == "Draft":
-            # Post invoice - create journal entry
-            # Find or create Accounts Receivable account
-            ar_account = await find_one_document("chart_of_accounts", {"account_code": "1200"})
-            if not ar_account:
-                # Create default AR account if doesn't exist
-                ar_account_data = {
-                    "account_code": "1200",
-                    "account_name": "Accounts Receivable",
-                    "account_type": "Asset",
-                    "normal_balance": "Debit",
-                    "balance": 0.0,
-                    "status": "Active"
-                }
-                ar_account = await create_document("chart_of_accounts", ar_account_data)
-            
-            # Find or create Sales Revenue account
-            sales_account = await find_one_document("chart_of_accounts", {"account_code": "4000"})
-            if not sales_account:
-                sales_account_data = {
-                    "account_code": "4000",
-                    "account_name": "Sales Revenue",
-                    "account_type": "Revenue",
-                    "normal_balance": "Credit",
-                    "balance": 0.0,
-                    "status": "Active"
-                }
-                sales_account = await create_document("chart_of_accounts", sales_account_data)
-            
-            # Create journal entry
-            year = datetime.utcnow().year
-            last_entry = await db.general_journal.find_one(
-                {"entry_number": {"$regex": f"^JE-{year}-"}},
-                sort=[("entry_number", -1)]
-            )
-            
-            if last_entry:
-                last_num = int(last_entry.get("entry_number", "0").split("-")[-1])
-                entry_number = f"JE-{year}-{str(last_num + 1).zfill(6)}"
-            else:
-                entry_number = f"JE-{year}-000001"
-            
-            journal_entry = {
-                "entry_number": entry_number,
-                "entry_date": invoice.get("invoice_date", datetime.utcnow().strftime("%Y-%m-%d")),
-                "description": f"Sales Invoice {invoice.get('invoice_number', '')}",
-                "debit_account": ar_account.get("id", ""),
-                "credit_account": sales_account.get("id", ""),
-                "debit_amount": invoice.get("amount", 0.0),
-                "credit_amount": invoice.get("amount", 0.0),
-                "reference": invoice_id,
-                "status": "Posted",
-                "created_by": invoice.get("created_by", "")
-            }
-            
-            await create_document("general_journal", journal_entry)
-            
-            # Update account balances
-            await update_document("chart_of_accounts", ar_account.get("id"), {
-                "balance": ar_account.get("balance", 0.0) + invoice.get("amount", 0.0)
-            })
-            await update_document("chart_of_accounts", sales_account.get("id"), {
-                "balance": sales_account.get("balance", 0.0) + invoice.get("amount", 0.0)
-            })
+            # Post invoice: debit Accounts Receivable, credit Sales Revenue
+            postings.append(Posting(
+                debit_code="1200",
+                credit_code="4000",
+                amount=invoice.get("amount", 0.0),
+                description=f"Sales Invoice {invoice.get('invoice_number', '')}",
+                reference=invoice_id,
+                entry_date=invoice.get("invoice_date", datetime.utcnow().strftime("%Y-%m-%d")),
+                created_by=invoice.get("created_by", "")
+            ))
         
         elif new_status == "Paid":
-            # Record payment
+            # Record payment: debit Cash, credit Accounts Receivable
             paid_amount = status_data.get("paid_amount", invoice.get("amount", 0.0))
             update_data["paid_amount"] = paid_amount
-            
+            postings.append(Posting(
+                debit_code="1110",
+                credit_code="1200",
+                amount=paid_amount,
+                description=f"Payment for Invoice {invoice.get('invoice_number', '')}",
+                reference=invoice_id,
+                entry_date=datetime.utcnow().strftime("%Y-%m-%d"),
+                created_by=invoice.get("created_by", "")
+            ))
+        
+        # Post journal entries and update the invoice status together
+        try:
+            await post_journal(postings, GuardedUpdate("sales_invoices", invoice_id, {"status": old_status}, update_data))
+        except LedgerConflict:
+            raise HTTPException(status_code=409, detail="Invoice status was changed by another request")
+        
+        if new_status == "Paid" and invoice.get("customer_id"):
             # Update customer total purchases
-            customer = await get_document("customers", invoice.get("customer_id"))
-            if customer:
-                new_total = customer.get("total_purchases", 0.0) + paid_amount
-                await update_document("customers", customer.get("id"), {
-                    "total_purchases": new_total,
-                    "last_purchase": datetime.utcnow().strftime("%Y-%m-%d")
-                })
-            
-            # Create payment journal entry
-            # Find Cash account
-            cash_account = await find_one_document("chart_of_accounts", {"account_code": "1110"})
-            if not cash_account:
-                cash_account_data = {
-                    "account_code": "1110",
-                    "account_name": "Cash",
-                    "account_type": "Asset",
-                    "normal_balance": "Debit",
-                    "balance": 0.0,
-                    "status": "Active"
-                }
-                cash_account = await create_document("chart_of_accounts", cash_account_data)
-            
-            # Find AR account
-            ar_account = await find_one_document("chart_of_accounts", {"account_code": "1200"})
-            if ar_account:
-                year = datetime.utcnow().year
-                last_entry = await db.general_journal.find_one(
-                    {"entry_number": {"$regex": f"^JE-{year}-"}},
-                    sort=[("entry_number", -1)]
-                )
-                
-                if last_entry:
-                    last_num = int(last_entry.get("entry_number", "0").split("-")[-1])
-                    entry_number = f"JE-{year}-{str(last_num + 1).zfill(6)}"
-                else:
-                    entry_number = f"JE-{year}-000001"
-                
-                payment_entry = {
-                    "entry_number": entry_number,
-                    "entry_date": datetime.utcnow().strftime("%Y-%m-%d"),
-                    "description": f"Payment for Invoice {invoice.get('invoice_number', '')}",
-                    "debit_account": cash_account.get("id", ""),
-                    "credit_account": ar_account.get("id", ""),
-                    "debit_amount": paid_amount,
-                    "credit_amount": paid_amount,
-                    "reference": invoice_id,
-                    "status": "Posted",
-                    "created_by": invoice.get("created_by", "")
-                }
-                
-                await create_document("general_journal", payment_entry)
-                
-                # Update account balances
-                await update_document("chart_of_accounts", cash_account.get("id"), {
-                    "balance": cash_account.get("balance", 0.0) + paid_amount
-                })
-                await update_document("chart_of_accounts", ar_account.get("id"), {
-                    "balance": ar_account.get("balance", 0.0) - paid_amount
-                })
-        
-        # Update invoice status
-        updated_invoice = await update_document("sales_invoices", invoice_id, update_data)
+            await increment_document("customers", invoice.get("customer_id"),
+                                     {"total_purchases": update_data["paid_amount"]},
+                                     {"last_purchase": datetime.utcnow().strftime("%Y-%m-%d")})
+        
+        updated_invoice = await get_document("sales_invoices", invoice_id)
+        await record_invoice_change("sales_invoices", invoice, updated_invoice)
         
         return {
             "message": f"Invoice status updated from {old_status} to {new_status}",
@@ -1264,46 +1262,34 @@ async def update_sales_invoice_status(invoice_id: str, status_data: dict):
 
 # Sales Order Endpoints
 @api_router.get("/sales-orders", response_model=List[SalesOrder])
-async def get_sales_orders():
-    """Get all sales orders"""
-    # Mock data for now - in production, this would come from database
-    orders = [
-        {
-            "id": "SO-001",
-            "order_number": "SO-2024-001",
-            "customer_id": "CUST-001",
-            "customer_name": "PT. ABC Indonesia",
-            "order_date": "2024-01-20",
-            "delivery_date": "2024-01-25",
-            "status": "Confirmed",
-            "total_amount": 45000000,
-            "items": [
-                {"product_id": "PRD-001", "product_name": "Laptop Gaming", "quantity": 2, "unit_price": 15000000, "total": 30000000},
-                {"product_id": "PRD-002", "product_name": "Mouse Wireless", "quantity": 5, "unit_price": 250000, "total": 1250000}
-            ],
-            "created_by": "John Sales",
-            "notes": "Priority delivery required",
-            "created_at": "2024-01-20 10:30:00"
-        },
-        {
-            "id": "SO-002",
-            "order_number": "SO-2024-002",
-            "customer_id": "CUST-002",
-            "customer_name": "CV. XYZ Trading",
-            "order_date": "2024-01-19",
-            "delivery_date": "2024-01-24",
-            "status": "Processing",
-            "total_amount": 28000000,
-            "items": [
-                {"product_id": "PRD-003", "product_name": "Keyboard Mechanical", "quantity": 10, "unit_price": 1200000, "total": 12000000},
-                {"product_id": "PRD-004", "product_name": "Monitor 27\"", "quantity": 8, "unit_price": 2000000, "total": 16000000}
-            ],
-            "created_by": "Jane Sales",
-            "notes": "Standard delivery",
-            "created_at": "2024-01-19 14:15:00"
-        }
-    ]
-    return orders
+async def get_sales_orders(response: Response, page: Dict = Depends(list_params),
+                           status: Optional[str] = None, customer_id: Optional[str] = None):
+    """Get sales orders, one page at a time"""
+    try:
+        orders_data = await fetch_page(
+            "sales_orders", page, response,
+            filter_dict=build_filter(status=status, customer_id=customer_id),
+            projection=list(SalesOrder.model_fields)
+        )
+        
+        return documents_response(orders_data, response, {
+            "order_number": "",
+            "customer_id": "",
+            "customer_name": "",
+            "order_date": "",
+            "delivery_date": "",
+            "status": "Draft",
+            "total_amount": 0.0,
+            "items": [],
+            "created_by": "",
+            "notes": "",
+            "created_at": "",
+        })
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error fetching sales orders: {str(e)}")
+        return []
 
 @api_router.post("/sales-orders", response_model=SalesOrder)
 async def create_sales_order(order: SalesOrderCreate):
@@ -1316,6 +1302,8 @@ async def create_sales_order(order: SalesOrderCreate):
         
         # Validate products and check stock
         total_amount = 0
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many(item.get("product_id") for item in order.items)
         for item in order.items:
             product_id = item.get("product_id")
             quantity = item.get("quantity", 0)
@@ -1324,7 +1312,7 @@ async def create_sales_order(order: SalesOrderCreate):
                 raise HTTPException(status_code=400, detail="Product ID is required for all items")
             
             # Get product details
-            product = await get_document("products", product_id)
+            product = await product_loader.load(product_id)
             if not product:
                 raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
             
@@ -1348,17 +1336,7 @@ async def create_sales_order(order: SalesOrderCreate):
             total_amount += item.get("total", 0)
         
         # Generate order number
-        year = datetime.utcnow().year
-        last_order = await db.sales_orders.find_one(
-            {"order_number": {"$regex": f"^SO-{year}-"}},
-            sort=[("order_number", -1)]
-        )
-        
-        if last_order:
-            last_num = int(last_order.get("order_number", "0").split("-")[-1])
-            order_number = f"SO-{year}-{str(last_num + 1).zfill(6)}"
-        else:
-            order_number = f"SO-{year}-000001"
+        order_number = await next_number("SO")
         
         # Prepare order data
         order_data = {
@@ -1447,12 +1425,14 @@ async def update_sales_order(order_id: str, order: SalesOrderCreate):
         
         # Validate products and calculate total
         total_amount = 0
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many(item.get("product_id") for item in order.items)
         for item in order.items:
             product_id = item.get("product_id")
             if not product_id:
                 raise HTTPException(status_code=400, detail="Product ID is required for all items")
             
-            product = await get_document("products", product_id)
+            product = await product_loader.load(product_id)
             if not product:
                 raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
             
@@ -1536,41 +1516,32 @@ async def update_sales_order_status(order_id: str, status_data: dict):
             )
         
         # Handle stock updates
+        items = order.get("items", [])
+        product_loader = DocumentLoader("products")
+        products = await product_loader.load_many(item.get("product_id") for item in items)
+        movements = []
         if new_status == "Confirmed" and old_status == "Draft":
             # Reserve stock (decrease available stock)
-            for item in order.get("items", []):
+            for item in items:
                 product_id = item.get("product_id")
-                quantity = item.get("quantity", 0)
-                
-                product = await get_document("products", product_id)
-                if not product:
+                if product_id not in products:
                     raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
-                
-                current_stock = product.get("stock", 0)
-                if current_stock < quantity:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Insufficient stock for {product.get('name', product_id)}. Available: {current_stock}, Required: {quantity}"
-                    )
-                
-                # Update stock
-                new_stock = current_stock - quantity
-                await update_document("products", product_id, {"stock": new_stock})
+                movements.append(StockMovement(product_id, -item.get("quantity", 0),
+                                               products[product_id].get("name", ""), "Sales order confirmed"))
         
         elif new_status == "Cancelled" and old_status in ["Confirmed", "Processing"]:
             # Restore stock (increase available stock)
-            for item in order.get("items", []):
+            for item in items:
                 product_id = item.get("product_id")
-                quantity = item.get("quantity", 0)
-                
-                product = await get_document("products", product_id)
-                if product:
-                    current_stock = product.get("stock", 0)
-                    new_stock = current_stock + quantity
-                    await update_document("products", product_id, {"stock": new_stock})
+                if product_id in products:
+                    movements.append(StockMovement(product_id, item.get("quantity", 0),
+                                                   products[product_id].get("name", ""), "Sales order cancelled"))
         
-        # Update order status
-        updated_order = await update_document("sales_orders", order_id, {"status": new_status})
+        # Apply stock movements and update order status together
+        await apply_order_stock_movements(
+            movements, "sales_order", order, GuardedUpdate("sales_orders", order_id, {"status": old_status}, {"status": new_status})
+        )
+        updated_order = await get_document("sales_orders", order_id)
         
         return {
             "message": f"Order status updated from {old_status} to {new_status}",
@@ -1616,10 +1587,15 @@ async def delete_sales_order(order_id: str):
 
 # Quotation Endpoints
 @api_router.get("/quotations", response_model=List[Quotation])
-async def get_quotations():
-    """Get all quotations"""
+async def get_quotations(response: Response, page: Dict = Depends(list_params),
+                         status: Optional[str] = None, customer_id: Optional[str] = None):
+    """Get quotations, one page at a time"""
     try:
-        quotations_data = await get_documents("quotations", sort=[("created_at", -1)])
+        quotations_data = await fetch_page(
+            "quotations", page, response,
+            filter_dict=build_filter(status=status, customer_id=customer_id),
+            projection=list(Quotation.model_fields)
+        )
         
         # Check for expired quotations
         today = datetime.utcnow().date()
@@ -1636,27 +1612,23 @@ async def get_quotations():
                     except:
                         pass
         
-        # Convert to Quotation model format
-        quotations = []
-        for quo in quotations_data:
-            quotations.append({
-                "id": quo.get("id", ""),
-                "quotation_number": quo.get("quotation_number", ""),
-                "customer_id": quo.get("customer_id", ""),
-                "customer_name": quo.get("customer_name", ""),
-                "quotation_date": quo.get("quotation_date", ""),
-                "valid_until": quo.get("valid_until", ""),
-                "status": quo.get("status", "Draft"),
-                "total_amount": quo.get("total_amount", 0.0),
-                "items": quo.get("items", []),
-                "created_by": quo.get("created_by", ""),
-                "notes": quo.get("notes", ""),
-                "created_at": quo.get("created_at", datetime.utcnow()).isoformat() if isinstance(quo.get("created_at"), datetime) else quo.get("created_at", ""),
-                "sent_date": quo.get("sent_date"),
-                "accepted_date": quo.get("accepted_date")
-            })
-        
-        return quotations
+        return documents_response(quotations_data, response, {
+            "quotation_number": "",
+            "customer_id": "",
+            "customer_name": "",
+            "quotation_date": "",
+            "valid_until": "",
+            "status": "Draft",
+            "total_amount": 0.0,
+            "items": [],
+            "created_by": "",
+            "notes": "",
+            "created_at": "",
+            "sent_date": None,
+            "accepted_date": None,
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching quotations: {str(e)}")
         return []
@@ -1672,12 +1644,14 @@ async def create_quotation(quotation: QuotationCreate):
         
         # Validate products and calculate total
         total_amount = 0
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many(item.get("product_id") for item in quotation.items)
         for item in quotation.items:
             product_id = item.get("product_id")
             if not product_id:
                 raise HTTPException(status_code=400, detail="Product ID is required for all items")
             
-            product = await get_document("products", product_id)
+            product = await product_loader.load(product_id)
             if not product:
                 raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
             
@@ -1695,17 +1669,7 @@ async def create_quotation(quotation: QuotationCreate):
             total_amount += item.get("total", 0)
         
         # Generate quotation number
-        year = datetime.utcnow().year
-        last_quotation = await db.quotations.find_one(
-            {"quotation_number": {"$regex": f"^QUO-{year}-"}},
-            sort=[("quotation_number", -1)]
-        )
-        
-        if last_quotation:
-            last_num = int(last_quotation.get("quotation_number", "0").split("-")[-1])
-            quotation_number = f"QUO-{year}-{str(last_num + 1).zfill(6)}"
-        else:
-            quotation_number = f"QUO-{year}-000001"
+        quotation_number = await next_number("QUO")
         
         # Prepare quotation data
         quotation_data = {
@@ -1812,12 +1776,14 @@ async def update_quotation(quotation_id: str, quotation: QuotationCreate):
         
         # Validate products and calculate total
         total_amount = 0
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many(item.get("product_id") for item in quotation.items)
         for item in quotation.items:
             product_id = item.get("product_id")
             if not product_id:
                 raise HTTPException(status_code=400, detail="Product ID is required for all items")
             
-            product = await get_document("products", product_id)
+            product = await product_loader.load(product_id)
             if not product:
                 raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
             
@@ -2022,94 +1988,51 @@ async def delete_quotation(quotation_id: str):
         raise HTTPException(status_code=500, detail=f"Error deleting quotation: {str(e)}")
 
 # PDF Generation Endpoints
-pdf_generator = PDFGenerator()
 
-@api_router.get("/sales-invoices/{invoice_id}/pdf")
-async def generate_invoice_pdf(invoice_id: str):
-    """Generate PDF for sales invoice"""
+def pdf_queue_full(e: PdfQueueFull) -> HTTPException:
+    """503 telling the client to retry once the rendering queue drains"""
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(PDF_RETRY_AFTER)})
+
+def pdf_response(pdf: bytes, filename: str) -> Response:
+    """The rendered document as a download; Content-Length comes from the body"""
+    return Response(
+        content=pdf,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+async def document_pdf(document_type: str, doc_id: str) -> Response:
+    """The stored document with its party, products and company settings as a PDF download"""
+    source = PDF_SOURCES[document_type]
     try:
-        # Get invoice data (mock for now)
-        invoice_data = {
-            "id": invoice_id,
-            "customer_id": "CUST-001",
-            "customer_name": "PT. ABC Indonesia",
-            "invoice_date": "2024-01-20",
-            "due_date": "2024-02-19",
-            "amount": 15000000,
-            "status": "Paid",
-            "items": [
-                {"product_id": "PRD-001", "product_name": "Laptop Gaming", "quantity": 1, "unit_price": 15000000, "total": 15000000}
-            ]
-        }
-        
-        # Create temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            pdf_path = pdf_generator.generate_invoice_pdf(invoice_data, tmp_file.name)
-            
-            # Return file path for download
-            return {"pdf_path": pdf_path, "filename": f"invoice_{invoice_id}.pdf"}
+        doc = await load_pdf_document(source, doc_id)
+        if not doc:
+            raise HTTPException(status_code=404, detail="Document not found")
+        settings = await get_settings_snapshot(DEFAULT_SETTINGS.dict())
+        pdf = await render_stored(source, doc, settings)
+        return pdf_response(pdf, f"{source.filename_prefix}_{doc_id}.pdf")
+    except HTTPException:
+        raise
+    except PdfQueueFull as e:
+        raise pdf_queue_full(e)
     except Exception as e:
+        logging.error(f"Error generating PDF for {source.collection} {doc_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error generating PDF: {str(e)}")
 
+@api_router.get("/sales-invoices/{invoice_id}/pdf")
+async def generate_invoice_pdf(invoice_id: str):
+    """Generate PDF for sales invoice"""
+    return await document_pdf("sales-invoices", invoice_id)
+
 @api_router.get("/sales-orders/{order_id}/pdf")
 async def generate_order_pdf(order_id: str):
     """Generate PDF for sales order"""
-    try:
-        # Get order data (mock for now)
-        order_data = {
-            "id": order_id,
-            "order_number": "SO-2024-001",
-            "customer_id": "CUST-001",
-            "customer_name": "PT. ABC Indonesia",
-            "order_date": "2024-01-20",
-            "delivery_date": "2024-01-25",
-            "status": "Confirmed",
-            "total_amount": 45000000,
-            "items": [
-                {"product_id": "PRD-001", "product_name": "Laptop Gaming", "quantity": 2, "unit_price": 15000000, "total": 30000000},
-                {"product_id": "PRD-002", "product_name": "Mouse Wireless", "quantity": 5, "unit_price": 250000, "total": 1250000}
-            ],
-            "notes": "Priority delivery required"
-        }
-        
-        # Create temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            pdf_path = pdf_generator.generate_order_pdf(order_data, tmp_file.name)
-            
-            # Return file path for download
-            return {"pdf_path": pdf_path, "filename": f"order_{order_id}.pdf"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating PDF: {str(e)}")
+    return await document_pdf("sales-orders", order_id)
 
 @api_router.get("/quotations/{quotation_id}/pdf")
 async def generate_quotation_pdf(quotation_id: str):
     """Generate PDF for quotation"""
-    try:
-        # Get quotation data (mock for now)
-        quotation_data = {
-            "id": quotation_id,
-            "quotation_number": "QUO-2024-001",
-            "customer_id": "CUST-001",
-            "customer_name": "PT. ABC Indonesia",
-            "quotation_date": "2024-01-20",
-            "valid_until": "2024-02-20",
-            "status": "Sent",
-            "total_amount": 45000000,
-            "items": [
-                {"product_id": "PRD-001", "product_name": "Laptop Gaming", "quantity": 2, "unit_price": 15000000, "total": 30000000},
-                {"product_id": "PRD-002", "product_name": "Mouse Wireless", "quantity": 5, "unit_price": 250000, "total": 1250000}
-            ],
-            "notes": "Valid for 30 days"
-        }
-        
-        # Create temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            pdf_path = pdf_generator.generate_quotation_pdf(quotation_data, tmp_file.name)
-            
-            # Return file path for download
-            return {"pdf_path": pdf_path, "filename": f"quotation_{quotation_id}.pdf"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating PDF: {str(e)}")
+    return await document_pdf("quotations", quotation_id)
 
 # =============================
 # Purchase Module Models
@@ -2223,32 +2146,46 @@ class ProductCreate(BaseModel):
 
 # Vendor Endpoints
 @api_router.get("/vendors", response_model=List[Vendor])
-async def get_vendors():
-    """Get all vendors"""
+async def get_vendors(response: Response, page: Dict = Depends(list_params),
+                      status: Optional[str] = None, city: Optional[str] = None):
+    """Get vendors, one page at a time"""
     try:
-        vendors_data = await get_documents("vendors", sort=[("created_at", -1)])
-        
-        # Convert to Vendor model format
-        vendors = []
-        for vend in vendors_data:
-            vendors.append({
-                "id": vend.get("id", ""),
-                "name": vend.get("name", ""),
-                "contact_person": vend.get("contact_person", ""),
-                "email": vend.get("email", ""),
-                "phone": vend.get("phone", ""),
-                "address": vend.get("address", ""),
-                "city": vend.get("city", ""),
-                "status": vend.get("status", "Active"),
-                "created_at": vend.get("created_at", datetime.utcnow()).isoformat() if isinstance(vend.get("created_at"), datetime) else vend.get("created_at", "")
-            })
+        vendors_data = await fetch_page(
+            "vendors", page, response,
+            filter_dict=build_filter(status=status, city=city),
+            projection=list(Vendor.model_fields)
+        )
         
-        return vendors
+        return documents_response(vendors_data, response, {
+            "name": "",
+            "contact_person": "",
+            "email": "",
+            "phone": "",
+            "address": "",
+            "city": "",
+            "status": "Active",
+            "created_at": "",
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching vendors: {str(e)}")
         return []
 
 
+def vendor_document(vendor: VendorCreate) -> Dict[str, Any]:
+    """New vendor document, shared by create_vendor and the bulk import"""
+    return {
+        "name": vendor.name,
+        "contact_person": vendor.contact_person,
+        "email": vendor.email,
+        "phone": vendor.phone,
+        "address": vendor.address,
+        "city": vendor.city,
+        "status": "Active"
+    }
+
+
 @api_router.post("/vendors", response_model=Vendor)
 async def create_vendor(vendor: VendorCreate):
     """Create a new vendor"""
@@ -2260,18 +2197,10 @@ async def create_vendor(vendor: VendorCreate):
                 raise HTTPException(status_code=400, detail="Vendor with this email already exists")
         
         # Prepare vendor data
-        vendor_data = {
-            "name": vendor.name,
-            "contact_person": vendor.contact_person,
-            "email": vendor.email,
-            "phone": vendor.phone,
-            "address": vendor.address,
-            "city": vendor.city,
-            "status": "Active"
-        }
+        vendor_data = vendor_document(vendor)
         
         # Save to database
-        created_vendor = await create_document("vendors", vendor_data)
+        created_vendor = await create_document("vendors", with_search_keys("vendors", vendor_data))
         
         # Return in Vendor model format
         return Vendor(
@@ -2345,7 +2274,7 @@ async def update_vendor(vendor_id: str, vendor: VendorCreate):
         }
         
         # Update in database
-        updated_vendor = await update_document("vendors", vendor_id, update_data)
+        updated_vendor = await update_document("vendors", vendor_id, with_search_keys("vendors", update_data))
         if not updated_vendor:
             raise HTTPException(status_code=500, detail="Failed to update vendor")
         
@@ -2402,43 +2331,30 @@ async def delete_vendor(vendor_id: str):
 
 # Purchase Invoice Endpoints
 @api_router.get("/purchase-invoices", response_model=List[PurchaseInvoice])
-async def get_purchase_invoices():
-    """Get all purchase invoices"""
+async def get_purchase_invoices(response: Response, page: Dict = Depends(list_params),
+                                status: Optional[str] = None, vendor_id: Optional[str] = None):
+    """Get purchase invoices, one page at a time"""
     try:
-        invoices_data = await get_documents("purchase_invoices", sort=[("created_at", -1)])
-        
-        # Check for overdue invoices
-        today = datetime.utcnow().date()
-        for invoice in invoices_data:
-            if invoice.get("status") == "Pending":
-                due_date_str = invoice.get("due_date", "")
-                if due_date_str:
-                    try:
-                        due_date = datetime.strptime(due_date_str, "%Y-%m-%d").date()
-                        if due_date < today:
-                            await update_document("purchase_invoices", invoice.get("id"), {"status": "Overdue"})
-                            invoice["status"] = "Overdue"
-                    except:
-                        pass
-        
-        # Convert to PurchaseInvoice model format
-        invoices = []
-        for inv in invoices_data:
-            invoices.append({
-                "id": inv.get("id", ""),
-                "invoice_number": inv.get("invoice_number", ""),
-                "vendor_id": inv.get("vendor_id", ""),
-                "vendor_name": inv.get("vendor_name", ""),
-                "invoice_date": inv.get("invoice_date", ""),
-                "due_date": inv.get("due_date", ""),
-                "amount": inv.get("amount", 0.0),
-                "paid_amount": inv.get("paid_amount", 0.0),
-                "status": inv.get("status", "Pending"),
-                "description": inv.get("description", ""),
-                "created_at": inv.get("created_at", datetime.utcnow()).isoformat() if isinstance(inv.get("created_at"), datetime) else inv.get("created_at", "")
-            })
+        invoices_data = await fetch_page(
+            "purchase_invoices", page, response,
+            filter_dict=build_filter(status=status, vendor_id=vendor_id),
+            projection=list(PurchaseInvoice.model_fields)
+        )
         
-        return invoices
+        return documents_response(invoices_data, response, {
+            "invoice_number": "",
+            "vendor_id": "",
+            "vendor_name": "",
+            "invoice_date": "",
+            "due_date": "",
+            "amount": 0.0,
+            "paid_amount": 0.0,
+            "status": "Pending",
+            "description": "",
+            "created_at": "",
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching purchase invoices: {str(e)}")
         return []
@@ -2456,17 +2372,7 @@ async def create_purchase_invoice(pi: PurchaseInvoiceCreate):
         # Generate invoice number if not provided
         invoice_number = pi.invoice_number
         if not invoice_number:
-            year = datetime.utcnow().year
-            last_invoice = await db.purchase_invoices.find_one(
-                {"invoice_number": {"$regex": f"^PINV-{year}-"}},
-                sort=[("invoice_number", -1)]
-            )
-            
-            if last_invoice:
-                last_num = int(last_invoice.get("invoice_number", "0").split("-")[-1])
-                invoice_number = f"PINV-{year}-{str(last_num + 1).zfill(6)}"
-            else:
-                invoice_number = f"PINV-{year}-000001"
+            invoice_number = await next_number("PINV")
         
         # Prepare invoice data
         invoice_data = {
@@ -2483,6 +2389,7 @@ async def create_purchase_invoice(pi: PurchaseInvoiceCreate):
         
         # Save to database
         created_invoice = await create_document("purchase_invoices", invoice_data)
+        await record_invoice_change("purchase_invoices", None, created_invoice)
         
         # Return in PurchaseInvoice model format
         return PurchaseInvoice(
@@ -2513,18 +2420,6 @@ async def get_purchase_invoice(invoice_id: str):
         if not invoice:
             raise HTTPException(status_code=404, detail="Purchase invoice not found")
         
-        # Check if overdue
-        if invoice.get("status") == "Pending":
-            due_date_str = invoice.get("due_date", "")
-            if due_date_str:
-                try:
-                    due_date = datetime.strptime(due_date_str, "%Y-%m-%d").date()
-                    if due_date < datetime.utcnow().date():
-                        await update_document("purchase_invoices", invoice_id, {"status": "Overdue"})
-                        invoice["status"] = "Overdue"
-                except:
-                    pass
-        
         # Return in PurchaseInvoice model format
         return PurchaseInvoice(
             id=invoice.get("id", ""),
@@ -2580,6 +2475,7 @@ async def update_purchase_invoice(invoice_id: str, pi: PurchaseInvoiceCreate):
         updated_invoice = await update_document("purchase_invoices", invoice_id, update_data)
         if not updated_invoice:
             raise HTTPException(status_code=500, detail="Failed to update purchase invoice")
+        await record_invoice_change("purchase_invoices", existing, updated_invoice)
         
         # Return in PurchaseInvoice model format
         return PurchaseInvoice(
@@ -2619,6 +2515,7 @@ async def delete_purchase_invoice(invoice_id: str):
         deleted = await delete_document("purchase_invoices", invoice_id)
         if not deleted:
             raise HTTPException(status_code=500, detail="Failed to delete purchase invoice")
+        await record_invoice_change("purchase_invoices", existing, None)
         
         return {"message": "Purchase invoice deleted successfully"}
     except HTTPException:
@@ -2658,130 +2555,40 @@ async def update_purchase_invoice_status(invoice_id: str, status_data: dict):
         
         # Handle status-specific logic
         update_data = {"status": new_status}
+        postings = []
         
         if new_status == "Pending" and old_status != "Pending":
-            # Post invoice - create journal entry
-            # Find or create Accounts Payable account
-            ap_account = await find_one_document("chart_of_accounts", {"account_code": "2100"})
-            if not ap_account:
-                ap_account_data = {
-                    "account_code": "2100",
-                    "account_name": "Accounts Payable",
-                    "account_type": "Liability",
-                    "normal_balance": "Credit",
-                    "balance": 0.0,
-                    "status": "Active"
-                }
-                ap_account = await create_document("chart_of_accounts", ap_account_data)
-            
-            # Find or create Purchase/Expense account
-            expense_account = await find_one_document("chart_of_accounts", {"account_code": "5100"})
-            if not expense_account:
-                expense_account_data = {
-                    "account_code": "5100",
-                    "account_name": "Purchase Expense",
-                    "account_type": "Expense",
-                    "normal_balance": "Debit",
-                    "balance": 0.0,
-                    "status": "Active"
-                }
-                expense_account = await create_document("chart_of_accounts", expense_account_data)
-            
-            # Create journal entry
-            year = datetime.utcnow().year
-            last_entry = await db.general_journal.find_one(
-                {"entry_number": {"$regex": f"^JE-{year}-"}},
-                sort=[("entry_number", -1)]
-            )
-            
-            if last_entry:
-                last_num = int(last_entry.get("entry_number", "0").split("-")[-1])
-                entry_number = f"JE-{year}-{str(last_num + 1).zfill(6)}"
-            else:
-                entry_number = f"JE-{year}-000001"
-            
-            journal_entry = {
-                "entry_number": entry_number,
-                "entry_date": invoice.get("invoice_date", datetime.utcnow().strftime("%Y-%m-%d")),
-                "description": f"Purchase Invoice {invoice.get('invoice_number', '')}",
-                "debit_account": expense_account.get("id", ""),
-                "credit_account": ap_account.get("id", ""),
-                "debit_amount": invoice.get("amount", 0.0),
-                "credit_amount": invoice.get("amount", 0.0),
-                "reference": invoice_id,
-                "status": "Posted",
-                "created_by": "System"
-            }
-            
-            await create_document("general_journal", journal_entry)
-            
-            # Update account balances
-            await update_document("chart_of_accounts", expense_account.get("id"), {
-                "balance": expense_account.get("balance", 0.0) + invoice.get("amount", 0.0)
-            })
-            await update_document("chart_of_accounts", ap_account.get("id"), {
-                "balance": ap_account.get("balance", 0.0) + invoice.get("amount", 0.0)
-            })
+            # Post invoice: debit Purchase Expense, credit Accounts Payable
+            postings.append(Posting(
+                debit_code="5100",
+                credit_code="2100",
+                amount=invoice.get("amount", 0.0),
+                description=f"Purchase Invoice {invoice.get('invoice_number', '')}",
+                reference=invoice_id,
+                entry_date=invoice.get("invoice_date", datetime.utcnow().strftime("%Y-%m-%d"))
+            ))
         
         elif new_status == "Paid":
-            # Record payment
+            # Record payment: debit Accounts Payable, credit Cash
             paid_amount = status_data.get("paid_amount", invoice.get("amount", 0.0))
             update_data["paid_amount"] = paid_amount
-            
-            # Create payment journal entry
-            # Find Cash account
-            cash_account = await find_one_document("chart_of_accounts", {"account_code": "1110"})
-            if not cash_account:
-                cash_account_data = {
-                    "account_code": "1110",
-                    "account_name": "Cash",
-                    "account_type": "Asset",
-                    "normal_balance": "Debit",
-                    "balance": 0.0,
-                    "status": "Active"
-                }
-                cash_account = await create_document("chart_of_accounts", cash_account_data)
-            
-            # Find AP account
-            ap_account = await find_one_document("chart_of_accounts", {"account_code": "2100"})
-            if ap_account:
-                year = datetime.utcnow().year
-                last_entry = await db.general_journal.find_one(
-                    {"entry_number": {"$regex": f"^JE-{year}-"}},
-                    sort=[("entry_number", -1)]
-                )
-                
-                if last_entry:
-                    last_num = int(last_entry.get("entry_number", "0").split("-")[-1])
-                    entry_number = f"JE-{year}-{str(last_num + 1).zfill(6)}"
-                else:
-                    entry_number = f"JE-{year}-000001"
-                
-                payment_entry = {
-                    "entry_number": entry_number,
-                    "entry_date": datetime.utcnow().strftime("%Y-%m-%d"),
-                    "description": f"Payment for Purchase Invoice {invoice.get('invoice_number', '')}",
-                    "debit_account": ap_account.get("id", ""),
-                    "credit_account": cash_account.get("id", ""),
-                    "debit_amount": paid_amount,
-                    "credit_amount": paid_amount,
-                    "reference": invoice_id,
-                    "status": "Posted",
-                    "created_by": "System"
-                }
-                
-                await create_document("general_journal", payment_entry)
-                
-                # Update account balances
-                await update_document("chart_of_accounts", ap_account.get("id"), {
-                    "balance": ap_account.get("balance", 0.0) - paid_amount
-                })
-                await update_document("chart_of_accounts", cash_account.get("id"), {
-                    "balance": cash_account.get("balance", 0.0) - paid_amount
-                })
-        
-        # Update invoice status
-        updated_invoice = await update_document("purchase_invoices", invoice_id, update_data)
+            postings.append(Posting(
+                debit_code="2100",
+                credit_code="1110",
+                amount=paid_amount,
+                description=f"Payment for Purchase Invoice {invoice.get('invoice_number', '')}",
+                reference=invoice_id,
+                entry_date=datetime.utcnow().strftime("%Y-%m-%d")
+            ))
+        
+        # Post journal entries and update the invoice status together
+        try:
+            await post_journal(postings, GuardedUpdate("purchase_invoices", invoice_id, {"status": old_status}, update_data))
+        except LedgerConflict:
+            raise HTTPException(status_code=409, detail="Invoice status was changed by another request")
+        
+        updated_invoice = await get_document("purchase_invoices", invoice_id)
+        await record_invoice_change("purchase_invoices", invoice, updated_invoice)
         
         return {
             "message": f"Invoice status updated from {old_status} to {new_status}",
@@ -2801,52 +2608,37 @@ async def update_purchase_invoice_status(invoice_id: str, status_data: dict):
 
 @api_router.get("/purchase-invoices/{invoice_id}/pdf")
 async def generate_purchase_invoice_pdf(invoice_id: str):
-    try:
-        invoice_data = {
-            "id": invoice_id,
-            "customer_id": "VEND-001",  # reuse field in pdf format
-            "customer_name": "PT. Supplier ABC",
-            "invoice_date": "2024-01-15",
-            "due_date": "2024-02-15",
-            "amount": 25000000,
-            "status": "Pending",
-            "items": [
-                {"product_id": "PRD-010", "product_name": "Bahan Baku A", "quantity": 10, "unit_price": 1000000, "total": 10000000}
-            ],
-        }
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            pdf_path = pdf_generator.generate_invoice_pdf(invoice_data, tmp_file.name)
-            return {"pdf_path": pdf_path, "filename": f"purchase_invoice_{invoice_id}.pdf"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating PDF: {str(e)}")
+    """Generate PDF for purchase invoice"""
+    return await document_pdf("purchase-invoices", invoice_id)
 
 
 # Purchase Order Endpoints
 @api_router.get("/purchase-orders", response_model=List[PurchaseOrder])
-async def get_purchase_orders():
-    """Get all purchase orders"""
+async def get_purchase_orders(response: Response, page: Dict = Depends(list_params),
+                              status: Optional[str] = None, vendor_id: Optional[str] = None):
+    """Get purchase orders, one page at a time"""
     try:
-        orders_data = await get_documents("purchase_orders", sort=[("created_at", -1)])
-        
-        # Convert to PurchaseOrder model format
-        orders = []
-        for order in orders_data:
-            orders.append({
-                "id": order.get("id", ""),
-                "order_number": order.get("order_number", ""),
-                "vendor_id": order.get("vendor_id", ""),
-                "vendor_name": order.get("vendor_name", ""),
-                "order_date": order.get("order_date", ""),
-                "delivery_date": order.get("delivery_date", ""),
-                "status": order.get("status", "Draft"),
-                "total_amount": order.get("total_amount", 0.0),
-                "items": order.get("items", []),
-                "created_by": order.get("created_by", ""),
-                "notes": order.get("notes", ""),
-                "created_at": order.get("created_at", datetime.utcnow()).isoformat() if isinstance(order.get("created_at"), datetime) else order.get("created_at", "")
-            })
+        orders_data = await fetch_page(
+            "purchase_orders", page, response,
+            filter_dict=build_filter(status=status, vendor_id=vendor_id),
+            projection=list(PurchaseOrder.model_fields)
+        )
         
-        return orders
+        return documents_response(orders_data, response, {
+            "order_number": "",
+            "vendor_id": "",
+            "vendor_name": "",
+            "order_date": "",
+            "delivery_date": "",
+            "status": "Draft",
+            "total_amount": 0.0,
+            "items": [],
+            "created_by": "",
+            "notes": "",
+            "created_at": "",
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching purchase orders: {str(e)}")
         return []
@@ -2863,6 +2655,8 @@ async def create_purchase_order(order: PurchaseOrderCreate):
         
         # Validate products and calculate total
         total_amount = 0
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many(item.get("product_id") for item in order.items)
         for item in order.items:
             product_id = item.get("product_id")
             quantity = item.get("quantity", 0)
@@ -2871,7 +2665,7 @@ async def create_purchase_order(order: PurchaseOrderCreate):
                 raise HTTPException(status_code=400, detail="Product ID is required for all items")
             
             # Get product details (or create if doesn't exist for purchase)
-            product = await get_document("products", product_id)
+            product = await product_loader.load(product_id)
             if not product:
                 # For purchase orders, we might be buying new products
                 # So we'll allow it but log a warning
@@ -2890,17 +2684,7 @@ async def create_purchase_order(order: PurchaseOrderCreate):
             total_amount += item.get("total", 0)
         
         # Generate order number
-        year = datetime.utcnow().year
-        last_order = await db.purchase_orders.find_one(
-            {"order_number": {"$regex": f"^PO-{year}-"}},
-            sort=[("order_number", -1)]
-        )
-        
-        if last_order:
-            last_num = int(last_order.get("order_number", "0").split("-")[-1])
-            order_number = f"PO-{year}-{str(last_num + 1).zfill(6)}"
-        else:
-            order_number = f"PO-{year}-000001"
+        order_number = await next_number("PO")
         
         # Prepare order data
         order_data = {
@@ -2991,12 +2775,14 @@ async def update_purchase_order(order_id: str, order: PurchaseOrderCreate):
         
         # Validate products and calculate total
         total_amount = 0
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many(item.get("product_id") for item in order.items)
         for item in order.items:
             product_id = item.get("product_id")
             if not product_id:
                 raise HTTPException(status_code=400, detail="Product ID is required for all items")
             
-            product = await get_document("products", product_id)
+            product = await product_loader.load(product_id)
             if not product:
                 logging.warning(f"Product {product_id} not found, but allowing purchase order update")
             
@@ -3108,21 +2894,21 @@ async def update_purchase_order_status(order_id: str, status_data: dict):
             )
         
         # Handle stock updates
+        movements = []
+        created_product_ids = []
         if new_status == "Received" and old_status in ["Confirmed", "Processing"]:
             # Receive goods - increase stock
-            for item in order.get("items", []):
+            items = order.get("items", [])
+            product_loader = DocumentLoader("products")
+            products = await product_loader.load_many(item.get("product_id") for item in items)
+            for item in items:
                 product_id = item.get("product_id")
                 quantity = item.get("quantity", 0)
                 
                 if product_id:
-                    product = await get_document("products", product_id)
-                    if product:
-                        # Update stock
-                        current_stock = product.get("stock", 0)
-                        new_stock = current_stock + quantity
-                        await update_document("products", product_id, {"stock": new_stock})
-                    else:
-                        # Product doesn't exist - create it from purchase order
+                    product = products.get(product_id)
+                    if not product:
+                        # Product doesn't exist - create it from purchase order, stock arrives with the movement
                         product_data = {
                             "name": item.get("product_name", f"Product {product_id}"),
                             "sku": f"SKU-{product_id}",
@@ -3130,20 +2916,35 @@ async def update_purchase_order_status(order_id: str, status_data: dict):
                             "category": "Purchased",
                             "price": item.get("unit_price", 0) * 1.2,  # Add 20% margin
                             "cost": item.get("unit_price", 0),
-                            "stock": quantity,
+                            "stock": 0,
                             "min_stock": 0,
                             "max_stock": 1000,
                             "status": "Active"
                         }
-                        new_product = await create_document("products", product_data)
-                        logging.info(f"Created new product {new_product.get('id')} from purchase order")
+                        product = await create_document("products", with_search_keys("products", product_data))
+                        products[product_id] = product
+                        created_product_ids.append(product.get("id"))
+                        logging.info(f"Created new product {product.get('id')} from purchase order")
+                    movements.append(StockMovement(product.get("id"), quantity, product.get("name", ""), "Purchase order received"))
         
         elif new_status == "Cancelled" and old_status in ["Confirmed", "Processing"]:
             # Cancel order - no stock change needed (stock only increases on Received)
             pass
         
-        # Update order status
-        updated_order = await update_document("purchase_orders", order_id, {"status": new_status})
+        # Apply stock movements and update order status together
+        try:
+            await apply_order_stock_movements(
+                movements, "purchase_order", order, GuardedUpdate("purchase_orders", order_id, {"status": old_status}, {"status": new_status})
+            )
+        except Exception:
+            # Nothing was received, so the products created for it go too
+            for product_id in created_product_ids:
+                try:
+                    await delete_document("products", product_id)
+                except Exception as e:
+                    logging.error(f"Error removing product {product_id} created for purchase order {order_id}: {str(e)}")
+            raise
+        updated_order = await get_document("purchase_orders", order_id)
         
         return {
             "message": f"Order status updated from {old_status} to {new_status}",
@@ -3162,26 +2963,8 @@ async def update_purchase_order_status(order_id: str, status_data: dict):
 
 @api_router.get("/purchase-orders/{order_id}/pdf")
 async def generate_purchase_order_pdf(order_id: str):
-    try:
-        order_data = {
-            "id": order_id,
-            "order_number": "PO-2024-001",
-            "customer_id": "VEND-001",  # reuse pdf field
-            "customer_name": "PT. Supplier ABC",
-            "order_date": "2024-01-10",
-            "delivery_date": "2024-01-20",
-            "status": "Confirmed",
-            "total_amount": 41000000,
-            "items": [
-                {"product_id": "PRD-010", "product_name": "Bahan Baku A", "quantity": 10, "unit_price": 1000000, "total": 10000000}
-            ],
-            "notes": "Urgent",
-        }
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            pdf_path = pdf_generator.generate_order_pdf(order_data, tmp_file.name)
-            return {"pdf_path": pdf_path, "filename": f"purchase_order_{order_id}.pdf"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating PDF: {str(e)}")
+    """Generate PDF for purchase order"""
+    return await document_pdf("purchase-orders", order_id)
 
 
 # =============================
@@ -3189,35 +2972,52 @@ async def generate_purchase_order_pdf(order_id: str):
 # =============================
 
 @api_router.get("/products", response_model=List[Product])
-async def get_products():
-    """Get all products"""
+async def get_products(response: Response, page: Dict = Depends(list_params),
+                       status: Optional[str] = None, category: Optional[str] = None):
+    """Get products, one page at a time"""
     try:
-        products_data = await get_documents("products", sort=[("created_at", -1)])
-        
-        # Convert to Product model format
-        products = []
-        for prod in products_data:
-            products.append({
-                "id": prod.get("id", ""),
-                "name": prod.get("name", ""),
-                "sku": prod.get("sku", ""),
-                "description": prod.get("description", ""),
-                "category": prod.get("category", ""),
-                "price": prod.get("price", 0.0),
-                "cost": prod.get("cost", 0.0),
-                "stock": prod.get("stock", 0),
-                "min_stock": prod.get("min_stock", 0),
-                "max_stock": prod.get("max_stock", 0),
-                "status": prod.get("status", "Active"),
-                "created_at": prod.get("created_at", datetime.utcnow()).isoformat() if isinstance(prod.get("created_at"), datetime) else prod.get("created_at", "")
-            })
+        products_data = await fetch_page(
+            "products", page, response,
+            filter_dict=build_filter(status=status, category=category),
+            projection=list(Product.model_fields)
+        )
         
-        return products
+        return documents_response(products_data, response, {
+            "name": "",
+            "sku": "",
+            "description": "",
+            "category": "",
+            "price": 0.0,
+            "cost": 0.0,
+            "stock": 0,
+            "min_stock": 0,
+            "max_stock": 0,
+            "status": "Active",
+            "created_at": "",
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching products: {str(e)}")
         return []
 
 
+def product_document(product: ProductCreate) -> Dict[str, Any]:
+    """New product document, shared by create_product and the bulk import"""
+    return {
+        "name": product.name,
+        "sku": product.sku,
+        "description": product.description,
+        "category": product.category,
+        "price": product.price,
+        "cost": product.cost,
+        "stock": product.stock,
+        "min_stock": product.min_stock,
+        "max_stock": product.max_stock,
+        "status": "Active"
+    }
+
+
 @api_router.post("/products", response_model=Product)
 async def create_product(product: ProductCreate):
     """Create a new product"""
@@ -3228,21 +3028,10 @@ async def create_product(product: ProductCreate):
             raise HTTPException(status_code=400, detail="Product with this SKU already exists")
         
         # Prepare product data
-        product_data = {
-            "name": product.name,
-            "sku": product.sku,
-            "description": product.description,
-            "category": product.category,
-            "price": product.price,
-            "cost": product.cost,
-            "stock": product.stock,
-            "min_stock": product.min_stock,
-            "max_stock": product.max_stock,
-            "status": "Active"
-        }
+        product_data = product_document(product)
         
         # Save to database
-        created_product = await create_document("products", product_data)
+        created_product = await create_document("products", with_search_keys("products", product_data))
         
         # Return in Product model format
         return Product(
@@ -3325,7 +3114,7 @@ async def update_product(product_id: str, product: ProductCreate):
         }
         
         # Update in database
-        updated_product = await update_document("products", product_id, update_data)
+        updated_product = await update_document("products", product_id, with_search_keys("products", update_data))
         if not updated_product:
             raise HTTPException(status_code=500, detail="Failed to update product")
         
@@ -3415,10 +3204,15 @@ class StockOpnameCreate(BaseModel):
 # =============================
 
 @api_router.get("/stock-opnames", response_model=List[StockOpname])
-async def get_stock_opnames():
-    """Get all stock opnames"""
+async def get_stock_opnames(response: Response, page: Dict = Depends(list_params),
+                            status: Optional[str] = None, warehouse: Optional[str] = None):
+    """Get stock opnames, one page at a time"""
     try:
-        opnames_data = await get_documents("stock_opnames", sort=[("created_at", -1)])
+        opnames_data = await fetch_page(
+            "stock_opnames", page, response,
+            filter_dict=build_filter(status=status, warehouse=warehouse),
+            projection=list(StockOpname.model_fields)
+        )
         
         # Convert to StockOpname model format
         opnames = []
@@ -3440,6 +3234,8 @@ async def get_stock_opnames():
             })
         
         return opnames
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching stock opnames: {str(e)}")
         return []
@@ -3455,12 +3251,14 @@ async def create_stock_opname(opname: StockOpnameCreate):
         discrepancies = 0
         variance_value = 0.0
         
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many(item.get("product_id") for item in opname.items)
         for item in opname.items:
             product_id = item.get("product_id")
             if not product_id:
                 raise HTTPException(status_code=400, detail="Product ID is required for all items")
             
-            product = await get_document("products", product_id)
+            product = await product_loader.load(product_id)
             if not product:
                 raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
             
@@ -3488,17 +3286,7 @@ async def create_stock_opname(opname: StockOpnameCreate):
                 variance_value += item["variance_value"]
         
         # Generate opname number
-        year = datetime.utcnow().year
-        last_opname = await db.stock_opnames.find_one(
-            {"opname_number": {"$regex": f"^OPN-{year}-"}},
-            sort=[("opname_number", -1)]
-        )
-        
-        if last_opname:
-            last_num = int(last_opname.get("opname_number", "0").split("-")[-1])
-            opname_number = f"OPN-{year}-{str(last_num + 1).zfill(6)}"
-        else:
-            opname_number = f"OPN-{year}-000001"
+        opname_number = await next_number("OPN")
         
         # Prepare opname data
         opname_data = {
@@ -3591,12 +3379,14 @@ async def update_stock_opname(opname_id: str, opname: StockOpnameCreate):
         discrepancies = 0
         variance_value = 0.0
         
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many(item.get("product_id") for item in opname.items)
         for item in opname.items:
             product_id = item.get("product_id")
             if not product_id:
                 raise HTTPException(status_code=400, detail="Product ID is required for all items")
             
-            product = await get_document("products", product_id)
+            product = await product_loader.load(product_id)
             if not product:
                 raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
             
@@ -3696,21 +3486,23 @@ async def complete_stock_opname(opname_id: str):
         if opname.get("status") == "Completed":
             raise HTTPException(status_code=400, detail="Stock opname already completed")
         
-        # Adjust stock for each item with variance
-        for item in opname.get("items", []):
-            product_id = item.get("product_id")
-            variance = item.get("variance", 0)
-            
-            if variance != 0 and product_id:
-                product = await get_document("products", product_id)
-                if product:
-                    current_stock = product.get("stock", 0)
-                    new_stock = current_stock + variance  # variance can be positive or negative
-                    await update_document("products", product_id, {"stock": new_stock})
-                    logging.info(f"Adjusted stock for {product.get('name', product_id)}: {current_stock} -> {new_stock}")
+        # Adjust stock for each item with variance (variance can be positive or negative)
+        items = opname.get("items", [])
+        product_loader = DocumentLoader("products")
+        products = await product_loader.load_many(item.get("product_id") for item in items)
+        movements = [
+            StockMovement(item.get("product_id"), item.get("variance", 0),
+                          products[item.get("product_id")].get("name", ""), "Stock opname adjustment")
+            for item in items
+            if item.get("variance", 0) != 0 and item.get("product_id") in products
+        ]
         
-        # Update opname status to Completed
-        updated_opname = await update_document("stock_opnames", opname_id, {"status": "Completed"})
+        # Apply adjustments and mark the opname Completed together
+        await apply_order_stock_movements(
+            movements, "stock_opname", opname,
+            GuardedUpdate("stock_opnames", opname_id, {"status": opname.get("status")}, {"status": "Completed"})
+        )
+        updated_opname = await get_document("stock_opnames", opname_id)
         
         return {
             "message": "Stock opname completed and stock adjusted",
@@ -3764,10 +3556,15 @@ class StockTransferCreate(BaseModel):
 # =============================
 
 @api_router.get("/stock-transfers", response_model=List[StockTransfer])
-async def get_stock_transfers():
-    """Get all stock transfers"""
+async def get_stock_transfers(response: Response, page: Dict = Depends(list_params),
+                              status: Optional[str] = None):
+    """Get stock transfers, one page at a time"""
     try:
-        transfers_data = await get_documents("stock_transfers", sort=[("created_at", -1)])
+        transfers_data = await fetch_page(
+            "stock_transfers", page, response,
+            filter_dict=build_filter(status=status),
+            projection=list(StockTransfer.model_fields)
+        )
         
         # Convert to StockTransfer model format
         transfers = []
@@ -3790,6 +3587,8 @@ async def get_stock_transfers():
             })
         
         return transfers
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching stock transfers: {str(e)}")
         return []
@@ -3801,6 +3600,8 @@ async def create_stock_transfer(transfer: StockTransferCreate):
     try:
         # Validate products and check stock availability
         total_value = 0.0
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many(item.get("product_id") for item in transfer.items)
         for item in transfer.items:
             product_id = item.get("product_id")
             quantity = item.get("quantity", 0)
@@ -3811,7 +3612,7 @@ async def create_stock_transfer(transfer: StockTransferCreate):
             if quantity <= 0:
                 raise HTTPException(status_code=400, detail="Quantity must be greater than 0")
             
-            product = await get_document("products", product_id)
+            product = await product_loader.load(product_id)
             if not product:
                 raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
             
@@ -3834,17 +3635,7 @@ async def create_stock_transfer(transfer: StockTransferCreate):
                 item["product_name"] = product.get("name", "")
         
         # Generate transfer number
-        year = datetime.utcnow().year
-        last_transfer = await db.stock_transfers.find_one(
-            {"transfer_number": {"$regex": f"^STR-{year}-"}},
-            sort=[("transfer_number", -1)]
-        )
-        
-        if last_transfer:
-            last_num = int(last_transfer.get("transfer_number", "0").split("-")[-1])
-            transfer_number = f"STR-{year}-{str(last_num + 1).zfill(6)}"
-        else:
-            transfer_number = f"STR-{year}-000001"
+        transfer_number = await next_number("STR")
         
         # Prepare transfer data
         transfer_data = {
@@ -3936,6 +3727,8 @@ async def update_stock_transfer(transfer_id: str, transfer: StockTransferCreate)
         
         # Validate products and check stock
         total_value = 0.0
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many(item.get("product_id") for item in transfer.items)
         for item in transfer.items:
             product_id = item.get("product_id")
             quantity = item.get("quantity", 0)
@@ -3946,7 +3739,7 @@ async def update_stock_transfer(transfer_id: str, transfer: StockTransferCreate)
             if quantity <= 0:
                 raise HTTPException(status_code=400, detail="Quantity must be greater than 0")
             
-            product = await get_document("products", product_id)
+            product = await product_loader.load(product_id)
             if not product:
                 raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
             
@@ -4054,30 +3847,25 @@ async def complete_stock_transfer(transfer_id: str):
         if transfer.get("status") == "Completed":
             raise HTTPException(status_code=400, detail="Stock transfer already completed")
         
-        # Update stock for each item
-        for item in transfer.get("items", []):
-            product_id = item.get("product_id")
-            quantity = item.get("quantity", 0)
-            
-            if product_id and quantity > 0:
-                product = await get_document("products", product_id)
-                if product:
-                    current_stock = product.get("stock", 0)
-                    
-                    # Decrease stock from source warehouse (from_warehouse)
-                    # For now, we use main stock - in future, can implement warehouse-specific stock
-                    if current_stock >= quantity:
-                        new_stock = current_stock - quantity
-                        await update_document("products", product_id, {"stock": new_stock})
-                        logging.info(f"Transferred {quantity} units of {product.get('name', product_id)} from {transfer.get('from_warehouse')} to {transfer.get('to_warehouse')}")
-                    else:
-                        raise HTTPException(
-                            status_code=400,
-                            detail=f"Insufficient stock for product {product.get('name', product_id)}. Available: {current_stock}, Required: {quantity}"
-                        )
-        
-        # Update transfer status to Completed
-        updated_transfer = await update_document("stock_transfers", transfer_id, {"status": "Completed"})
+        # Decrease stock from source warehouse (from_warehouse)
+        # For now, we use main stock - in future, can implement warehouse-specific stock
+        items = transfer.get("items", [])
+        product_loader = DocumentLoader("products")
+        products = await product_loader.load_many(item.get("product_id") for item in items)
+        reason = f"Transfer from {transfer.get('from_warehouse')} to {transfer.get('to_warehouse')}"
+        movements = [
+            StockMovement(item.get("product_id"), -item.get("quantity", 0),
+                          products[item.get("product_id")].get("name", ""), reason)
+            for item in items
+            if item.get("quantity", 0) > 0 and item.get("product_id") in products
+        ]
+        
+        # Apply stock movements and mark the transfer Completed together
+        await apply_order_stock_movements(
+            movements, "stock_transfer", transfer,
+            GuardedUpdate("stock_transfers", transfer_id, {"status": transfer.get("status")}, {"status": "Completed"})
+        )
+        updated_transfer = await get_document("stock_transfers", transfer_id)
         
         return {
             "message": "Stock transfer completed",
@@ -4136,10 +3924,16 @@ class ProductionOrderCreate(BaseModel):
 # =============================
 
 @api_router.get("/production-orders", response_model=List[ProductionOrder])
-async def get_production_orders():
-    """Get all production orders"""
+async def get_production_orders(response: Response, page: Dict = Depends(list_params),
+                                status: Optional[str] = None, product_id: Optional[str] = None,
+                                workstation: Optional[str] = None):
+    """Get production orders, one page at a time"""
     try:
-        orders_data = await get_documents("production_orders", sort=[("created_at", -1)])
+        orders_data = await fetch_page(
+            "production_orders", page, response,
+            filter_dict=build_filter(status=status, product_id=product_id, workstation=workstation),
+            projection=list(ProductionOrder.model_fields)
+        )
         
         # Convert to ProductionOrder model format
         orders = []
@@ -4164,6 +3958,8 @@ async def get_production_orders():
             })
         
         return orders
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching production orders: {str(e)}")
         return []
@@ -4173,8 +3969,10 @@ async def get_production_orders():
 async def create_production_order(order: ProductionOrderCreate):
     """Create a new production order"""
     try:
-        # Validate product exists
-        product = await get_document("products", order.product_id)
+        # Validate product exists (fetched together with every BOM component in one query)
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many([order.product_id] + [bom_item.get("component_id") for bom_item in order.bom])
+        product = await product_loader.load(order.product_id)
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
         
@@ -4190,7 +3988,7 @@ async def create_production_order(order: ProductionOrderCreate):
                 raise HTTPException(status_code=400, detail="Quantity must be greater than 0")
             
             # Get component product
-            component = await get_document("products", component_id)
+            component = await product_loader.load(component_id)
             if not component:
                 raise HTTPException(status_code=404, detail=f"Component {component_id} not found")
             
@@ -4215,17 +4013,7 @@ async def create_production_order(order: ProductionOrderCreate):
                 bom_item["component_name"] = component.get("name", "")
         
         # Generate order number
-        year = datetime.utcnow().year
-        last_order = await db.production_orders.find_one(
-            {"order_number": {"$regex": f"^PROD-{year}-"}},
-            sort=[("order_number", -1)]
-        )
-        
-        if last_order:
-            last_num = int(last_order.get("order_number", "0").split("-")[-1])
-            order_number = f"PROD-{year}-{str(last_num + 1).zfill(6)}"
-        else:
-            order_number = f"PROD-{year}-000001"
+        order_number = await next_number("PROD")
         
         # Prepare order data
         order_data = {
@@ -4321,8 +4109,10 @@ async def update_production_order(order_id: str, order: ProductionOrderCreate):
         if existing.get("status") in ["In Production", "Completed"]:
             raise HTTPException(status_code=400, detail=f"Cannot update order with status: {existing.get('status')}")
         
-        # Validate product
-        product = await get_document("products", order.product_id)
+        # Validate product (fetched together with every BOM component in one query)
+        product_loader = DocumentLoader("products")
+        await product_loader.load_many([order.product_id] + [bom_item.get("component_id") for bom_item in order.bom])
+        product = await product_loader.load(order.product_id)
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
         
@@ -4334,7 +4124,7 @@ async def update_production_order(order_id: str, order: ProductionOrderCreate):
             if not component_id:
                 raise HTTPException(status_code=400, detail="Component ID is required for all BOM items")
             
-            component = await get_document("products", component_id)
+            component = await product_loader.load(component_id)
             if not component:
                 raise HTTPException(status_code=404, detail=f"Component {component_id} not found")
             
@@ -4471,58 +4261,44 @@ async def update_production_order_status(order_id: str, status_data: dict):
         # Handle status-specific logic
         update_data = {"status": new_status}
         
+        # Fetch the finished product and every BOM component in one query
+        bom = order.get("bom", [])
+        product_loader = DocumentLoader("products")
+        products = await product_loader.load_many([order.get("product_id")] + [bom_item.get("component_id") for bom_item in bom])
+        
+        def bom_movements(sign: int, reason: str) -> List[StockMovement]:
+            movements = []
+            for bom_item in bom:
+                component_id = bom_item.get("component_id")
+                total_required = bom_item.get("quantity", 0) * order.get("quantity", 0)
+                if component_id in products and total_required > 0:
+                    movements.append(StockMovement(component_id, sign * total_required,
+                                                   products[component_id].get("name", ""), reason))
+            return movements
+        
+        movements = []
         if new_status == "In Production" and old_status in ["Draft", "Scheduled"]:
             # Start production - consume materials from BOM
-            for bom_item in order.get("bom", []):
-                component_id = bom_item.get("component_id")
-                required_qty_per_unit = bom_item.get("quantity", 0)
-                total_required = required_qty_per_unit * order.get("quantity", 0)
-                
-                if component_id and total_required > 0:
-                    component = await get_document("products", component_id)
-                    if component:
-                        current_stock = component.get("stock", 0)
-                        if current_stock >= total_required:
-                            new_stock = current_stock - total_required
-                            await update_document("products", component_id, {"stock": new_stock})
-                            logging.info(f"Consumed {total_required} units of {component.get('name', component_id)} for production order {order.get('order_number', '')}")
-                        else:
-                            raise HTTPException(
-                                status_code=400,
-                                detail=f"Insufficient stock for component {component.get('name', component_id)}. Available: {current_stock}, Required: {total_required}"
-                            )
+            movements = bom_movements(-1, "Consumed by production")
         
         elif new_status == "Completed" and old_status == "In Production":
             # Complete production - add finished product to stock
             product_id = order.get("product_id")
             completed_qty = status_data.get("completed_quantity", order.get("quantity", 0))
             
-            if product_id and completed_qty > 0:
-                product = await get_document("products", product_id)
-                if product:
-                    current_stock = product.get("stock", 0)
-                    new_stock = current_stock + completed_qty
-                    await update_document("products", product_id, {"stock": new_stock})
-                    update_data["completed_quantity"] = completed_qty
-                    logging.info(f"Added {completed_qty} units of {product.get('name', product_id)} to stock from production order {order.get('order_number', '')}")
+            if product_id in products and completed_qty > 0:
+                movements = [StockMovement(product_id, completed_qty, products[product_id].get("name", ""), "Produced")]
+                update_data["completed_quantity"] = completed_qty
         
         elif new_status == "Cancelled" and old_status == "In Production":
             # Cancel production - return materials to stock
-            for bom_item in order.get("bom", []):
-                component_id = bom_item.get("component_id")
-                required_qty_per_unit = bom_item.get("quantity", 0)
-                total_required = required_qty_per_unit * order.get("quantity", 0)
-                
-                if component_id and total_required > 0:
-                    component = await get_document("products", component_id)
-                    if component:
-                        current_stock = component.get("stock", 0)
-                        new_stock = current_stock + total_required
-                        await update_document("products", component_id, {"stock": new_stock})
-                        logging.info(f"Returned {total_required} units of {component.get('name', component_id)} to stock from cancelled production order")
-        
-        # Update order status
-        updated_order = await update_document("production_orders", order_id, update_data)
+            movements = bom_movements(1, "Returned from cancelled production")
+        
+        # Apply stock movements and update order status together
+        await apply_order_stock_movements(
+            movements, "production_order", order, GuardedUpdate("production_orders", order_id, {"status": old_status}, update_data)
+        )
+        updated_order = await get_document("production_orders", order_id)
         
         return {
             "message": f"Order status updated from {old_status} to {new_status}",
@@ -4544,94 +4320,55 @@ async def update_production_order_status(order_id: str, status_data: dict):
 # Reports Module Endpoints
 # =============================
 
+def report_params(
+    start_date: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    end_date: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    granularity: str = Query("month", pattern="^(day|week|month|year)$")
+) -> Dict[str, Any]:
+    """Shared date-range (YYYY-MM-DD, inclusive) and period granularity parameters"""
+    if start_date and end_date and start_date > end_date:
+        raise HTTPException(status_code=400, detail="start_date must not be after end_date")
+    return {"start_date": start_date, "end_date": end_date, "granularity": granularity}
+
+
 @api_router.get("/reports")
-async def get_reports():
+async def get_reports(params: Dict = Depends(report_params)):
     """Get summary report data"""
-    report_data = {
-        "sales": {
-            "totalRevenue": 194258000.0,
-            "totalOrders": 156,
-            "averageOrderValue": 1245000.0,
-            "growthRate": 12.5
-        },
-        "inventory": {
-            "totalProducts": 1234,
-            "lowStockItems": 23,
-            "outOfStockItems": 5,
-            "totalValue": 4500000000.0
-        },
-        "production": {
-            "totalOrders": 45,
-            "completedOrders": 32,
-            "inProgressOrders": 13,
-            "efficiency": 85.2
-        }
-    }
-    return report_data
+    try:
+        return await summary_report(**params)
+    except Exception as e:
+        logging.error(f"Error building summary report: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error building summary report: {str(e)}")
 
 
 @api_router.get("/reports/sales")
-async def get_sales_report():
+async def get_sales_report(params: Dict = Depends(report_params), top: int = Query(5, ge=1, le=100)):
     """Get detailed sales report"""
-    return {
-        "period": "2024-01",
-        "totalRevenue": 194258000.0,
-        "totalOrders": 156,
-        "averageOrderValue": 1245000.0,
-        "growthRate": 12.5,
-        "topProducts": [
-            {"name": "Laptop Gaming", "revenue": 45000000, "quantity": 30},
-            {"name": "Mouse Wireless", "revenue": 25000000, "quantity": 100},
-            {"name": "Keyboard Mechanical", "revenue": 18000000, "quantity": 15}
-        ],
-        "monthlyData": [
-            {"month": "Jan", "revenue": 194258000},
-            {"month": "Dec", "revenue": 172500000},
-            {"month": "Nov", "revenue": 158000000}
-        ]
-    }
+    try:
+        return await sales_report(top=top, **params)
+    except Exception as e:
+        logging.error(f"Error building sales report: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error building sales report: {str(e)}")
 
 
 @api_router.get("/reports/inventory")
-async def get_inventory_report():
+async def get_inventory_report(category: Optional[str] = None, top: int = Query(5, ge=1, le=100)):
     """Get detailed inventory report"""
-    return {
-        "totalProducts": 1234,
-        "lowStockItems": 23,
-        "outOfStockItems": 5,
-        "totalValue": 4500000000.0,
-        "categoryBreakdown": [
-            {"category": "Elektronik", "count": 456, "value": 2500000000},
-            {"category": "Aksesoris", "count": 678, "value": 1500000000},
-            {"category": "Komputer", "count": 100, "value": 500000000}
-        ],
-        "topProducts": [
-            {"name": "Laptop Gaming", "stock": 25, "value": 375000000},
-            {"name": "Mouse Wireless", "stock": 150, "value": 37500000},
-            {"name": "Keyboard Mechanical", "stock": 45, "value": 54000000}
-        ]
-    }
+    try:
+        return await inventory_report(category=category, top=top)
+    except Exception as e:
+        logging.error(f"Error building inventory report: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error building inventory report: {str(e)}")
 
 
 @api_router.get("/reports/production")
-async def get_production_report():
+async def get_production_report(params: Dict = Depends(report_params)):
     """Get detailed production report"""
-    return {
-        "totalOrders": 45,
-        "completedOrders": 32,
-        "inProgressOrders": 13,
-        "efficiency": 85.2,
-        "workstationStats": [
-            {"workstation": "Assembly Line A", "orders": 20, "efficiency": 90.5},
-            {"workstation": "Assembly Line B", "orders": 15, "efficiency": 82.3},
-            {"workstation": "Quality Control", "orders": 10, "efficiency": 88.7}
-        ],
-        "monthlyData": [
-            {"month": "Jan", "orders": 45, "completed": 32},
-            {"month": "Dec", "orders": 38, "completed": 35},
-            {"month": "Nov", "orders": 42, "completed": 40}
-        ]
-    }
+    try:
+        return await production_report(**params)
+    except Exception as e:
+        logging.error(f"Error building production report: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error building production report: {str(e)}")
 
 
 # =============================
@@ -4767,10 +4504,15 @@ class UserCreate(BaseModel):
 # =============================
 
 @api_router.get("/users", response_model=List[User])
-async def get_users():
-    """Get all users"""
+async def get_users(response: Response, page: Dict = Depends(list_params),
+                    status: Optional[str] = None, role: Optional[str] = None):
+    """Get users, one page at a time"""
     try:
-        users_data = await get_documents("users", sort=[("created_at", -1)])
+        users_data = await fetch_page(
+            "users", page, response,
+            filter_dict=build_filter(status=status, role=role),
+            projection=list(User.model_fields)
+        )
         
         # Convert to User model format (exclude password)
         users = []
@@ -4789,6 +4531,8 @@ async def get_users():
             })
         
         return users
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching users: {str(e)}")
         return []
@@ -5350,10 +5094,17 @@ class ChartOfAccountCreate(BaseModel):
 # =============================
 
 @api_router.get("/chart-of-accounts", response_model=List[ChartOfAccount])
-async def get_chart_of_accounts():
-    """Get all chart of accounts"""
+async def get_chart_of_accounts(response: Response, page: Dict = Depends(list_params),
+                                status: Optional[str] = None, account_type: Optional[str] = None):
+    """Get chart of accounts ordered by account code, one page at a time"""
     try:
-        accounts_data = await get_documents("chart_of_accounts", sort=[("account_code", 1)])
+        accounts_data = await fetch_page(
+            "chart_of_accounts", page, response,
+            filter_dict=build_filter(status=status, account_type=account_type),
+            projection=list(ChartOfAccount.model_fields),
+            sort_field="account_code",
+            default_order="asc"
+        )
         
         # Convert to ChartOfAccount model format
         accounts = []
@@ -5372,6 +5123,8 @@ async def get_chart_of_accounts():
             })
         
         return accounts
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching chart of accounts: {str(e)}")
         return []
@@ -5406,6 +5159,7 @@ async def create_chart_of_account(account: ChartOfAccountCreate):
         
         # Save to database
         created_account = await create_document("chart_of_accounts", account_data)
+        forget_accounts()
         
         # Return in ChartOfAccount model format
         return ChartOfAccount(
@@ -5489,6 +5243,7 @@ async def update_chart_of_account(account_id: str, account: ChartOfAccountCreate
         
         # Update in database
         updated_account = await update_document("chart_of_accounts", account_id, update_data)
+        forget_accounts()
         if not updated_account:
             raise HTTPException(status_code=500, detail="Failed to update chart of account")
         
@@ -5544,6 +5299,7 @@ async def delete_chart_of_account(account_id: str):
         
         # Delete from database
         deleted = await delete_document("chart_of_accounts", account_id)
+        forget_accounts()
         if not deleted:
             raise HTTPException(status_code=500, detail="Failed to delete chart of account")
         
@@ -5589,30 +5345,29 @@ class GeneralJournalEntryCreate(BaseModel):
 # =============================
 
 @api_router.get("/general-journal", response_model=List[GeneralJournalEntry])
-async def get_general_journal_entries():
-    """Get all general journal entries"""
+async def get_general_journal_entries(response: Response, page: Dict = Depends(list_params),
+                                      status: Optional[str] = None, reference: Optional[str] = None):
+    """Get general journal entries, one page at a time"""
     try:
-        entries_data = await get_documents("general_journal", sort=[("created_at", -1)])
+        entries_data = await fetch_page(
+            "general_journal", page, response,
+            filter_dict=build_filter(status=status, reference=reference),
+            projection=list(GeneralJournalEntry.model_fields)
+        )
+        
+        # Resolve account names from the cached chart of accounts
+        names = await account_names(
+            [entry.get("debit_account", "") for entry in entries_data] +
+            [entry.get("credit_account", "") for entry in entries_data]
+        )
         
         # Convert to GeneralJournalEntry model format
         entries = []
         for entry in entries_data:
-            # Get account names
             debit_account_id = entry.get("debit_account", "")
             credit_account_id = entry.get("credit_account", "")
-            
-            debit_account_name = ""
-            credit_account_name = ""
-            
-            if debit_account_id:
-                debit_acc = await get_document("chart_of_accounts", debit_account_id)
-                if debit_acc:
-                    debit_account_name = debit_acc.get("account_name", "")
-            
-            if credit_account_id:
-                credit_acc = await get_document("chart_of_accounts", credit_account_id)
-                if credit_acc:
-                    credit_account_name = credit_acc.get("account_name", "")
+            debit_account_name = names.get(debit_account_id, "")
+            credit_account_name = names.get(credit_account_id, "")
             
             entries.append({
                 "id": entry.get("id", ""),
@@ -5630,6 +5385,8 @@ async def get_general_journal_entries():
             })
         
         return entries
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching general journal entries: {str(e)}")
         return []
@@ -5653,17 +5410,7 @@ async def create_general_journal_entry(entry: GeneralJournalEntryCreate):
             raise HTTPException(status_code=404, detail="Credit account not found")
         
         # Generate entry number
-        year = datetime.utcnow().year
-        last_entry = await db.general_journal.find_one(
-            {"entry_number": {"$regex": f"^JE-{year}-"}},
-            sort=[("entry_number", -1)]
-        )
-        
-        if last_entry:
-            last_num = int(last_entry.get("entry_number", "0").split("-")[-1])
-            entry_number = f"JE-{year}-{str(last_num + 1).zfill(6)}"
-        else:
-            entry_number = f"JE-{year}-000001"
+        entry_number = await next_number("JE")
         
         # Prepare entry data
         entry_data = {
@@ -5719,19 +5466,9 @@ async def get_general_journal_entry(entry_id: str):
         # Get account names
         debit_account_id = entry.get("debit_account", "")
         credit_account_id = entry.get("credit_account", "")
-        
-        debit_account_name = ""
-        credit_account_name = ""
-        
-        if debit_account_id:
-            debit_acc = await get_document("chart_of_accounts", debit_account_id)
-            if debit_acc:
-                debit_account_name = debit_acc.get("account_name", "")
-        
-        if credit_account_id:
-            credit_acc = await get_document("chart_of_accounts", credit_account_id)
-            if credit_acc:
-                credit_account_name = credit_acc.get("account_name", "")
+        names = await account_names([debit_account_id, credit_account_id])
+        debit_account_name = names.get(debit_account_id, "")
+        credit_account_name = names.get(credit_account_id, "")
         
         # Return in GeneralJournalEntry model format
         return GeneralJournalEntry(
@@ -6102,6 +5839,196 @@ async def delete_chart_of_account(account_id: str):
     return {"message": "Account deleted"}
 
 
+# =============================
+# Data Export Endpoints
+# =============================
+
+# Collections that may be exported, with the model whose fields are the CSV columns;
+# users, settings and counters are deliberately excluded
+EXPORTABLE_COLLECTIONS: Dict[str, Type[BaseModel]] = {
+    "customers": Customer, "vendors": Vendor, "products": Product,
+    "sales_invoices": SalesInvoice, "sales_orders": SalesOrder, "quotations": Quotation,
+    "purchase_invoices": PurchaseInvoice, "purchase_orders": PurchaseOrder,
+    "stock_opnames": StockOpname, "stock_transfers": StockTransfer, "production_orders": ProductionOrder,
+    "chart_of_accounts": ChartOfAccount, "general_journal": GeneralJournalEntry
+}
+
+# Documents encoded per chunk written to the response
+EXPORT_CHUNK_SIZE = 500
+
+# Trailing CSV column holding, as JSON, the stored fields a collection's model does not declare
+EXPORT_EXTRA_COLUMN = "extra"
+
+
+def export_json_default(value: Any) -> Any:
+    """JSON encoder fallback for values Mongo returns"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    return str(value)
+
+
+def export_csv_value(value: Any) -> Any:
+    """Flatten a document value into a single CSV cell"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=export_json_default)
+    return value
+
+
+async def export_ndjson(docs):
+    """Encode documents as newline-delimited JSON, one chunk per EXPORT_CHUNK_SIZE rows"""
+    lines = []
+    async for doc in docs:
+        lines.append(json.dumps(doc, default=export_json_default))
+        if len(lines) >= EXPORT_CHUNK_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+async def export_csv(docs, columns: List[str], extra_column: bool = False):
+    """Encode documents as CSV under a fixed header; missing fields are left empty.
+
+    With extra_column, fields outside columns (documents written by older
+    versions or imports need not match the model) go into a trailing JSON
+    "extra" column instead of being dropped.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns + ([EXPORT_EXTRA_COLUMN] if extra_column else []),
+                            extrasaction="ignore")
+    writer.writeheader()
+    declared = set(columns)
+    count = 0
+    async for doc in docs:
+        row = {key: export_csv_value(value) for key, value in doc.items() if key in declared}
+        if extra_column:
+            extra = {key: value for key, value in doc.items() if key not in declared}
+            row[EXPORT_EXTRA_COLUMN] = json.dumps(extra, default=export_json_default) if extra else ""
+        writer.writerow(row)
+        count += 1
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+async def log_stream_errors(chunks, collection_name: str):
+    """Log failures that happen after the response has started streaming"""
+    try:
+        async for chunk in chunks:
+            yield chunk
+    except Exception as e:
+        logging.error(f"Error exporting {collection_name}: {str(e)}")
+        raise
+
+
+@api_router.get("/export/{collection}")
+async def export_collection(
+    collection: str,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    fields: Optional[str] = None,
+    status: Optional[str] = None,
+    batch_size: int = Query(1000, ge=1, le=10000)
+):
+    """Stream a whole collection as NDJSON or CSV straight from a database cursor"""
+    collection_name = collection.replace("-", "_")
+    if collection_name not in EXPORTABLE_COLLECTIONS:
+        raise HTTPException(status_code=404, detail=f"Collection {collection} cannot be exported")
+
+    columns = [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+    docs = stream_documents(collection_name, build_filter(status=status), columns, batch_size)
+
+    if format == "csv":
+        if columns:
+            body = export_csv(docs, columns)
+        else:
+            body = export_csv(docs, list(EXPORTABLE_COLLECTIONS[collection_name].model_fields), extra_column=True)
+        media_type = "text/csv"
+    else:
+        body = export_ndjson(docs)
+        media_type = "application/x-ndjson"
+
+    filename = f"{collection_name}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{format}"
+    return StreamingResponse(
+        log_stream_errors(body, collection_name),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@api_router.get("/sync/{collection}")
+async def sync_collection(
+    collection: str,
+    since: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+):
+    """Documents changed since a sync token, plus deletions.
+
+    Follow next_cursor (repeating since) until it is null; the last page holds
+    the deletions and the token to pass as since next time.
+    """
+    collection_name = collection.replace("-", "_")
+    if collection_name not in SYNC_COLLECTIONS:
+        raise HTTPException(status_code=404, detail=f"Collection {collection} cannot be synced")
+    try:
+        return MongoJSONResponse(await sync_page(collection_name, since, cursor, limit))
+    except SyncTokenExpired as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logging.error(f"Error syncing {collection_name}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error syncing {collection_name}: {str(e)}")
+
+
+# =============================
+# Bulk Import Endpoints
+# =============================
+
+# Collection -> create model, document builder and unique key checked per chunk
+IMPORT_SPECS = {
+    "customers": ImportSpec(CustomerCreate, customer_document, "email"),
+    "products": ImportSpec(ProductCreate, product_document, "sku"),
+    "vendors": ImportSpec(VendorCreate, vendor_document, "email"),
+}
+
+
+@api_router.post("/import/{collection}")
+async def import_collection(
+    collection: str,
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, pattern="^(ndjson|csv)$")
+):
+    """Bulk-create documents from a CSV (with header) or NDJSON upload.
+
+    Streams back one NDJSON result per row (created, duplicate, invalid or
+    error) followed by a summary line. The format defaults to the file extension.
+    """
+    spec = IMPORT_SPECS.get(collection)
+    if not spec:
+        raise HTTPException(status_code=404, detail=f"Collection {collection} cannot be imported")
+    format = format or ("csv" if (file.filename or "").lower().endswith(".csv") else "ndjson")
+    # FastAPI closes uploads when the endpoint returns, before the response streams; keep our own handle
+    upload, file.file = file.file, io.BytesIO()
+    rows = csv_rows(upload) if format == "csv" else ndjson_rows(upload)
+
+    async def results():
+        try:
+            async for result in import_rows(collection, spec, rows):
+                yield json.dumps(result) + "\n"
+        finally:
+            upload.close()
+
+    return StreamingResponse(log_stream_errors(results(), collection), media_type="application/x-ndjson")
+
+
 # =============================
 # Authentication Module Endpoints
 # =============================
@@ -0,0 +1,96 @@
+"""
+In-memory snapshot of the system settings document
+
+Every open browser tab polls GET /api/settings. The settings document carries
+a version that each write increments, and each worker serves its latest
+snapshot from memory, answering a matching If-None-Match with 304, so polling
+never reaches the database. Writes through save_settings replace the local
+snapshot; writes from other workers arrive through the cache invalidation
+listener, and SETTINGS_CACHE_TTL bounds staleness when that is switched off.
+"""
+import asyncio
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, NamedTuple, Optional
+
+from pymongo import ReturnDocument
+
+from database import db
+from invalidation import on_change
+
+SETTINGS_COLLECTION = "settings"
+SETTINGS_DOC_ID = "system_settings"
+SETTINGS_SECTIONS = ("general", "database", "email", "notifications", "security", "appearance")
+
+# Seconds a snapshot is served before it is re-read even without an invalidation
+SETTINGS_CACHE_TTL = int(os.environ.get("SETTINGS_CACHE_TTL", "300"))
+
+
+class SettingsSnapshot(NamedTuple):
+    settings: Dict[str, Any]
+    version: int
+    loaded_at: float
+
+    @property
+    def etag(self) -> str:
+        return f'"settings-{self.version}"'
+
+
+_snapshot: Optional[SettingsSnapshot] = None
+_load_lock = asyncio.Lock()
+
+
+def _store(doc: Dict) -> SettingsSnapshot:
+    """Make a document the current snapshot unless a newer version is already held"""
+    global _snapshot
+    snapshot = SettingsSnapshot(
+        {section: doc.get(section, {}) for section in SETTINGS_SECTIONS},
+        int(doc.get("version", 0)),
+        time.monotonic()
+    )
+    if _snapshot is None or snapshot.version >= _snapshot.version:
+        _snapshot = snapshot
+    return snapshot
+
+
+def forget_settings(*_) -> None:
+    """Drop the snapshot so the next read reloads it"""
+    global _snapshot
+    _snapshot = None
+
+
+on_change(SETTINGS_COLLECTION, forget_settings)
+
+
+def _fresh(snapshot: Optional[SettingsSnapshot]) -> bool:
+    return snapshot is not None and time.monotonic() - snapshot.loaded_at < SETTINGS_CACHE_TTL
+
+
+async def get_settings_snapshot(defaults: Dict[str, Any]) -> SettingsSnapshot:
+    """The current settings, seeding defaults on first use"""
+    if _fresh(_snapshot):
+        return _snapshot
+    async with _load_lock:
+        # Concurrent callers wait for one load instead of each reading
+        if _fresh(_snapshot):
+            return _snapshot
+        doc = await db[SETTINGS_COLLECTION].find_one_and_update(
+            {"_id": SETTINGS_DOC_ID},
+            {"$setOnInsert": {**defaults, "version": 1, "updated_at": datetime.utcnow()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return _store(doc)
+
+
+async def save_settings(settings: Dict[str, Any]) -> SettingsSnapshot:
+    """Write the given sections, bump the version and return the new snapshot"""
+    sections = {section: settings[section] for section in SETTINGS_SECTIONS if section in settings}
+    doc = await db[SETTINGS_COLLECTION].find_one_and_update(
+        {"_id": SETTINGS_DOC_ID},
+        {"$set": {**sections, "updated_at": datetime.utcnow()}, "$inc": {"version": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return _store(doc)
@@ -0,0 +1,167 @@
+"""
+Stock movement service
+
+apply_stock_movements changes product stock for every line of a document in
+one bulk_write of conditional $inc updates (a decrement only matches while
+stock covers it), writes one stock_movements row per line and applies the
+document's status change. If any line fails, nothing is kept: inside a
+transaction when the server supports one, otherwise by undoing exactly the
+lines that were applied, which are tagged with the batch id while in flight.
+"""
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+from pymongo import UpdateOne
+
+from cache import document_cache
+from database import bump_change_version, client, db, get_documents_by_ids, id_filter
+from ledger import GuardedUpdate, apply_guard, transactions_supported
+
+PRODUCTS_COLLECTION = "products"
+MOVEMENTS_COLLECTION = "stock_movements"
+
+# Batch ids of movements applied to a product but not yet committed (fallback path only)
+PENDING_FIELD = "pending_stock_movements"
+
+
+class StockMovement(NamedTuple):
+    product_id: str
+    quantity: float  # signed: negative takes stock out
+    product_name: str = ""
+    reason: str = ""
+
+
+class StockShortage(Exception):
+    """A movement would take a product's stock below zero, or the product is gone"""
+
+    def __init__(self, product_id: str, name: str, available: float, required: float):
+        self.product_id = product_id
+        if available is None:
+            message = f"Product {name or product_id} not found"
+        else:
+            message = f"Insufficient stock for {name or product_id}. Available: {available}, Required: {required}"
+        super().__init__(message)
+
+
+def _net_changes(movements: List[StockMovement]) -> Dict[str, float]:
+    """Net quantity per product, so repeated lines become one conditional update"""
+    net: Dict[str, float] = defaultdict(float)
+    for movement in movements:
+        net[movement.product_id] += movement.quantity
+    return {product_id: quantity for product_id, quantity in net.items() if quantity}
+
+
+def _stock_update(product_id: str, quantity: float, extra: Optional[Dict] = None) -> UpdateOne:
+    condition = {"stock": {"$gte": -quantity}} if quantity < 0 else {}
+    update = {"$inc": {"stock": quantity}, "$set": {"updated_at": datetime.utcnow()}, **(extra or {})}
+    return UpdateOne({**id_filter(product_id), **condition}, update)
+
+
+async def _find_shortage(net: Dict[str, float]) -> StockShortage:
+    """Work out which line failed, for the error message"""
+    products = await get_documents_by_ids(PRODUCTS_COLLECTION, net)
+    for product_id, quantity in net.items():
+        product = products.get(product_id)
+        if not product:
+            return StockShortage(product_id, "", None, -quantity)
+        if quantity < 0 and product.get("stock", 0) < -quantity:
+            return StockShortage(product_id, product.get("name", ""), product.get("stock", 0), -quantity)
+    # Stock recovered between the failed write and this read
+    product_id, quantity = next(iter(net.items()))
+    return StockShortage(product_id, "", 0, -quantity)
+
+
+def _movement_rows(movements: List[StockMovement], batch_id: str, reference_type: str,
+                   reference_id: str, reference_number: str) -> List[Dict]:
+    now = datetime.utcnow()
+    return [{
+        "batch_id": batch_id,
+        "product_id": movement.product_id,
+        "product_name": movement.product_name,
+        "quantity": movement.quantity,
+        "reason": movement.reason,
+        "reference_type": reference_type,
+        "reference_id": reference_id,
+        "reference_number": reference_number,
+        "created_at": now
+    } for movement in movements if movement.quantity]
+
+
+async def _apply_in_transaction(net: Dict[str, float], rows: List[Dict],
+                                guard: Optional[GuardedUpdate]) -> None:
+    async with await client.start_session() as session:
+        async def callback(s):
+            await apply_guard(guard, session=s)
+            if net:
+                ops = [_stock_update(product_id, quantity) for product_id, quantity in net.items()]
+                result = await db[PRODUCTS_COLLECTION].bulk_write(ops, ordered=False, session=s)
+                if result.matched_count < len(ops):
+                    # Raising aborts the transaction, undoing every line
+                    raise await _find_shortage(net)
+            if rows:
+                await db[MOVEMENTS_COLLECTION].insert_many([dict(row) for row in rows], session=s)
+        await session.with_transaction(callback)
+
+
+async def _clear_pending_markers(net: Dict[str, float]) -> None:
+    """Remove the pending field from products no other batch is still applying to"""
+    await db[PRODUCTS_COLLECTION].bulk_write([
+        UpdateOne({**id_filter(product_id), PENDING_FIELD: {"$size": 0}}, {"$unset": {PENDING_FIELD: ""}})
+        for product_id in net
+    ], ordered=False)
+
+
+async def _apply_with_compensation(net: Dict[str, float], rows: List[Dict], batch_id: str,
+                                   guard: Optional[GuardedUpdate]) -> None:
+    products = db[PRODUCTS_COLLECTION]
+    await apply_guard(guard)
+    if net:
+        ops = [_stock_update(product_id, quantity, {"$push": {PENDING_FIELD: batch_id}})
+               for product_id, quantity in net.items()]
+        result = await products.bulk_write(ops, ordered=False)
+        if result.matched_count < len(ops):
+            # Undo only the lines that were applied, found by their batch tag
+            await products.bulk_write([
+                UpdateOne({**id_filter(product_id), PENDING_FIELD: batch_id},
+                          {"$inc": {"stock": -quantity}, "$pull": {PENDING_FIELD: batch_id}})
+                for product_id, quantity in net.items()
+            ], ordered=False)
+            await _clear_pending_markers(net)
+            if guard:
+                await db[guard.collection_name].update_one(
+                    {**id_filter(guard.doc_id), **guard.changes}, {"$set": guard.expected}
+                )
+            raise await _find_shortage(net)
+        await products.bulk_write([
+            UpdateOne({**id_filter(product_id), PENDING_FIELD: batch_id}, {"$pull": {PENDING_FIELD: batch_id}})
+            for product_id in net
+        ], ordered=False)
+        await _clear_pending_markers(net)
+    if rows:
+        await db[MOVEMENTS_COLLECTION].insert_many(rows)
+
+
+async def apply_stock_movements(movements: List[StockMovement], reference_type: str, reference_id: str,
+                                reference_number: str = "", guard: Optional[GuardedUpdate] = None) -> str:
+    """Apply all stock movements of a document atomically and return the batch id.
+
+    Raises StockShortage if any product lacks the stock for its decrement (or no
+    longer exists), and LedgerConflict if the guard no longer matches; in both
+    cases no stock, movement row or guarded change is kept.
+    """
+    batch_id = uuid.uuid4().hex
+    net = _net_changes(movements)
+    rows = _movement_rows(movements, batch_id, reference_type, reference_id, reference_number)
+
+    try:
+        if await transactions_supported():
+            await _apply_in_transaction(net, rows, guard)
+        else:
+            await _apply_with_compensation(net, rows, batch_id, guard)
+    finally:
+        for product_id in net:
+            document_cache.invalidate(PRODUCTS_COLLECTION, product_id)
+    await bump_change_version(PRODUCTS_COLLECTION, MOVEMENTS_COLLECTION, *([guard.collection_name] if guard else []))
+    return batch_id
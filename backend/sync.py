@@ -0,0 +1,96 @@
+"""
+Delta sync: documents changed since a token, plus tombstones for deletes
+
+A sync pass starts without a cursor and records the server time as its high
+water mark. It pages through the matching documents in _id order with
+next_cursor; the last page carries the tombstones and the token for the next
+pass. A pass with a token returns documents whose updated_at is at or after
+the previous high water mark minus SYNC_OVERLAP, which covers writes that
+stamped updated_at just before the mark but committed after it, and clock
+skew between hosts. Clients apply documents as upserts, so repeats are
+harmless, and then the deletions.
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from database import (
+    TOMBSTONE_RETENTION_DAYS, TOMBSTONES_COLLECTION, MAX_PAGE_SIZE,
+    convert_objectid_to_str, db, decode_cursor, encode_cursor
+)
+
+# Collections clients may sync; users, settings and counters are deliberately excluded
+SYNC_COLLECTIONS = {
+    "customers", "vendors", "products",
+    "sales_invoices", "sales_orders", "quotations",
+    "purchase_invoices", "purchase_orders",
+    "stock_opnames", "stock_transfers", "production_orders",
+    "chart_of_accounts", "general_journal"
+}
+
+# Seconds re-read before the previous high water mark
+SYNC_OVERLAP = 5
+
+
+class SyncTokenExpired(Exception):
+    """The token predates the tombstone retention window; the client must sync from scratch"""
+
+
+def encode_sync_token(high_water_mark: datetime) -> str:
+    return encode_cursor(high_water_mark, None)
+
+
+def decode_sync_token(token: str) -> datetime:
+    """Raise ValueError if the token is malformed"""
+    high_water_mark, _ = decode_cursor(token)
+    if not isinstance(high_water_mark, datetime):
+        raise ValueError("Invalid sync token")
+    # json_util decodes dates as aware UTC; the rest of the app uses naive UTC
+    return high_water_mark.replace(tzinfo=None)
+
+
+async def _tombstones(collection_name: str, since: datetime) -> List[Dict[str, Any]]:
+    cursor = db[TOMBSTONES_COLLECTION].find(
+        {"collection": collection_name, "deleted_at": {"$gte": since}},
+        {"_id": 0, "doc_id": 1, "deleted_at": 1}
+    ).sort("deleted_at", 1)
+    return [{"id": doc["doc_id"], "deleted_at": doc["deleted_at"]} async for doc in cursor]
+
+
+async def sync_page(collection_name: str, since: Optional[str] = None, cursor: Optional[str] = None,
+                    limit: int = MAX_PAGE_SIZE) -> Dict[str, Any]:
+    """One page of a sync pass.
+
+    Raises ValueError for a malformed token or cursor and SyncTokenExpired when
+    deletes since the token may already have been forgotten.
+    """
+    start = None
+    if since:
+        start = decode_sync_token(since) - timedelta(seconds=SYNC_OVERLAP)
+        if start < datetime.utcnow() - timedelta(days=TOMBSTONE_RETENTION_DAYS):
+            raise SyncTokenExpired("Sync token has expired; sync again without a token")
+
+    if cursor:
+        high_water_mark, last_id = decode_cursor(cursor)
+    else:
+        high_water_mark, last_id = datetime.utcnow(), None
+
+    query: Dict[str, Any] = {}
+    if start:
+        query["updated_at"] = {"$gte": start}
+    if last_id is not None:
+        query["_id"] = {"$gt": last_id}
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    docs = await db[collection_name].find(query).sort("_id", 1).limit(limit + 1).to_list(length=limit + 1)
+
+    result: Dict[str, Any] = {"next_cursor": None, "deleted": [], "token": None}
+    if len(docs) > limit:
+        docs = docs[:limit]
+        result["next_cursor"] = encode_cursor(high_water_mark, docs[-1]["_id"])
+    else:
+        # Last page: a full pass needs no tombstones, since the client starts from nothing
+        if start:
+            result["deleted"] = await _tombstones(collection_name, start)
+        result["token"] = encode_sync_token(high_water_mark)
+    result["documents"] = [convert_objectid_to_str(doc) for doc in docs]
+    return result
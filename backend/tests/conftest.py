@@ -0,0 +1,41 @@
+"""
+Shared fixtures: every service module reads and writes an in-memory
+mongomock-motor database instead of MONGO_URL
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+
+import database  # noqa: E402
+import ledger  # noqa: E402
+import numbering  # noqa: E402
+import stock  # noqa: E402
+import sync  # noqa: E402
+from cache import document_cache  # noqa: E402
+
+# Modules that imported db by name from database
+DB_MODULES = (database, ledger, numbering, stock, sync)
+
+
+@pytest.fixture
+def mock_db(monkeypatch):
+    test_db = AsyncMongoMockClient()["zone_test"]
+    for module in DB_MODULES:
+        monkeypatch.setattr(module, "db", test_db)
+    # mongomock has no multi-document transactions, so the ledger and stock fallbacks run
+    monkeypatch.setattr(ledger, "LEDGER_TRANSACTIONS", "off")
+
+    # Process-local state must not leak from one test's database into the next
+    monkeypatch.setattr(numbering, "_seeded", set())
+    monkeypatch.setattr(numbering, "_blocks", {})
+    monkeypatch.setattr(numbering, "_locks", {})
+    ledger.forget_accounts()
+    document_cache.clear()
+    yield test_db
+    ledger.forget_accounts()
+    document_cache.clear()
@@ -0,0 +1,91 @@
+import asyncio
+from collections import defaultdict
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+import ledger
+from ledger import GuardedUpdate, LedgerConflict, Posting
+
+pytestmark = pytest.mark.asyncio
+
+
+def _posting(debit_code: str, credit_code: str, amount: float) -> Posting:
+    return Posting(debit_code, credit_code, amount, "test", "INV-TEST", "2024-01-01")
+
+
+async def _assert_balanced(mock_db):
+    """Every account balance equals what the journal says, and debits equal credits"""
+    accounts = {str(doc["_id"]): doc async for doc in mock_db.chart_of_accounts.find()}
+    expected = defaultdict(float)
+    debits = credits = 0.0
+    async for entry in mock_db.general_journal.find():
+        debit, credit = accounts[entry["debit_account"]], accounts[entry["credit_account"]]
+        expected[entry["debit_account"]] += ledger.balance_delta(debit, "Debit", entry["debit_amount"])
+        expected[entry["credit_account"]] += ledger.balance_delta(credit, "Credit", entry["credit_amount"])
+        debits += entry["debit_amount"]
+        credits += entry["credit_amount"]
+    assert debits == pytest.approx(credits)
+    for account_id, account in accounts.items():
+        assert account["balance"] == pytest.approx(expected[account_id]), account["account_code"]
+
+
+async def test_concurrent_postings_do_not_drift(mock_db):
+    await asyncio.gather(*(
+        ledger.post_journal([_posting("1200", "4000", 10.0), _posting("1110", "1200", 4.0)])
+        for _ in range(40)
+    ))
+    assert await mock_db.general_journal.count_documents({}) == 80
+    receivable = await mock_db.chart_of_accounts.find_one({"account_code": "1200"})
+    assert receivable["balance"] == pytest.approx(40 * 6.0)
+    await _assert_balanced(mock_db)
+
+
+async def test_failed_balance_line_undoes_the_whole_posting(mock_db, monkeypatch):
+    await ledger.post_journal([_posting("1200", "4000", 25.0)])
+    invoice_id = (await mock_db.sales_invoices.insert_one({"status": "Pending"})).inserted_id
+
+    # The balance bulk_write applies every line but the last and reports that one as failed
+    collection_class = type(mock_db.chart_of_accounts)
+    original = collection_class.bulk_write
+
+    async def failing_bulk_write(self, requests, *args, **kwargs):
+        if self.name != ledger.ACCOUNTS_COLLECTION or len(requests) < 2:
+            return await original(self, requests, *args, **kwargs)
+        await original(self, requests[:-1], *args, **kwargs)
+        raise BulkWriteError({"writeErrors": [{"index": len(requests) - 1, "code": 2, "errmsg": "forced"}]})
+
+    monkeypatch.setattr(collection_class, "bulk_write", failing_bulk_write)
+    guard = GuardedUpdate("sales_invoices", str(invoice_id), {"status": "Pending"}, {"status": "Paid"})
+    with pytest.raises(BulkWriteError):
+        await ledger.post_journal([_posting("1110", "1200", 25.0)], guard)
+    monkeypatch.setattr(collection_class, "bulk_write", original)
+
+    assert await mock_db.general_journal.count_documents({}) == 1
+    assert (await mock_db.sales_invoices.find_one({"_id": invoice_id}))["status"] == "Pending"
+    await _assert_balanced(mock_db)
+
+
+async def test_unknown_account_posts_nothing(mock_db):
+    with pytest.raises(ValueError):
+        await ledger.post_journal([_posting("1200", "4000", 5.0), _posting("9999", "1200", 5.0)])
+    assert await mock_db.general_journal.count_documents({}) == 0
+    async for account in mock_db.chart_of_accounts.find():
+        assert account["balance"] == 0
+
+
+async def test_guard_conflict_posts_nothing(mock_db):
+    invoice_id = (await mock_db.sales_invoices.insert_one({"status": "Paid"})).inserted_id
+    guard = GuardedUpdate("sales_invoices", str(invoice_id), {"status": "Pending"}, {"status": "Paid"})
+    with pytest.raises(LedgerConflict):
+        await ledger.post_journal([_posting("1200", "4000", 5.0)], guard)
+    assert await mock_db.general_journal.count_documents({}) == 0
+    await _assert_balanced(mock_db)
+
+
+async def test_guard_matches_legacy_string_ids(mock_db):
+    await mock_db.sales_invoices.insert_one({"_id": ObjectId(), "id": "INV-LEGACY", "status": "Pending"})
+    guard = GuardedUpdate("sales_invoices", "INV-LEGACY", {"status": "Pending"}, {"status": "Paid"})
+    await ledger.post_journal([_posting("1200", "4000", 5.0)], guard)
+    assert (await mock_db.sales_invoices.find_one({"id": "INV-LEGACY"}))["status"] == "Paid"
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+import numbering
+
+pytestmark = pytest.mark.asyncio
+
+
+async def _create_concurrently(mock_db, clients: int, per_client: int):
+    async def client():
+        for _ in range(per_client):
+            number = await numbering.next_number("INV", 2024)
+            await mock_db.sales_invoices.insert_one({"invoice_number": number})
+    await asyncio.gather(*(client() for _ in range(clients)))
+    return [doc["invoice_number"] async for doc in mock_db.sales_invoices.find()]
+
+
+async def test_concurrent_creates_get_distinct_gap_free_numbers(mock_db):
+    numbers = await _create_concurrently(mock_db, clients=50, per_client=10)
+    assert sorted(numbers) == [numbering.format_number("INV", 2024, seq) for seq in range(1, 501)]
+
+
+async def test_block_allocation_never_repeats_a_number(mock_db, monkeypatch):
+    monkeypatch.setattr(numbering, "NUMBER_BLOCK_SIZE", 7)
+    numbers = await _create_concurrently(mock_db, clients=30, per_client=10)
+    assert len(numbers) == 300
+    assert len(set(numbers)) == 300
+
+
+async def test_counter_continues_after_legacy_numbers(mock_db):
+    await mock_db.sales_invoices.insert_many([
+        {"invoice_number": "INV-2024-000041"},
+        {"invoice_number": "INV-2024-000007"},
+        {"invoice_number": "INV-2023-000900"},
+    ])
+    assert await numbering.next_number("INV", 2024) == "INV-2024-000042"
+    assert await numbering.next_number("INV", 2024) == "INV-2024-000043"
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import get_page
+
+pytestmark = pytest.mark.asyncio
+
+
+async def _seed(mock_db):
+    """Repeated sort values, null ones and a few documents without the field"""
+    base = datetime(2024, 1, 1)
+    docs = []
+    for i in range(47):
+        if i % 9 == 0:
+            due_date = None
+        else:
+            due_date = base + timedelta(days=i % 6)
+        docs.append({"n": i, "due_date": due_date, "status": "Pending" if i % 2 else "Paid"})
+    docs += [{"n": 100 + i, "status": "Pending"} for i in range(4)]
+    await mock_db.sales_invoices.insert_many(docs)
+    return docs
+
+
+async def _all_pages(limit, **kwargs):
+    seen, cursor = [], None
+    while True:
+        docs, cursor = await get_page("sales_invoices", limit=limit, cursor=cursor, **kwargs)
+        seen += [doc["n"] for doc in docs]
+        if not cursor:
+            return seen
+
+
+@pytest.mark.parametrize("direction", [1, -1])
+@pytest.mark.parametrize("limit", [1, 4, 10, 100])
+async def test_every_document_exactly_once(mock_db, direction, limit):
+    docs = await _seed(mock_db)
+    seen = await _all_pages(limit, sort_field="due_date", sort_direction=direction)
+    assert sorted(seen) == sorted(doc["n"] for doc in docs)
+
+
+async def test_pages_follow_sort_order(mock_db):
+    await _seed(mock_db)
+    seen = await _all_pages(5, sort_field="due_date", sort_direction=1)
+    expected = [doc["n"] async for doc in mock_db.sales_invoices.find().sort([("due_date", 1), ("_id", 1)])]
+    assert seen == expected
+
+
+async def test_filter_applies_on_every_page(mock_db):
+    docs = await _seed(mock_db)
+    seen = await _all_pages(6, filter_dict={"status": "Pending"}, sort_field="due_date", sort_direction=-1)
+    assert sorted(seen) == sorted(doc["n"] for doc in docs if doc["status"] == "Pending")
+
+
+async def test_default_created_at_order(mock_db):
+    now = datetime(2024, 1, 1)
+    await mock_db.customers.insert_many([{"n": i, "created_at": now - timedelta(seconds=i // 3)} for i in range(25)])
+    seen, cursor = [], None
+    while True:
+        docs, cursor = await get_page("customers", limit=7, cursor=cursor)
+        seen += [doc["n"] for doc in docs]
+        if not cursor:
+            break
+    assert sorted(seen) == list(range(25))
@@ -0,0 +1,57 @@
+import pytest
+
+from ledger import GuardedUpdate
+from stock import PENDING_FIELD, StockMovement, StockShortage, apply_stock_movements
+
+pytestmark = pytest.mark.asyncio
+
+
+async def _products(mock_db, **stocks):
+    result = await mock_db.products.insert_many([{"name": name, "stock": stock} for name, stock in stocks.items()])
+    return {name: str(product_id) for name, product_id in zip(stocks, result.inserted_ids)}
+
+
+async def _stocks(mock_db):
+    return {doc["name"]: doc["stock"] async for doc in mock_db.products.find()}
+
+
+async def test_movements_apply_and_leave_no_pending_marker(mock_db):
+    ids = await _products(mock_db, bolt=10, nut=5)
+    await apply_stock_movements([
+        StockMovement(ids["bolt"], -4, "bolt"),
+        StockMovement(ids["nut"], 3, "nut"),
+        StockMovement(ids["bolt"], -1, "bolt"),
+    ], "stock_transfer", "T-1")
+
+    assert await _stocks(mock_db) == {"bolt": 5, "nut": 8}
+    assert await mock_db.stock_movements.count_documents({"reference_id": "T-1"}) == 3
+    assert await mock_db.products.count_documents({PENDING_FIELD: {"$exists": True}}) == 0
+
+
+async def test_one_short_line_rolls_back_every_line(mock_db):
+    ids = await _products(mock_db, bolt=10, nut=2, washer=0)
+    order_id = (await mock_db.sales_orders.insert_one({"status": "Confirmed"})).inserted_id
+    guard = GuardedUpdate("sales_orders", str(order_id), {"status": "Confirmed"}, {"status": "Shipped"})
+
+    with pytest.raises(StockShortage) as raised:
+        await apply_stock_movements([
+            StockMovement(ids["bolt"], -3, "bolt"),
+            StockMovement(ids["nut"], -5, "nut"),
+            StockMovement(ids["washer"], 7, "washer"),
+        ], "sales_order", "SO-1", guard=guard)
+
+    assert raised.value.product_id == ids["nut"]
+    assert await _stocks(mock_db) == {"bolt": 10, "nut": 2, "washer": 0}
+    assert await mock_db.stock_movements.count_documents({}) == 0
+    assert await mock_db.products.count_documents({PENDING_FIELD: {"$exists": True}}) == 0
+    assert (await mock_db.sales_orders.find_one({"_id": order_id}))["status"] == "Confirmed"
+
+
+async def test_missing_product_rolls_back(mock_db):
+    ids = await _products(mock_db, bolt=10)
+    with pytest.raises(StockShortage):
+        await apply_stock_movements([
+            StockMovement(ids["bolt"], 5, "bolt"),
+            StockMovement("5f0000000000000000000000", -1, "gone"),
+        ], "stock_opname", "OPN-1")
+    assert await _stocks(mock_db) == {"bolt": 10}
@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import create_document, delete_document, update_document
+from sync import SyncTokenExpired, encode_sync_token, sync_page
+
+pytestmark = pytest.mark.asyncio
+
+
+async def _sync_pass(since=None, limit=3):
+    """Follow next_cursor to the end of a pass; returns documents by id, deletions and the token"""
+    documents, cursor = {}, None
+    while True:
+        page = await sync_page("customers", since, cursor, limit)
+        documents.update((doc["id"], doc) for doc in page["documents"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            return documents, [deleted["id"] for deleted in page["deleted"]], page["token"]
+
+
+async def test_full_pass_then_changes_and_tombstones(mock_db):
+    created = [await create_document("customers", {"name": f"Customer {i}"}) for i in range(7)]
+    documents, deleted, token = await _sync_pass()
+    assert set(documents) == {doc["id"] for doc in created}
+    assert deleted == []
+    assert token
+
+    await update_document("customers", created[2]["id"], {"name": "Renamed"})
+    assert await delete_document("customers", created[5]["id"])
+    documents, deleted, token = await _sync_pass(since=token)
+
+    assert documents[created[2]["id"]]["name"] == "Renamed"
+    assert created[5]["id"] not in documents
+    assert deleted == [created[5]["id"]]
+
+
+async def test_old_changes_are_not_resent(mock_db):
+    old = datetime.utcnow() - timedelta(hours=1)
+    await mock_db.customers.insert_many([{"name": "Old", "updated_at": old}, {"name": "New", "updated_at": datetime.utcnow()}])
+    documents, _, _ = await _sync_pass(since=encode_sync_token(datetime.utcnow() - timedelta(minutes=1)))
+    assert [doc["name"] for doc in documents.values()] == ["New"]
+
+
+async def test_token_older_than_tombstone_retention_expires(mock_db):
+    with pytest.raises(SyncTokenExpired):
+        await sync_page("customers", encode_sync_token(datetime.utcnow() - timedelta(days=365)))
+
+
+async def test_malformed_token_is_rejected(mock_db):
+    with pytest.raises(ValueError):
+        await sync_page("customers", "not-a-token")
@@ -161,12 +161,14 @@ const PurchaseInvoice = () => {
     try {
       const response = await fetch(`${API_URL}/purchase-invoices/${invoiceId}/pdf`);
       if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
-      const data = await response.json();
+      const blob = await response.blob();
+      const url = window.URL.createObjectURL(blob);
       const link = document.createElement('a');
-      link.href = data.pdf_path;
-      link.download = data.filename;
+      link.href = url;
+      link.download = `purchase_invoice_${invoiceId}.pdf`;
       document.body.appendChild(link);
       link.click();
+      window.URL.revokeObjectURL(url);
       document.body.removeChild(link);
     } catch (err) {
       console.error('Error downloading PDF:', err);
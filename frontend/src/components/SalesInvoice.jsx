@@ -100,14 +100,16 @@ const SalesInvoice = () => {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
       
-      const data = await response.json();
+      const blob = await response.blob();
+      const url = window.URL.createObjectURL(blob);
       
       // Create download link
       const link = document.createElement('a');
-      link.href = data.pdf_path;
-      link.download = data.filename;
+      link.href = url;
+      link.download = `invoice_${invoiceId}.pdf`;
       document.body.appendChild(link);
       link.click();
+      window.URL.revokeObjectURL(url);
       document.body.removeChild(link);
     } catch (err) {
       console.error('Error downloading PDF:', err);